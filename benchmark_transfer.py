@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+
+Benchmark of uploading files to a Raspberry PI without a Raspberry PI.
+
+It starts a local SSH server (paramiko) on a temporary directory behind a proxy
+simulating the latency and the bandwidth of the link, and measures deep_copy,
+list_copy and execute_remote on synthetic file trees.
+
+---
+"""
+
+import contextlib
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from os.path import join
+from time import monotonic, sleep
+
+import paramiko
+
+from install_utils import TRANSFER_METHODS, deep_copy, execute_remote, list_copy
+
+
+logging.basicConfig(format="%(message)s")
+logger = logging.getLogger()
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+SCENARIOS = ["tiny", "large", "webapplication", "list", "commands"]
+USERNAME = "argus"
+PASSWORD = "benchmark"
+
+
+class BenchmarkServer(paramiko.ServerInterface):
+    """
+    SSH server executing the commands with bash in the root directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def check_auth_password(self, username, password):
+        if username == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.execute, args=(channel, command.decode("utf-8")), daemon=True).start()
+        return True
+
+    def execute(self, channel, command):
+        process = subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=self.root,
+            env={**os.environ, "HOME": self.root},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        def forward_input():
+            with process.stdin:
+                for data in iter(lambda: channel.recv(32768), b""):
+                    try:
+                        process.stdin.write(data)
+                        process.stdin.flush()
+                    except BrokenPipeError:
+                        break
+
+        def forward_errors():
+            # the client may close the connection without waiting for the end of the command
+            with contextlib.suppress(EOFError, OSError):
+                for data in iter(lambda: process.stderr.read1(32768), b""):
+                    channel.sendall_stderr(data)
+
+        threading.Thread(target=forward_input, daemon=True).start()
+        errors = threading.Thread(target=forward_errors, daemon=True)
+        errors.start()
+        with contextlib.suppress(EOFError, OSError):
+            for data in iter(lambda: process.stdout.read1(32768), b""):
+                channel.sendall(data)
+            errors.join()
+            channel.send_exit_status(process.wait())
+            channel.close()
+
+
+class BenchmarkSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        paramiko.SFTPServer.set_file_attr(self.filename, attr)
+        return paramiko.SFTP_OK
+
+
+class BenchmarkSFTPServer(paramiko.SFTPServerInterface):
+    """
+    SFTP server on the local filesystem, relative paths are in the root directory
+    """
+
+    def __init__(self, server, root, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _path(self, path):
+        return os.path.join(self.root, path)
+
+    def _convert(self, function, *args):
+        try:
+            function(*args)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    def list_folder(self, path):
+        try:
+            result = []
+            for filename in os.listdir(self._path(path)):
+                attributes = paramiko.SFTPAttributes.from_stat(os.lstat(join(self._path(path), filename)))
+                attributes.filename = filename
+                result.append(attributes)
+            return result
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            descriptor = os.open(path, flags | getattr(os, "O_BINARY", 0), 0o666)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+
+        handle = BenchmarkSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(descriptor, mode)
+        return handle
+
+    def remove(self, path):
+        return self._convert(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._convert(os.rename, self._path(oldpath), self._path(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self._convert(os.replace, self._path(oldpath), self._path(newpath))
+
+    def mkdir(self, path, attr):
+        return self._convert(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._convert(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._convert(paramiko.SFTPServer.set_file_attr, self._path(path), attr)
+
+
+class LinkSimulator:
+    """
+    TCP proxy delaying the packets (latency) and limiting the bandwidth
+
+    Counts the round trips: the direction of the traffic changing from the client
+    to the server and back.
+    """
+
+    def __init__(self, target_port, latency=0.0, bandwidth=0):
+        self.target_port = target_port
+        # one way delay
+        self.delay = latency / 2
+        self.bandwidth = bandwidth
+        self.round_trips = 0
+        self._direction = None
+        self._lock = threading.Lock()
+        self._socket = socket.create_server(("127.0.0.1", 0))
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.round_trips = 0
+
+    def _accept(self):
+        while True:
+            client, _ = self._socket.accept()
+            server = socket.create_connection(("127.0.0.1", self.target_port))
+            for connection in (client, server):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for source, target, direction in ((client, server, "up"), (server, client, "down")):
+                packets = queue.Queue()
+                threading.Thread(target=self._receive, args=(source, packets, direction), daemon=True).start()
+                threading.Thread(target=self._send, args=(target, packets), daemon=True).start()
+
+    def _receive(self, source, packets, direction):
+        # closing the connection at the end of the benchmark
+        with contextlib.suppress(OSError):
+            for data in iter(lambda: source.recv(65536), b""):
+                with self._lock:
+                    if direction == "down" and self._direction == "up":
+                        self.round_trips += 1
+                    self._direction = direction
+                packets.put((monotonic() + self.delay, data))
+        packets.put((monotonic() + self.delay, b""))
+
+    def _send(self, target, packets):
+        with contextlib.suppress(OSError):
+            while True:
+                deliver, data = packets.get()
+                sleep(max(0, deliver - monotonic()))
+                if not data:
+                    target.shutdown(socket.SHUT_WR)
+                    return
+                if self.bandwidth:
+                    sleep(len(data) / self.bandwidth)
+                target.sendall(data)
+
+
+def start_server(root):
+    """
+    Start the SSH server on a random local port
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    server_socket = socket.create_server(("127.0.0.1", 0))
+
+    def accept():
+        while True:
+            client, _ = server_socket.accept()
+            # like sshd
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, BenchmarkSFTPServer, root)
+            transport.start_server(server=BenchmarkServer(root))
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server_socket.getsockname()[1]
+
+
+def connect(port):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect("127.0.0.1", port=port, username=USERNAME, password=PASSWORD, look_for_keys=False, allow_agent=False)
+    return ssh
+
+
+def write_file(filename, size, text=True):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as file:
+        if text:
+            # compressible content like source code
+            line = f"export const value{size} = function() {{ return {random.random()}; }};\n".encode("utf-8")
+            file.write((line * (size // len(line) + 1))[:size])
+        else:
+            file.write(random.randbytes(size))
+
+
+def generate_tiny(path, count=200, size=1024):
+    """
+    Many tiny files in nested directories (python sources)
+    """
+    for index in range(count):
+        write_file(join(path, f"package{index % 10}", f"module{index % 7}", f"file{index}.py"), size)
+
+
+def generate_large(path, count=3, size=8 * 1024 * 1024):
+    """
+    A few large (not compressible) files
+    """
+    for index in range(count):
+        write_file(join(path, f"archive{index}.bin"), size, text=False)
+
+
+def generate_webapplication(path):
+    """
+    Angular production build: localized copies of many chunks of different size
+    """
+    for language in ("en", "hu", "it"):
+        for index in range(60):
+            write_file(join(path, language, f"chunk-{index:08x}.js"), random.randint(500, 120 * 1024))
+        write_file(join(path, language, "main.js"), 600 * 1024)
+        write_file(join(path, language, "polyfills.js"), 35 * 1024)
+        write_file(join(path, language, "styles.css"), 80 * 1024)
+        write_file(join(path, language, "index.html"), 2 * 1024)
+        for index in range(15):
+            write_file(join(path, language, "assets", f"icon{index}.png"), random.randint(1024, 16 * 1024), text=False)
+
+
+def change_file(path):
+    """
+    Change one file of the tree (for the delta uploads), returns its name
+    """
+    filename = sorted(join(root, filename) for root, _, files in os.walk(path) for filename in files)[0]
+    write_file(filename, os.path.getsize(filename), text=False)
+    return filename
+
+
+def get_tree_size(path):
+    count, size = 0, 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            count += 1
+            size += os.path.getsize(join(root, filename))
+    return count, size
+
+
+def measure(name, method, link, function, files=0, size=0):
+    link.reset()
+    start = monotonic()
+    function()
+    duration = monotonic() - start
+    result = {
+        "scenario": name,
+        "method": method,
+        "files": files,
+        "bytes": size,
+        "seconds": round(duration, 3),
+        "files_per_second": round(files / duration, 1) if duration else 0,
+        "mb_per_second": round(size / 1024 / 1024 / duration, 2) if duration else 0,
+        "round_trips": link.round_trips,
+    }
+    print(
+        f"{name:<16} {method:<5} {files:>6} files {size:>10} bytes {duration:8.2f}s "
+        f"{result['files_per_second']:8.1f} files/s {result['mb_per_second']:7.2f} MB/s {link.round_trips:>6} round trips",
+        flush=True
+    )
+    return result
+
+
+def run_benchmark(scenarios, methods, latency, bandwidth, commands):
+    workspace = tempfile.mkdtemp(prefix="arpi_benchmark_")
+    try:
+        source = join(workspace, "source")
+        remote = join(workspace, "remote")
+        os.makedirs(remote)
+
+        random.seed(0)
+        generate_tiny(join(source, "tiny"))
+        generate_large(join(source, "large"))
+        generate_webapplication(join(source, "webapplication"))
+
+        link = LinkSimulator(start_server(remote), latency=latency, bandwidth=bandwidth)
+        ssh = connect(link.port)
+
+        results = []
+        for scenario in scenarios:
+            if scenario in ("tiny", "large", "webapplication"):
+                files, size = get_tree_size(join(source, scenario))
+                for method in methods:
+                    target = f"{scenario}_{method}"
+                    results.append(measure(
+                        scenario, method, link,
+                        lambda: deep_copy(ssh, join(source, scenario), target, "**/*", False, method=method),
+                        files, size
+                    ))
+                    # the manifest of the first delta upload is the base of the measured one
+                    deep_copy(ssh, join(source, scenario), target, "**/*", False, delta=True, method=method)
+                    # the throughput of the delta is measured on the transferred (changed) files
+                    changed = change_file(join(source, scenario))
+                    results.append(measure(
+                        f"{scenario} (delta)", method, link,
+                        lambda: deep_copy(ssh, join(source, scenario), target, "**/*", False, delta=True, method=method),
+                        1, os.path.getsize(changed)
+                    ))
+                    shutil.rmtree(join(remote, target))
+            elif scenario == "list":
+                files = [(join(source, "tiny", "package0", "module0", filename), ".")
+                         for filename in sorted(os.listdir(join(source, "tiny", "package0", "module0")))]
+                size = sum(os.path.getsize(filename) for filename, _ in files)
+                for method in methods:
+                    results.append(measure(
+                        "list", method, link, lambda: list_copy(ssh, files, False, method), len(files), size
+                    ))
+            elif scenario == "commands":
+                results.append(measure(
+                    "commands", "exec", link,
+                    lambda: [execute_remote(ssh, "true") for _ in range(commands)],
+                    commands
+                ))
+
+        ssh.close()
+        return results
+    finally:
+        shutil.rmtree(workspace)
+
+
+def main(argv=None):
+    """Command line options."""
+
+    parser = ArgumentParser(description=__doc__.split("---")[0], formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log the transfers")
+    parser.add_argument(
+        "-s", "--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS, help="Scenarios to run (default: all)"
+    )
+    parser.add_argument(
+        "-m", "--methods", nargs="+", choices=TRANSFER_METHODS, default=list(TRANSFER_METHODS),
+        help="Transfer methods to compare (default: all)"
+    )
+    parser.add_argument("-l", "--latency", type=float, default=0, help="Simulated round trip time in milliseconds")
+    parser.add_argument("-b", "--bandwidth", type=float, default=0, help="Simulated bandwidth in kB/s (default: unlimited)")
+    parser.add_argument("-c", "--commands", type=int, default=20, help="Number of remote commands to execute")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Save the results to the file (JSON)")
+    args = parser.parse_args(argv)
+
+    # the results are printed, the logs of the transfers only in verbose mode
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    print(f"Latency: {args.latency}ms, bandwidth: {f'{args.bandwidth}kB/s' if args.bandwidth else 'unlimited'}")
+
+    results = run_benchmark(args.scenarios, args.methods, args.latency / 1000, args.bandwidth * 1024, args.commands)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump({"latency_ms": args.latency, "bandwidth_kbps": args.bandwidth, "results": results}, output, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
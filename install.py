@@ -16,28 +16,46 @@ It uses the configuration file install/[_<environment>].yaml!
 @contact:    gkovacs81@gmail.com
 """
 
+import hashlib
 import json
 import logging
+import os
+import shlex
 import subprocess
 import sys
+import threading
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from os import path, system
 from os.path import basename, exists, join
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
 from socket import gaierror
-from time import sleep
+from time import monotonic, sleep
 
 import paramiko
 import yaml
 from paramiko.ssh_exception import SSHException
 from scp import SCPClient
 
+from trace_utils import ScriptTimer, export_trace, span, traced
+
 from install_utils import (
     deep_copy,
     execute_remote,
     generate_SSH_key,
+    compile_bytecode,
+    download_directory,
+    file_hash,
+    get_remote_python,
     list_copy,
-    print_lines,
-    show_progress
+    measure_bytecode,
+    precompress_assets,
+    pump_output,
+    RemoteCommandError,
+    run_steps,
+    show_progress,
+    Step,
+    TRANSFER_METHODS
 )
 
 
@@ -51,6 +69,34 @@ logging.basicConfig(format="%(message)s")
 logger = logging.getLogger()
 logging.getLogger("paramiko").setLevel(logging.CRITICAL)
 
+# serializes the changes of the local files (keys, dhparam, known hosts) when deploying to many hosts
+local_files_lock = threading.Lock()
+# one host at a time asks for the password on the terminal (ssh-copy-id) when deploying to many hosts
+terminal_lock = threading.Lock()
+# dhparam file => generation of the file shared by the hosts of the fleet
+dhparam_files = {}
+# printed by the install script when a step waits for the dhparam file
+DHPARAM_MARKER = "::dhparam::"
+
+# order of installing the components
+COMPONENTS = ["environment", "server", "monitor", "database", "webapplication"]
+
+# environment of pipenv for the virtual environment of the server on the device
+PIPENV_ENVIRONMENT = "PIPENV_TIMEOUT=9999 CI=1 WORKON_HOME=/home/argus/.venvs PIPENV_CUSTOM_VENV_NAME=server"
+# key of the python packages installed last (see get_packages_key)
+INSTALLED_PACKAGES_FILE = "server/.arpi_packages"
+# wheels of the python packages on the device
+WHEELHOUSE_DIRECTORY = "wheelhouse"
+REQUIREMENTS_FILE = "/tmp/requirements.txt"
+# the prebuilt packages are identified by the version, the architecture and the configure flags
+NGINX_CONFIGURE_FLAGS = "--with-http_stub_status_module --with-http_ssl_module --with-http_gzip_static_module"
+WIRINGPI_GITURL = "https://github.com/WiringPi/WiringPi.git"
+
+# authenticated connections shared by the installation steps: (hostname, port, username) => SSHClient
+connections = {}
+connection_locks = {}
+connections_lock = threading.Lock()
+
 __all__ = []
 __version__ = 0.1
 __date__ = "2017-08-21"
@@ -86,9 +132,57 @@ def get_default_connection(access):
     return ssh
 
 
+def get_connection_key(access):
+    return access["hostname"], access.get("port", 22), access["username"]
+
+
 def get_arpi_connection(access):
     """
-    Returns the connection to the remote host
+    Returns the shared connection to the remote host (connects if it's not connected yet)
+    """
+    key = get_connection_key(access)
+    with connections_lock:
+        lock = connection_locks.setdefault(key, threading.Lock())
+
+    # connecting to different hosts in parallel but only once to the same host
+    with lock:
+        ssh = connections.get(key)
+        if ssh is not None and ssh.get_transport() is not None and ssh.get_transport().is_active():
+            logger.debug("Reusing connection %s@%s:%s", access["username"], access["hostname"], access.get("port", 22))
+            return ssh
+
+        with span("connect", hostname=access["hostname"]):
+            ssh = connect_arpi(access)
+        connections[key] = ssh
+        return ssh
+
+
+def close_connection(access):
+    """
+    Closes the shared connection to the remote host
+    """
+    with connections_lock:
+        ssh = connections.pop(get_connection_key(access), None)
+
+    if ssh is not None:
+        ssh.close()
+
+
+def close_connections():
+    """
+    Closes all the shared connections
+    """
+    with connections_lock:
+        clients = list(connections.values())
+        connections.clear()
+
+    for ssh in clients:
+        ssh.close()
+
+
+def connect_arpi(access):
+    """
+    Returns a new connection to the remote host
     """
     try:
         if access.get("key_name", "") and exists(access.get("key_name", "")):
@@ -137,26 +231,32 @@ def get_arpi_connection(access):
     return ssh
 
 
-def install_environment(arpi_access, database, deployment, progress=False):
+@traced()
+def install_environment(
+    arpi_access, database, deployment, progress=False, method="scp", timing=None, only_steps=None, skip_steps=None
+):
     """
     Install prerequisites to an empty Raspberry PI.
+
+    The install script skips the steps completed by the previous runs. The only_steps
+    (even if completed) and the skip_steps are comma separated step names.
+    The duration of the sections and the commands of the install script is saved to the timing file.
+    With deployment.build_cache_path nginx and WiringPi are built only on the first device
+    of the architecture and the later devices install the cached packages.
     """
 
-    # generate SSH key if the name is defined but it doesn't exist
-    if (
-        arpi_access.get("key_name", "")
-        and not exists(arpi_access.get("key_name", ""))
-        and not exists(arpi_access.get("key_name", "") + ".pub")
-    ):
-        generate_SSH_key(arpi_access.get("key_name", ""), arpi_access["password"])
+    with local_files_lock:
+        # generate SSH key if the name is defined but it doesn't exist
+        if (
+            arpi_access.get("key_name", "")
+            and not exists(arpi_access.get("key_name", ""))
+            and not exists(arpi_access.get("key_name", "") + ".pub")
+        ):
+            generate_SSH_key(arpi_access.get("key_name", ""), arpi_access["password"])
 
+    # generated in the background while the device is provisioned
     dhparam_file = "arpi_dhparam.pem"
-    if not exists(dhparam_file):
-        logger.info("dhparam (%s) generating", dhparam_file)
-        system(f"openssl dhparam -out {dhparam_file} {deployment['dhparam_size']}")
-    else:
-        logger.info("dhparam (%s) already exists", dhparam_file)
-        system(f"openssl dhparam -in {dhparam_file} -text | head -3")
+    dhparam = get_dhparam(dhparam_file, deployment["dhparam_size"])
 
     # create the env variables string because paramiko update_environment ignores them
     arguments = {
@@ -176,42 +276,88 @@ def install_environment(arpi_access, database, deployment, progress=False):
     # adding package versions
     arguments.update({p.upper(): f"{v}" for p, v in deployment["packages"].items() if v})
 
-    arguments = [f"export {key}={value}" for key, value in arguments.items()]
-    arguments = "; ".join(arguments)
-
     # remove the known_hosts entry to avoid conflict with the previous installation
     known_hosts_file = path.expanduser("~/.ssh/known_hosts")
-    subprocess.call(["ssh-keygen", "-f", known_hosts_file, "-R", arpi_access["hostname"]])
+    with local_files_lock:
+        subprocess.call(["ssh-keygen", "-f", known_hosts_file, "-R", arpi_access["hostname"]])
 
     ssh = get_arpi_connection(arpi_access)
     scp = SCPClient(ssh.get_transport(), progress=show_progress if progress else None)
     scp.put("scripts/install_environment.sh", remote_path=".")
-    deep_copy(ssh, join("server", "etc"), "/tmp/etc", "**/*", progress)
-    list_copy(
-        ssh,
-        (
-            (dhparam_file, "/tmp"),
-            ("manage_versions.py", "~")
-        ),
-        progress
-    )
+    deep_copy(ssh, join("server", "etc"), "/tmp/etc", "**/*", progress, method=method)
+    list_copy(ssh, (("manage_versions.py", "~"),), progress, method)
+    execute_remote(ssh=ssh, command=f"rm -f {join('/tmp', dhparam_file)}.failed")
+
+    prebuilt = get_prebuilt_packages(ssh, deployment["packages"])
+    build_cache = deployment.get("build_cache_path")
+    if build_cache:
+        upload_prebuilt_packages(ssh, prebuilt, build_cache, progress, method)
+    arguments.update(prebuilt)
+    arguments["NGINX_CONFIGURE_FLAGS"] = shlex.quote(NGINX_CONFIGURE_FLAGS)
+
+    arguments = [f"export {key}={value}" for key, value in arguments.items()]
+    arguments = "; ".join(arguments)
 
     channel = ssh.get_transport().open_session()
     channel.get_pty()
     channel.set_combine_stderr(True)
-    output = channel.makefile("r", -1)
+
+    dhparam_upload = threading.Thread(
+        target=upload_dhparam,
+        args=(ssh, dhparam, join("/tmp", dhparam_file), progress),
+        name=threading.current_thread().name,
+        daemon=True,
+    )
+    dhparam_upload.start()
 
     logger.info("Starting install script...")
-    channel.exec_command(f"{arguments}; ./install_environment.sh")
-    print_lines(output)
+    options = ""
+    if only_steps:
+        options += f" --only {shlex.quote(only_steps)}"
+    if skip_steps:
+        options += f" --skip {shlex.quote(skip_steps)}"
+    channel.exec_command(f"{arguments}; ./install_environment.sh{options}")
+    timer = ScriptTimer()
+    dhparam_needed = threading.Event()
+
+    def on_line(stream, elapsed, line):
+        if line == DHPARAM_MARKER:
+            dhparam_needed.set()
+        timer.on_line(stream, elapsed, line)
+
+    exit_status = pump_output(channel, on_line=on_line)
+    logger.info("Install script finished with exit status %s", exit_status)
+    # the script doesn't use the dhparam file if it failed or the steps of the file didn't run
+    # (completed, skipped or not selected), the daemon thread is left behind
+    if exit_status != 0:
+        if dhparam_upload.is_alive():
+            logger.warning("Install script failed, not waiting for the dhparam (%s) generation", dhparam_file)
+    elif dhparam_needed.is_set():
+        if dhparam_upload.is_alive():
+            logger.info("Waiting for the dhparam (%s) generation...", dhparam_file)
+        dhparam_upload.join()
+    elif dhparam_upload.is_alive():
+        logger.info("The dhparam (%s) isn't used by the install script, not waiting for the generation", dhparam_file)
+    timer.finish()
+    timer.log_summary()
+    if timing:
+        timer.save(timing.format(hostname=arpi_access["hostname"]))
+    if build_cache:
+        # the packages built by the script (also if a later step failed)
+        download_prebuilt_packages(ssh, prebuilt, build_cache)
+    if exit_status != 0:
+        raise RemoteCommandError(
+            f"Install script failed (exit status {exit_status}), installing the environment again resumes at the failed step"
+        )
 
     if arpi_access.get("key_name", "") and arpi_access['deploy_ssh_key']:
         # deploy key
         command = f"ssh-copy-id -i {arpi_access.get('key_name', '')} {arpi_access['username']}@{arpi_access['hostname']}"
-        logger.info("Deploy public key: %s", command)
-        while subprocess.call(command, shell=True) != 0:
-            # retry after 2 seconds
-            sleep(2)
+        with terminal_lock:
+            logger.info("Deploy public key: %s", command)
+            while subprocess.call(command, shell=True) != 0:
+                # retry after 2 seconds
+                sleep(2)
 
     if arpi_access.get("key_name", "") and arpi_access['disable_ssh_password_authentication']:
         # ssh accept password only from terminal
@@ -219,23 +365,22 @@ def install_environment(arpi_access, database, deployment, progress=False):
             message="Switching to key based ssh authentication",
             ssh=ssh,
             command="sudo sed -i -E -e 's/.*PasswordAuthentication (yes|no)/PasswordAuthentication no/g' /etc/ssh/sshd_config",
+            check=True,
         )
 
     logger.info("Finished installing environment")
 
 
-def install_component(arpi_access, deployment, component, update=False, restart=False, progress=False):
-    """
-    Install the monitor component to a Raspberry PI.
-    """
-    ssh = get_arpi_connection(arpi_access)
-
+def create_server_directories(ssh):
     execute_remote(
         message="Creating server directories...",
         ssh=ssh,
         command="mkdir -p  server/etc server/scripts server/src webapplication",
+        check=True,
     )
 
+
+def upload_common_files(ssh, deployment, progress=False, delta=False, method="scp", bytecode=False):
     logger.info("Copy common files...")
     list_copy(
         ssh,
@@ -249,128 +394,584 @@ def install_component(arpi_access, deployment, component, update=False, restart=
             (join("server", "src", "models.py"), join("server", "src", "models.py")),
             (join("server", "src", "new_registration_code.py"), join("server", "src", "new_registration_code.py")),
             (join("server", "src", "tester.py"), join("server", "src", "tester.py")),
-        ), progress
-    )
-    deep_copy(
-        ssh, join("server", "src", "tools"), join("server", "src", "tools"), "**/*.py", progress
-    )
-
-    logger.info("Copy component '%s'...", component)
-    deep_copy(
-        ssh,
-        join("server", "src", component),
-        join("server", "src", component),
-        "**/*.py",
-        progress
+        ), progress, method
     )
+    upload_python_sources(ssh, join("server", "src", "tools"), progress, delta, method, bytecode)
 
     if deployment["deploy_simulator"]:
         list_copy(
             ssh,
             (
                 (join("server", "src", "simulator.py"), join("server", "src", "simulator.py")),
-            ), progress
+            ), progress, method
         )
 
-    if update:
-        categories = ["packages", "device"]
-        if deployment["deploy_simulator"]:
-            categories.append("simulator")
 
-        execute_remote(
-            message="Install python packages to system...",
+def upload_component(ssh, component, progress=False, delta=False, method="scp", bytecode=False):
+    logger.info("Copy component '%s'...", component)
+    upload_python_sources(ssh, join("server", "src", component), progress, delta, method, bytecode)
+
+
+def upload_python_sources(ssh, source, progress=False, delta=False, method="scp", bytecode=False):
+    """
+    Copy the python files of the directory to the same path on the device.
+
+    With bytecode the .pyc files are compiled for the python of the device: locally and uploaded
+    with the sources if the local python has the same version, on the device otherwise.
+    """
+    filters = ["**/*.py"]
+    compile_locally = False
+    if bytecode:
+        home, cache_tag = get_remote_python(ssh)
+        compile_locally = cache_tag == sys.implementation.cache_tag
+        if compile_locally:
+            # the hosts of the fleet upload the same files
+            with local_files_lock:
+                compile_bytecode(source, join(home, source))
+            filters.append(f"**/__pycache__/*.{cache_tag}.pyc")
+
+    deep_copy(ssh, source, source, filters, progress, delta, method)
+
+    if bytecode:
+        if not compile_locally:
+            execute_remote(
+                message=f"Compile {source} on the device ({cache_tag})...",
+                ssh=ssh,
+                command=f"python3 -m compileall -q --invalidation-mode checked-hash {source}",
+                check=True,
+            )
+        measure_bytecode(ssh, source)
+
+
+def install_python_packages(ssh, arpi_access, deployment, progress=False, delta=False, method="scp"):
+    """
+    Install the python packages of the Pipfile.lock unless the same lock is installed already.
+
+    With a wheelhouse (deployment.wheelhouse_path) the wheels built on the first device are
+    stored locally and the later installs use them without the package index.
+    """
+    categories = ["packages", "device"]
+    if deployment["deploy_simulator"]:
+        categories.append("simulator")
+
+    key = get_packages_key(ssh, categories)
+    _, stdout, _ = ssh.exec_command(f"cat {INSTALLED_PACKAGES_FILE} 2>/dev/null")
+    if stdout.read().decode().strip() == key:
+        logger.info("Python packages are up to date (%s)", key)
+        return
+
+    wheelhouse = join(deployment["wheelhouse_path"], key) if deployment.get("wheelhouse_path") else None
+    offline = wheelhouse is not None and exists(wheelhouse)
+    if offline:
+        logger.info("Copy wheels: %s => %s", wheelhouse, WHEELHOUSE_DIRECTORY)
+        deep_copy(ssh, wheelhouse, WHEELHOUSE_DIRECTORY, "*.whl", progress, delta, method)
+
+    status = None
+    if offline:
+        # the wheels built on the device don't match the hashes of the Pipfile.lock,
+        # pip installs them from the requirements without hashes
+        status = execute_remote(
+            message="Install python packages from the wheelhouse...",
             ssh=ssh,
             password=arpi_access["password"],
-            command=f"cd server; \
-                    PIPENV_TIMEOUT=9999 CI=1 WORKON_HOME=/home/argus/.venvs PIPENV_CUSTOM_VENV_NAME=server \
-                    pipenv install --site-packages --categories \"{' '.join(categories)}\"",
+            command=f"cd server; {get_requirements_command(categories)} && \
+                {PIPENV_ENVIRONMENT} PIPENV_SITE_PACKAGES=1 pipenv run pip install --no-index --no-deps \
+                --find-links $HOME/{WHEELHOUSE_DIRECTORY} -r {REQUIREMENTS_FILE}",
         )
+        if status != 0:
+            logger.warning("Failed to install from the wheelhouse, using the package index")
 
-    if restart:
+    if status != 0:
         execute_remote(
-            message=f"Restarting the '{component}' service...",
+            message="Install python packages to system...",
             ssh=ssh,
             password=arpi_access["password"],
-            command=f"sudo systemctl restart argus_{component}.service",
+            command=f"cd server; {PIPENV_ENVIRONMENT} pipenv install --site-packages --categories \"{' '.join(categories)}\"",
+            check=True,
         )
+    if wheelhouse is not None and not offline:
+        build_wheelhouse(ssh, categories, wheelhouse)
 
-    ssh.close()
+    execute_remote(ssh=ssh, command=f"echo {key} > {INSTALLED_PACKAGES_FILE}", check=True)
 
 
-def install_server(arpi_access, deployment, update=False, restart=False, progress=False):
+def get_dhparam(filename, size):
     """
-    Install the server component to a Raspberry PI.
+    Returns the future of the dhparam file, generating it in the background if it doesn't exist.
+
+    The hosts of the fleet share the file and its generation.
     """
-    install_component(arpi_access, deployment, "server", update=update, restart=restart, progress=progress)
+    with local_files_lock:
+        if filename not in dhparam_files:
+            future = Future()
+            dhparam_files[filename] = future
+            if exists(filename):
+                logger.info("dhparam (%s) already exists", filename)
+                system(f"openssl dhparam -in {filename} -text | head -3")
+                future.set_result(filename)
+            else:
+                threading.Thread(
+                    target=generate_dhparam, args=(filename, size, future), name="dhparam", daemon=True
+                ).start()
+
+        return dhparam_files[filename]
+
+
+def generate_dhparam(filename, size, future):
+    logger.info("dhparam (%s) generating", filename)
+    try:
+        with span("dhparam", size=size):
+            subprocess.run(
+                ["openssl", "dhparam", "-out", f"{filename}.tmp", str(size)],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        os.replace(f"{filename}.tmp", filename)
+        logger.info("dhparam (%s) generated", filename)
+        future.set_result(filename)
+    except (OSError, subprocess.CalledProcessError) as error:
+        logger.error("Failed to generate dhparam (%s): %s", filename, error)
+        future.set_exception(error)
 
 
-def install_monitor(arpi_access, deployment, update=False, restart=False, progress=False):
+def upload_dhparam(ssh, dhparam, target, progress=False):
     """
-    Install the monitor component to a Raspberry PI.
+    Upload the dhparam file when it is generated, the install script waits for it.
+    """
+    try:
+        filename = dhparam.result()
+        scp = SCPClient(ssh.get_transport(), progress=show_progress if progress else None)
+        logger.info("  Copying %s to %s", filename, target)
+        # the file appears at once for the install script
+        scp.put(filename, remote_path=f"{target}.tmp")
+        execute_remote(ssh=ssh, command=f"mv {target}.tmp {target}", check=True)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.error("Failed to upload dhparam: %s", error)
+        execute_remote(ssh=ssh, command=f"touch {target}.failed")
+
+
+def get_prebuilt_packages(ssh, packages):
+    """
+    Returns the remote paths of the prebuilt packages and the resolved versions (environment variables of the install script).
+
+    The file names identify the build: version, OS release, architecture (and the hash of the configure flags).
+    """
+    _, stdout, _ = ssh.exec_command("uname -m")
+    machine = stdout.read().decode().strip()
+    _, stdout, _ = ssh.exec_command(". /etc/os-release && echo $VERSION_CODENAME")
+    release = stdout.read().decode().strip() or "unknown"
+
+    prebuilt = {}
+    if packages.get("nginx_version"):
+        flags = hashlib.sha256(NGINX_CONFIGURE_FLAGS.encode()).hexdigest()[:8]
+        prebuilt["NGINX_ARTIFACT"] = f"/tmp/nginx-{packages['nginx_version']}-{release}-{machine}-{flags}.tar.gz"
+
+    # build the same commit of the default branch on all the devices
+    wiringpi_version = packages.get("wiringpi_version") or get_remote_head(WIRINGPI_GITURL)
+    if wiringpi_version:
+        prebuilt["WIRINGPI_VERSION"] = wiringpi_version
+        prebuilt["WIRINGPI_ARTIFACT"] = f"/tmp/wiringpi-{wiringpi_version}-{release}-{machine}.deb"
+
+    return prebuilt
+
+
+def get_remote_head(url):
+    """
+    Returns the commit of the default branch of the git repository (None if it isn't available).
     """
-    install_component(arpi_access, deployment, "monitor", update=update, restart=restart, progress=progress)
+    try:
+        output = subprocess.check_output(["git", "ls-remote", url, "HEAD"], text=True, timeout=30)
+        return output.split()[0][:12]
+    except (OSError, subprocess.SubprocessError, IndexError) as error:
+        logger.warning("Failed to get the commit of %s: %s", url, error)
+        return None
+
 
+def get_artifact_paths(prebuilt):
+    return [value for key, value in prebuilt.items() if key.endswith("_ARTIFACT")]
 
-def install_database(arpi_access, database, update=False, progress=False):
+
+def upload_prebuilt_packages(ssh, prebuilt, build_cache, progress=False, method="scp"):
     """
-    Install the database component to a Raspberry PI.
+    Upload the packages of the build cache to the device.
     """
-    ssh = get_arpi_connection(arpi_access)
+    files = [
+        (join(build_cache, basename(artifact)), "/tmp")
+        for artifact in get_artifact_paths(prebuilt)
+        if exists(join(build_cache, basename(artifact)))
+    ]
+    if files:
+        logger.info("Upload prebuilt packages...")
+        list_copy(ssh, files, progress, method)
+
+
+def download_prebuilt_packages(ssh, prebuilt, build_cache):
+    """
+    Download the packages built on the device to the build cache.
+    """
+    scp = SCPClient(ssh.get_transport())
+    for artifact in get_artifact_paths(prebuilt):
+        filename = join(build_cache, basename(artifact))
+        if exists(filename):
+            continue
+
+        _, stdout, _ = ssh.exec_command(f"test -f {artifact}")
+        if stdout.channel.recv_exit_status() != 0:
+            continue
+
+        logger.info("Save the prebuilt package %s to %s", basename(artifact), build_cache)
+        with local_files_lock:
+            os.makedirs(build_cache, exist_ok=True)
+            scp.get(artifact, local_path=f"{filename}.tmp")
+            os.replace(f"{filename}.tmp", filename)
+
 
+def get_packages_key(ssh, categories):
+    """
+    Returns the key of the python packages: hash of the Pipfile.lock, categories, python version and architecture.
+    """
+    _, stdout, _ = ssh.exec_command(
+        "python3 -c 'import platform, sys; print(\"py%s%s-%s\" % (*sys.version_info[:2], platform.machine()))'"
+    )
+    platform_tag = stdout.read().decode().strip()
+    return f"{file_hash(join('server', 'Pipfile.lock'))[:16]}-{'+'.join(categories)}-{platform_tag}"
+
+
+def get_requirements_command(categories):
+    """
+    Returns the command writing the locked versions of the packages (without hashes) to the requirements file.
+    """
+    return f"{PIPENV_ENVIRONMENT} pipenv requirements --categories \"{' '.join(categories)}\" > {REQUIREMENTS_FILE}"
+
+
+def build_wheelhouse(ssh, categories, wheelhouse):
+    """
+    Build the wheels of the installed packages on the device and download them to the wheelhouse.
+    """
+    status = execute_remote(
+        message="Build wheels of the python packages...",
+        ssh=ssh,
+        command=f"cd server; rm -rf $HOME/{WHEELHOUSE_DIRECTORY}; {get_requirements_command(categories)} && \
+                {PIPENV_ENVIRONMENT} pipenv run pip wheel --no-deps -r {REQUIREMENTS_FILE} -w $HOME/{WHEELHOUSE_DIRECTORY}",
+    )
+    if status != 0:
+        logger.warning("Failed to build the wheels, the wheelhouse isn't updated")
+        return
+
+    download_directory(ssh, WHEELHOUSE_DIRECTORY, wheelhouse)
+
+
+def restart_service(ssh, arpi_access, service):
+    execute_remote(
+        message=f"Restarting the '{service}' service...",
+        ssh=ssh,
+        password=arpi_access["password"],
+        command=f"sudo systemctl restart {service}.service",
+        check=True,
+    )
+
+
+def upload_migrations(ssh, progress=False, delta=False, method="scp"):
     logger.info("Copy migrations...")
     deep_copy(
         ssh,
         join("server", "migrations"),
         join("server", "migrations"),
         "**/*",
-        progress
+        progress,
+        delta,
+        method
     )
 
+
+def upgrade_database(ssh):
     execute_remote(
         message="Upgrade database...",
         ssh=ssh,
-        command="""cd server; \ 
+        command="""cd server; \
             source /home/argus/.venvs/server/bin/activate; \
             export $(grep -hv '^#' .env secrets.env | sed 's/\"//g' | xargs -d '\\n'); \
             printenv; \
             flask --app server:app db upgrade
-        """
+        """,
+        check=True,
     )
 
-    if update:
-        execute_remote(
-            message="Updating database content...",
-            ssh=ssh,
-            command=f"cd server;\
-                    source /home/argus/.venvs/server/bin/activate; \
-                    src/data.py -d -c {database['content']}",
-        )
 
-    ssh.close()
+def update_database_content(ssh, database):
+    execute_remote(
+        message="Updating database content...",
+        ssh=ssh,
+        command=f"cd server;\
+                source /home/argus/.venvs/server/bin/activate; \
+                src/data.py -d -c {database['content']}",
+        check=True,
+    )
 
 
-def install_webapplication(arpi_access, deployment, restart=False, progress=False):
-    """
-    Install the web application component to a Raspberry PI.
-    """
-    ssh = get_arpi_connection(arpi_access)
-
+def remove_webapplication(ssh):
     execute_remote(
         message="Delete old webapplication on remote site...",
         ssh=ssh,
         command="rm -R webapplication || true",
     )
 
+
+def upload_webapplication(ssh, deployment, progress=False, delta=False, method="scp"):
     target = "webapplication"
+    # the hosts of the fleet upload the same files
+    with local_files_lock:
+        precompress_assets(deployment["webapplication_path"], deployment.get("precompress", ["gzip"]))
+
     logger.info("Copy web application: %s => %s", deployment["webapplication_path"], target)
-    deep_copy(ssh, deployment["webapplication_path"], target, "**/*", progress)
+    deep_copy(ssh, deployment["webapplication_path"], target, "**/*", progress, delta, method)
+
+
+@traced()
+def install_component(
+    arpi_access, deployment, component, update=False, restart=False, progress=False, delta=False, method="scp", bytecode=False
+):
+    """
+    Install the monitor component to a Raspberry PI.
+    """
+    ssh = get_arpi_connection(arpi_access)
+
+    create_server_directories(ssh)
+    upload_common_files(ssh, deployment, progress, delta, method, bytecode)
+    upload_component(ssh, component, progress, delta, method, bytecode)
+
+    if update:
+        install_python_packages(ssh, arpi_access, deployment, progress, delta, method)
 
     if restart:
-        execute_remote(
-            message="Restarting the service...",
-            ssh=ssh,
-            command="sudo systemctl restart nginx.service",
+        restart_service(ssh, arpi_access, f"argus_{component}")
+
+
+def install_server(
+    arpi_access, deployment, update=False, restart=False, progress=False, delta=False, method="scp", bytecode=False
+):
+    """
+    Install the server component to a Raspberry PI.
+    """
+    install_component(
+        arpi_access, deployment, "server", update=update, restart=restart, progress=progress, delta=delta, method=method,
+        bytecode=bytecode
+    )
+
+
+def install_monitor(
+    arpi_access, deployment, update=False, restart=False, progress=False, delta=False, method="scp", bytecode=False
+):
+    """
+    Install the monitor component to a Raspberry PI.
+    """
+    install_component(
+        arpi_access, deployment, "monitor", update=update, restart=restart, progress=progress, delta=delta, method=method,
+        bytecode=bytecode
+    )
+
+
+@traced()
+def install_database(arpi_access, database, update=False, progress=False, delta=False, method="scp"):
+    """
+    Install the database component to a Raspberry PI.
+    """
+    ssh = get_arpi_connection(arpi_access)
+
+    upload_migrations(ssh, progress, delta, method)
+    upgrade_database(ssh)
+
+    if update:
+        update_database_content(ssh, database)
+
+
+@traced()
+def install_webapplication(arpi_access, deployment, restart=False, progress=False, delta=False, method="scp"):
+    """
+    Install the web application component to a Raspberry PI.
+    """
+    ssh = get_arpi_connection(arpi_access)
+
+    if not delta:
+        # in delta mode the removed files are deleted based on the manifest
+        remove_webapplication(ssh)
+
+    upload_webapplication(ssh, deployment, progress, delta, method)
+
+    if restart:
+        restart_service(ssh, arpi_access, "nginx")
+
+
+def plan_steps(components, arpi_access, config, args):
+    """
+    Returns the steps of installing the components with their dependencies.
+
+    The uploads don't depend on each other, the package installation, the database
+    upgrade and the service restarts wait for the files they use.
+    """
+    ssh = get_arpi_connection(arpi_access)
+    deployment = config["deployment"]
+    transfer = (args.progress, args.delta, args.method)
+    services = [component for component in ("server", "monitor") if component in components]
+
+    steps = []
+    if services:
+        steps.append(Step("directories", partial(create_server_directories, ssh), []))
+        steps.append(
+            Step("common files", partial(upload_common_files, ssh, deployment, *transfer, args.bytecode), ["directories"])
+        )
+        for component in services:
+            steps.append(
+                Step(f"upload {component}", partial(upload_component, ssh, component, *transfer, args.bytecode), ["directories"])
+            )
+        if args.update:
+            steps.append(
+                Step("python packages", partial(install_python_packages, ssh, arpi_access, deployment, *transfer), ["common files"])
+            )
+
+    if "database" in components:
+        # the database upgrade runs the server application in the virtual environment
+        dependencies = ["upload migrations"] + [
+            step.name for step in steps if step.name in ("common files", "upload server", "python packages")
+        ]
+        steps.append(Step("upload migrations", partial(upload_migrations, ssh, *transfer), []))
+        steps.append(Step("upgrade database", partial(upgrade_database, ssh), dependencies))
+        if args.update:
+            steps.append(
+                Step("update database", partial(update_database_content, ssh, config["database"]), ["upgrade database"])
+            )
+
+    if args.restart:
+        for component in services:
+            dependencies = [
+                step.name for step in steps
+                if step.name in ("common files", f"upload {component}", "python packages", "upgrade database", "update database")
+            ]
+            steps.append(
+                Step(f"restart {component}", partial(restart_service, ssh, arpi_access, f"argus_{component}"), dependencies)
+            )
+
+    if "webapplication" in components:
+        dependencies = []
+        if not args.delta:
+            steps.append(Step("remove webapplication", partial(remove_webapplication, ssh), []))
+            dependencies = ["remove webapplication"]
+        steps.append(
+            Step("upload webapplication", partial(upload_webapplication, ssh, deployment, *transfer), dependencies)
         )
+        if args.restart:
+            steps.append(
+                Step("restart nginx", partial(restart_service, ssh, arpi_access, "nginx"), ["upload webapplication"])
+            )
+
+    return steps
+
+
+def get_targets(config):
+    """
+    Returns the access parameters of the hosts.
+
+    The targets inherit the common access parameters (arpi_access) and can override them.
+    """
+    targets = config.get("targets") or []
+    if not targets:
+        return [config["arpi_access"]]
+
+    return [{**config["arpi_access"], **target} for target in targets]
+
+
+def install(component, arpi_access, config, args):
+    """
+    Install the component to the host.
+    """
+    if component == "environment":
+        install_environment(
+            arpi_access, config["database"], config["deployment"], args.progress, args.method, args.timing,
+            args.only_steps, args.skip_steps
+        )
+    elif component == "server":
+        install_server(
+            arpi_access, config["deployment"], args.update, args.restart, args.progress, args.delta, args.method, args.bytecode
+        )
+    elif component == "monitor":
+        install_monitor(
+            arpi_access, config["deployment"], args.update, args.restart, args.progress, args.delta, args.method, args.bytecode
+        )
+    elif component == "webapplication":
+        install_webapplication(arpi_access, config["deployment"], args.restart, args.progress, args.delta, args.method)
+    elif component == "database":
+        install_database(arpi_access, config["database"], args.update, args.progress, args.delta, args.method)
+    else:
+        logger.error("Unknown component: %s", component)
+
+
+def install_components(components, arpi_access, config, args):
+    """
+    Install the components to the host through one shared connection.
+
+    In parallel mode the independent steps of the components run at the same
+    time on their own channels of the connection.
+    """
+    try:
+        if args.parallel:
+            if "environment" in components:
+                # the environment is the prerequisite of the other components
+                install("environment", arpi_access, config, args)
+
+            steps = plan_steps([c for c in components if c != "environment"], arpi_access, config, args)
+            with span("install steps", hostname=arpi_access["hostname"], steps=len(steps)):
+                run_steps(steps, args.parallel_steps)
+        else:
+            for component in components:
+                logger.info("Installing component '%s'...", component)
+                with span(f"install {component}", hostname=arpi_access["hostname"]):
+                    install(component, arpi_access, config, args)
+    finally:
+        close_connection(arpi_access)
+
+
+def install_fleet(components, targets, config, args):
+    """
+    Install the components to all the hosts in parallel.
+
+    Returns the result of the installation for each host: (hostname, error, duration).
+    """
+
+    def install_host(arpi_access):
+        # the name of the thread identifies the host in the log
+        threading.current_thread().name = arpi_access["hostname"]
+        start = monotonic()
+        try:
+            install_components(components, arpi_access, config, args)
+            logger.info("Finished successfully!")
+            return arpi_access["hostname"], None, monotonic() - start
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Failed to execute!")
+            return arpi_access["hostname"], error, monotonic() - start
+
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(install_host, target) for target in targets]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    return sorted(results, key=lambda result: result[0])
+
+
+def print_summary(results):
+    """
+    Prints the result of the installation for each host.
+    """
+    lines = []
+    for hostname, error, duration in results:
+        status = "FAILED" if error else "OK"
+        lines.append(f"  {hostname:<32} {status:<8} {duration:8.1f}s  {error or ''}".rstrip())
+
+    failed = len([error for _, error, _ in results if error])
+    logger.info(
+        "Deployment summary (%s succeeded, %s failed):\n%s", len(results) - failed, failed, "\n".join(lines)
+    )
 
 
 def main(argv=None):  # IGNORE:C0111
@@ -381,6 +982,7 @@ def main(argv=None):  # IGNORE:C0111
     else:
         sys.argv.extend(argv)
 
+    args = None
     try:
         # Setup argument parser
         parser = ArgumentParser(
@@ -396,8 +998,11 @@ def main(argv=None):  # IGNORE:C0111
             help="Verbose output",
         )
         parser.add_argument(
-            "component",
-            choices=["environment", "server", "monitor", "database", "webapplication"],
+            "components",
+            nargs="+",
+            metavar="component",
+            choices=COMPONENTS,
+            help=f"Components to install in the order of {COMPONENTS}",
         )
         parser.add_argument(
             "-e",
@@ -425,6 +1030,74 @@ def main(argv=None):  # IGNORE:C0111
             action="store_true",
             help="Show progress bars",
         )
+        parser.add_argument(
+            "-d",
+            "--delta",
+            action="store_true",
+            help="Upload only the new and changed files and delete the removed ones (based on the manifest on the device)",
+        )
+        parser.add_argument(
+            "-t",
+            "--transfer",
+            dest="method",
+            choices=TRANSFER_METHODS,
+            default="scp",
+            help="Method of uploading the files: one SCP transfer per file, one compressed tar stream "
+            "or pipelined SFTP (default: scp)",
+        )
+        parser.add_argument(
+            "-b",
+            "--bytecode",
+            action="store_true",
+            help="Upload the python files compiled for the device (checked-hash .pyc) and measure the cold start",
+        )
+        parser.add_argument(
+            "-y",
+            "--yes",
+            action="store_true",
+            help="Start the installation without waiting for verifying the configuration",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of hosts installed in parallel if the configuration has more targets (default: 8)",
+        )
+        parser.add_argument(
+            "-P",
+            "--parallel",
+            action="store_true",
+            help="Run the independent installation steps in parallel",
+        )
+        parser.add_argument(
+            "--parallel-steps",
+            type=int,
+            default=4,
+            metavar="STEPS",
+            help="Number of installation steps running at the same time with --parallel (default: 4)",
+        )
+        parser.add_argument(
+            "--trace",
+            metavar="FILE",
+            help="Save the duration of the installation steps to the file (Chrome trace JSON)",
+        )
+        parser.add_argument(
+            "--only-steps",
+            metavar="STEPS",
+            help="Run only the listed steps of the environment install script (comma separated, even if completed)",
+        )
+        parser.add_argument(
+            "--skip-steps",
+            metavar="STEPS",
+            help="Skip the listed steps of the environment install script (comma separated)",
+        )
+        parser.add_argument(
+            "--timing",
+            metavar="FILE",
+            help="Save the duration of the sections and commands of the environment install script to the file "
+            "(JSON, {hostname} is replaced with the name of the host)",
+        )
 
         # Process arguments
         args = parser.parse_args()
@@ -441,20 +1114,25 @@ def main(argv=None):  # IGNORE:C0111
         with open(config_filename, "r", encoding="utf-8") as stream:
             config = yaml.load(stream, Loader=yaml.FullLoader)
             logger.info("Working with configuration: \n%s", json.dumps(config, indent=4, sort_keys=True))
-            input("Waiting before starting the installation to verify the configuration!")
-
-        if args.component == "environment":
-            install_environment(config["arpi_access"], config["database"], config["deployment"], args.progress)
-        elif args.component == "server":
-            install_server(config["arpi_access"], config["deployment"], args.update, args.restart, args.progress)
-        elif args.component == "monitor":
-            install_monitor(config["arpi_access"], config["deployment"], args.update, args.restart, args.progress)
-        elif args.component == "webapplication":
-            install_webapplication(config["arpi_access"], config["deployment"], args.restart)
-        elif args.component == "database":
-            install_database(config["arpi_access"], config["database"], args.update, args.progress)
-        else:
-            logger.error("Unknown component: %s", args.component)
+            if not args.yes:
+                input("Waiting before starting the installation to verify the configuration!")
+
+        components = [component for component in COMPONENTS if component in args.components]
+        targets = get_targets(config)
+        if len(targets) > 1 or args.parallel:
+            # progress bars of the parallel uploads would overwrite each other
+            args.progress = False
+            for handler in logging.getLogger().handlers:
+                handler.setFormatter(logging.Formatter("%(threadName)s: %(message)s"))
+
+        if len(targets) > 1:
+            logger.info("Installing to %s hosts with %s workers", len(targets), args.workers)
+
+            results = install_fleet(components, targets, config, args)
+            print_summary(results)
+            return 2 if any(error for _, error, _ in results) else 0
+
+        install_components(components, targets[0], config, args)
 
         logger.info("Finished successfully!")
         return 0
@@ -467,6 +1145,10 @@ def main(argv=None):  # IGNORE:C0111
     except Exception:
         logger.exception("Failed to execute!")
         return 2
+    finally:
+        close_connections()
+        if args is not None and args.trace:
+            export_trace(args.trace)
 
 
 if __name__ == "__main__":
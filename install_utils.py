@@ -5,21 +5,68 @@ Created on 2017. aug. 27.
 """
 
 
+import compileall
 import contextlib
 import glob
+import gzip
+import hashlib
+import json
 import logging
 import os.path
+import py_compile
+import select
+import shlex
+import shutil
+import tarfile
+import threading
+import weakref
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from time import monotonic
 from os import listdir
-from os.path import isfile, join
+from os.path import basename, isfile, join
 from textwrap import indent
 
 import paramiko
 from scp import SCPClient
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from trace_utils import span
+
 
 # get main logger
 logger = logging.getLogger(__name__)
 
+# name of the file storing the uploaded files of a target directory on the remote host
+MANIFEST_FILENAME = ".arpi_manifest.json"
+
+
+# step of an installation with the names of the steps it depends on
+Step = namedtuple("Step", ["name", "function", "dependencies"])
+
+
+# reading the output of the remote commands
+OUTPUT_CHUNK_SIZE = 32 * 1024
+OUTPUT_POLL_INTERVAL = 1
+MAX_LINE_LENGTH = 4096
+
+
+class TransferError(Exception):
+    """
+    Thrown when the files can't be uploaded to the remote host.
+    """
+
+
+class RemoteCommandError(Exception):
+    """
+    Thrown when the command executed on the remote host fails.
+    """
+
 
 def collect_files(local_path, file_filter=None):
     if file_filter is None:
@@ -33,69 +80,614 @@ def collect_files(local_path, file_filter=None):
 
 
 def print_ssh_output(output, errors, command=""):
+    """
+    Log the output of the command executed with exec_command and return its exit status
+    """
     if command:
         logger.debug("Executed: '%s'", command)
 
-    print_lines(output)
-    print_lines(errors)
+    # both files belong to the channel of the command
+    return pump_output(output.channel)
 
 
-def print_lines(lines, indent="\t"):
-    for line in iter(lambda: lines.readline(2048), ""):
-        with contextlib.suppress(UnicodeDecodeError):
-            if line.strip() != "None":
-                logger.info("%s%s", indent, line.strip())
-
+def pump_output(channel, indent="\t", on_line=None):
+    """
+    Log the stdout and the stderr of the channel line by line as they arrive and
+    return the exit status of the command
 
-uploaded_files = set()
+    The lines are logged with the time elapsed since starting to read the output and
+    passed to the on_line(stream, elapsed, line) callback. Reading both streams at the
+    same time the remote command can't block on a full stderr window.
+    """
+    start = monotonic()
+    buffers = {"stdout": bytearray(), "stderr": bytearray()}
+
+    def emit(stream, data):
+        line = data.decode("utf-8", errors="replace").rstrip()
+        elapsed = monotonic() - start
+        logger.info("%s[%8.2fs] %s", indent, elapsed, line)
+        if on_line is not None:
+            on_line(stream, elapsed, line)
+
+    def feed(stream, data):
+        buffer = buffers[stream]
+        buffer.extend(data)
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0 and len(buffer) >= MAX_LINE_LENGTH:
+                # split too long lines to keep the buffer bounded
+                end = MAX_LINE_LENGTH - 1
+            elif end < 0:
+                break
+            emit(stream, buffer[:end + 1])
+            del buffer[:end + 1]
+
+    while True:
+        select.select([channel], [], [], OUTPUT_POLL_INTERVAL)
+        received = False
+        if channel.recv_ready():
+            feed("stdout", channel.recv(OUTPUT_CHUNK_SIZE))
+            received = True
+        if channel.recv_stderr_ready():
+            feed("stderr", channel.recv_stderr(OUTPUT_CHUNK_SIZE))
+            received = True
+        if not received and (channel.eof_received or channel.closed):
+            break
+
+    for stream, buffer in buffers.items():
+        if buffer:
+            emit(stream, buffer)
+
+    return channel.recv_exit_status()
+
+
+# the files uploaded by the current thread for the debug log
+_uploads = threading.local()
+
+
+def get_uploaded_files():
+    if not hasattr(_uploads, "files"):
+        _uploads.files = set()
+    return _uploads.files
 
 
 def show_progress(filename, size, sent):
-    uploaded_files.add(filename.decode("utf-8"))
-    print("%s: %s/%s => %2d%%" % (filename.decode("utf-8"), sent, size, 100 * sent / size), end="\r")
+    get_uploaded_files().add(filename.decode("utf-8"))
+    print("%s: %s/%s => %2d%%" % (filename.decode("utf-8"), sent, size, 100 * sent / size if size else 100), end="\r")
+
+
+def list_copy(ssh, files, progress, method="scp"):
+    size = sum(os.path.getsize(source) for source, _ in files)
+    with span("list_copy", files=len(files), bytes=size, method=method):
+        if method == "scp":
+            scp = SCPClient(ssh.get_transport(), progress=show_progress if progress else None)
+
+            for source, target in files:
+                logger.info("  Copying %s to %s", source, join(target, source.split("/")[-1]))
+                scp.put(source, remote_path=target)
+        else:
+            # the relative remote paths are in the home directory like in case of SCP
+            home, directories = get_remote_directories(ssh, [home_relative(target) for _, target in files])
+            entries = []
+            for source, target in files:
+                target = home_relative(target)
+                if target in directories:
+                    target = join(target, basename(source))
+                logger.info("  Copying %s to %s", source, target)
+                # the targets are relative to the root for all the files
+                entries.append((source, os.path.relpath(join(home, target), "/")))
+            transfer(ssh, "/", entries, progress, method)
+
+        # delete last progress line
+        print("\033[K", end="\r")
+        uploaded_files = get_uploaded_files()
+        if uploaded_files:
+            logger.debug("Files copied:\n%s\n", indent('\n'.join(sorted(uploaded_files)), "  "))
+        uploaded_files.clear()
+
+
+def deep_copy(ssh, source, target, filter, progress, delta=False, method="scp"):
+    """
+    Copy files from source to target recursively
 
+    In delta mode only the new and changed files are uploaded (compared to the manifest
+    of the previous upload in the target directory) and the removed files are deleted.
+    The manifest is written after every upload, so it always describes the uploaded files.
 
-def list_copy(ssh, files, progress):
-    scp = SCPClient(ssh.get_transport(), progress=show_progress if progress else None)
+    The method selects the transfer backend (see TRANSFER_METHODS).
+    """
+    with span("deep_copy", source=source, target=target, method=method, delta=delta) as trace:
+        files = sorted(collect_tree(source, filter))
+        manifest = build_manifest(source, files)
+        previous = None
+        if delta:
+            previous = read_remote_manifest(ssh, target)
+            files = [filename for filename in files if previous.get(filename) != manifest[filename]]
+            removed = sorted(set(previous) - set(manifest))
+            logger.info(
+                "  Delta of %s: %s new or changed, %s unchanged, %s removed",
+                target, len(files), len(manifest) - len(files), len(removed)
+            )
+            remove_remote_files(ssh, target, removed)
+            trace.update(unchanged=len(manifest) - len(files), removed=len(removed))
+
+        trace["files"] = len(files)
+        entries = []
+        for relative_filename in files:
+            logger.info("  Copying %s to %s", join(source, relative_filename), join(target, relative_filename))
+            entries.append((join(source, relative_filename), relative_filename))
+        transfer(ssh, target, entries, progress, method)
+
+        if not manifest and previous is None:
+            # nothing is uploaded (the target may not exist), the previous manifest is outdated
+            _, stdout, stderr = ssh.exec_command(f"rm -f {shlex.quote(join(target, MANIFEST_FILENAME))}")
+            print_ssh_output(stdout, stderr)
+        elif manifest != previous:
+            # store the manifest only after all the files are uploaded
+            write_remote_manifest(ssh, target, manifest)
+
+        # delete last progress line
+        print("\033[K", end="\r")
+        uploaded_files = get_uploaded_files()
+        if uploaded_files:
+            logger.debug("Files copied:\n%s\n", indent('\n'.join(sorted(uploaded_files)), "  "))
+        uploaded_files.clear()
+
+
+def transfer(ssh, directory, entries, progress, method="scp"):
+    """
+    Upload the files (local path, remote path relative to the directory) with the selected backend
+    """
+    size = sum(os.path.getsize(source) for source, _ in entries)
+    start = monotonic()
+    with span("transfer", directory=directory, method=method, files=len(entries), bytes=size):
+        TRANSFER_METHODS[method](ssh, directory, entries, progress)
+    duration = monotonic() - start
+    logger.info(
+        "  Uploaded %s files (%s bytes) to %s in %.2fs (%.1f kB/s) with %s",
+        len(entries), size, directory, duration, size / 1024 / duration if duration else 0, method
+    )
+
+
+class ProgressReader:
+    """
+    File object reporting the progress of reading like the SCP progress callback
+    """
 
-    for source, target in files:
-        logger.info("  Copying %s to %s", source, join(target, source.split("/")[-1]))
-        scp.put(source, remote_path=target)
+    def __init__(self, file, name, size):
+        self._file = file
+        self._name = name.encode("utf-8")
+        self._size = size
+        self._sent = 0
 
-    # delete last progress line
-    print("\033[K", end="\r")
-    if uploaded_files:
-        logger.debug("Files copied:\n%s\n", indent('\n'.join(sorted(uploaded_files)), "  "))
-    uploaded_files.clear()
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._sent += len(data)
+        show_progress(self._name, self._size, self._sent)
+        return data
 
 
-def deep_copy(ssh, source, target, filter, progress):
+class CountingWriter:
     """
-    Copy files from source to target recursively
+    File object counting the bytes written to the wrapped file
     """
-    _, stdout, stderr = ssh.exec_command(f"mkdir -p {target}")
+
+    def __init__(self, file):
+        self._file = file
+        self.count = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self.count += len(data)
+        return len(data)
+
+
+def scp_put(ssh, directory, entries, progress):
+    """
+    Upload the files one by one with SCP (creating the directories one by one)
+    """
+    _, stdout, stderr = ssh.exec_command(f"mkdir -p {directory}")
     print_ssh_output(stdout, stderr)
 
     scp = SCPClient(ssh.get_transport(), progress=show_progress if progress else None)
+    for source, target in entries:
+        directories = os.path.dirname(target)
+        if directories:
+            _, stdout, stderr = ssh.exec_command(f"mkdir -p {join(directory, directories)}")
+            print_ssh_output(stdout, stderr)
+        scp.put(source, remote_path=join(directory, target))
+
+
+def tar_put(ssh, directory, entries, progress):
+    """
+    Upload the files as a single compressed tar stream extracted on the remote host
+    """
+    if not entries:
+        return
+
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(f"mkdir -p {shlex.quote(directory)} && tar -xzf - -C {shlex.quote(directory)}")
+    stdin = channel.makefile("wb")
+    output = CountingWriter(stdin)
+    with tarfile.open(fileobj=output, mode="w|gz") as archive:
+        for source, target in entries:
+            info = archive.gettarinfo(source, arcname=target)
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            with open(source, "rb") as file:
+                archive.addfile(info, ProgressReader(file, target, info.size) if progress else file)
+            get_uploaded_files().add(target)
+
+    stdin.close()
+    channel.shutdown_write()
+    errors = channel.makefile_stderr("r").read().decode("utf-8", errors="replace")
+    exit_status = channel.recv_exit_status()
+    channel.close()
+    if exit_status != 0:
+        raise TransferError(f"Failed to extract files to '{directory}' ({exit_status}): {errors.strip()}")
+
+    logger.debug("  Sent %s files in %s compressed bytes", len(entries), output.count)
+
+
+# number of SFTP sessions uploading files at the same time on a connection, shared by the parallel uploads
+# (sshd accepts MaxSessions channels per connection, 10 by default, the commands need channels too)
+SFTP_SESSIONS = 4
+SFTP_CHUNK_SIZE = 32 * 1024
+# transport => semaphore of the SFTP sessions
+sftp_session_limits = weakref.WeakKeyDictionary()
+sftp_session_limits_lock = threading.Lock()
+
+# sets the permissions and the modification times of the uploaded files (JSON from stdin)
+SET_ATTRIBUTES_SCRIPT = (
+    "import json, os, sys\n"
+    "for path, mode, mtime in json.load(sys.stdin):\n"
+    "    os.chmod(path, mode)\n"
+    "    os.utime(path, (mtime, mtime))\n"
+)
+
+
+def sftp_put(ssh, directory, entries, progress):
+    """
+    Upload the files with pipelined SFTP writes on parallel sessions
+
+    The writes of a file don't wait for the acknowledgement of the previous write and
+    more files are uploaded at the same time. The directories are created in the first
+    session, the permissions and the modification times are set in one remote command.
+    """
+    if not entries:
+        return
+
+    with open_sftp_session(ssh) as sftp:
+        for path in get_parent_directories(directory, [target for _, target in entries]):
+            with contextlib.suppress(IOError):
+                sftp.mkdir(path)
+
+    def upload(session_entries):
+        with open_sftp_session(ssh) as session:
+            for source, target in session_entries:
+                size = os.path.getsize(source)
+                with open(source, "rb") as local_file, session.open(join(directory, target), "wb") as remote_file:
+                    remote_file.set_pipelined(True)
+                    reader = ProgressReader(local_file, target, size) if progress else local_file
+                    for chunk in iter(lambda: reader.read(SFTP_CHUNK_SIZE), b""):
+                        remote_file.write(chunk)
+
+    sessions = min(SFTP_SESSIONS, len(entries))
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        # wait for all the sessions and raise the first error
+        for future in [executor.submit(upload, entries[index::sessions]) for index in range(sessions)]:
+            future.result()
+
+    attributes = []
+    for source, target in entries:
+        stat = os.stat(source)
+        attributes.append((join(directory, target), stat.st_mode & 0o7777, stat.st_mtime))
+        get_uploaded_files().add(target)
+
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(f"python3 -c {shlex.quote(SET_ATTRIBUTES_SCRIPT)}")
+    channel.sendall(json.dumps(attributes).encode("utf-8"))
+    channel.shutdown_write()
+    errors = channel.makefile_stderr("r").read().decode("utf-8", errors="replace")
+    exit_status = channel.recv_exit_status()
+    channel.close()
+    if exit_status != 0:
+        raise TransferError(f"Failed to set the file attributes in '{directory}' ({exit_status}): {errors.strip()}")
+
+
+@contextlib.contextmanager
+def open_sftp_session(ssh):
+    """
+    Opens an SFTP session, waits while SFTP_SESSIONS sessions are open on the connection
+    """
+    transport = ssh.get_transport()
+    with sftp_session_limits_lock:
+        limit = sftp_session_limits.setdefault(transport, threading.BoundedSemaphore(SFTP_SESSIONS))
+
+    with limit:
+        sftp = ssh.open_sftp()
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+
+
+def get_parent_directories(directory, paths):
+    """
+    Returns the directory and all the parent directories of the paths (relative to the directory)
+    in the order of creating them
+    """
+    directories = set()
+    for path in [directory] + [join(directory, os.path.dirname(path)) for path in paths]:
+        path = os.path.normpath(path)
+        while path not in directories and path not in ("", ".", "/"):
+            directories.add(path)
+            path = os.path.dirname(path)
+
+    return sorted(directories, key=lambda path: (path.count("/"), path))
 
-    for full_filename in glob.iglob(join(source, filter), recursive=True):
-        if os.path.isfile(full_filename):
-            filename = full_filename.split("/")[-1]
-            directories = full_filename.split(f"{source}/")[1].rsplit(filename)[0]
-            logger.info("  Copying %s to %s", full_filename, join(target, directories, filename))
-            # print("Directories: ", directories)
-            # print("Source: ", source)
-            # print("Target: ", target)
-            if directories:
-                _, stdout, stderr = ssh.exec_command(f"mkdir -p {join(target, directories)}")
-                print_ssh_output(stdout, stderr)
-            scp.put(full_filename, remote_path=join(target, directories, filename))
-
-    # delete last progress line
-    print("\033[K", end="\r")
-    if uploaded_files:
-        logger.debug("Files copied:\n%s\n", indent('\n'.join(sorted(uploaded_files)), "  "))
-    uploaded_files.clear()
+
+# methods of uploading the files:
+#  - scp: one SCP transfer (and one mkdir) per file
+#  - tar: one compressed tar stream for all the files
+#  - sftp: pipelined SFTP writes on parallel sessions
+TRANSFER_METHODS = {
+    "scp": scp_put,
+    "tar": tar_put,
+    "sftp": sftp_put,
+}
+
+
+def home_relative(path):
+    """
+    Returns the remote path without the home directory prefix (~)
+    """
+    if path == "~":
+        return "."
+    if path.startswith("~/"):
+        return path[2:]
+    return path
+
+
+def get_remote_directories(ssh, paths):
+    """
+    Returns the home directory and the paths which are existing directories on the remote host
+    (in one round trip)
+    """
+    quoted = " ".join(shlex.quote(path) for path in paths)
+    _, stdout, _ = ssh.exec_command(f'echo "$HOME"; for path in {quoted}; do [ -d "$path" ] && echo "$path"; done')
+    home, *directories = stdout.read().decode("utf-8").splitlines()
+    return home, set(directories)
+
+
+def collect_tree(source, filter):
+    """
+    Returns the path of the files matching the filter (glob or list of globs) relative to the source directory
+    """
+    for pattern in [filter] if isinstance(filter, str) else filter:
+        for full_filename in glob.iglob(join(source, pattern), recursive=True):
+            if os.path.isfile(full_filename):
+                yield os.path.relpath(full_filename, source)
+
+
+def file_hash(filename, chunk_size=64 * 1024):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def build_manifest(source, files):
+    """
+    Returns the size and the hash of the files (relative to the source directory)
+    """
+    return {
+        filename: {
+            "size": os.path.getsize(join(source, filename)),
+            "sha256": file_hash(join(source, filename))
+        }
+        for filename in files
+    }
+
+
+def read_remote_manifest(ssh, target):
+    """
+    Returns the manifest of the previous upload to the target directory or an empty one
+    """
+    _, stdout, _ = ssh.exec_command(f"cat {shlex.quote(join(target, MANIFEST_FILENAME))} 2>/dev/null")
+    content = stdout.read()
+    try:
+        return json.loads(content).get("files", {})
+    except (ValueError, AttributeError):
+        if content:
+            logger.warning("Invalid manifest in %s, uploading all the files", target)
+        return {}
+
+
+def write_remote_manifest(ssh, target, manifest):
+    content = json.dumps({"files": manifest}, indent=2, sort_keys=True).encode("utf-8")
+    scp = SCPClient(ssh.get_transport())
+    scp.putfo(BytesIO(content), join(target, MANIFEST_FILENAME))
+
+
+def remove_remote_files(ssh, target, files):
+    if not files:
+        return
+
+    for filename in files:
+        logger.info("  Removing %s", join(target, filename))
+
+    paths = " ".join(shlex.quote(filename) for filename in files)
+    _, stdout, stderr = ssh.exec_command(f"cd {shlex.quote(target)} && rm -f -- {paths}")
+    print_ssh_output(stdout, stderr)
+
+
+# text based assets worth compressing (the images and fonts like woff are compressed already)
+COMPRESSIBLE_EXTENSIONS = (
+    ".css", ".eot", ".html", ".ico", ".js", ".json", ".map", ".mjs", ".otf", ".svg", ".ttf", ".txt",
+    ".webmanifest", ".xml",
+)
+# smaller files aren't compressed by nginx either (gzip_min_length)
+PRECOMPRESS_MIN_SIZE = 1024
+PRECOMPRESS_FORMATS = {
+    "gzip": (".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0)),
+    "brotli": (".br", lambda data: brotli.compress(data, quality=11)),
+}
+
+
+def precompress_assets(directory, formats=("gzip",), workers=None):
+    """
+    Create the compressed siblings (.gz, .br) of the assets for the gzip_static of nginx.
+
+    The siblings up to date (same modification time) are kept, the ones not smaller than the asset are skipped
+    and the ones of removed assets are deleted.
+    Returns the number of compressed files created.
+    """
+    if "brotli" in formats and brotli is None:
+        logger.warning("Brotli compression isn't available (pip install brotli)")
+        formats = [name for name in formats if name != "brotli"]
+
+    assets = [
+        filename for filename in glob.glob(join(directory, "**", "*"), recursive=True)
+        if filename.endswith(COMPRESSIBLE_EXTENSIONS) and isfile(filename) and os.path.getsize(filename) >= PRECOMPRESS_MIN_SIZE
+    ]
+    remove_stale_compressed(directory)
+    start = monotonic()
+    with span("precompress", assets=len(assets), formats=list(formats)) as args:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            args["created"] = sum(executor.map(lambda filename: precompress_asset(filename, formats), assets))
+
+    logger.info("Compressed %s files of %s assets in %.2fs", args["created"], len(assets), monotonic() - start)
+    return args["created"]
+
+
+def remove_stale_compressed(directory):
+    """
+    Removes the compressed siblings (of all the formats) whose asset doesn't exist anymore.
+    """
+    for extension, _ in PRECOMPRESS_FORMATS.values():
+        for filename in glob.glob(join(directory, "**", f"*{extension}"), recursive=True):
+            asset = filename[:-len(extension)]
+            if asset.endswith(COMPRESSIBLE_EXTENSIONS) and not isfile(asset):
+                logger.debug("Removing stale %s", filename)
+                os.remove(filename)
+
+
+def precompress_asset(filename, formats):
+    asset_stat = os.stat(filename)
+    data = None
+    created = 0
+    for name in formats:
+        extension, compress = PRECOMPRESS_FORMATS[name]
+        compressed_filename = filename + extension
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(compressed_filename).st_mtime_ns == asset_stat.st_mtime_ns:
+                continue
+
+        if data is None:
+            with open(filename, "rb") as asset:
+                data = asset.read()
+
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(compressed_filename)
+            continue
+
+        with open(compressed_filename, "wb") as compressed_file:
+            compressed_file.write(compressed)
+        os.utime(compressed_filename, ns=(asset_stat.st_atime_ns, asset_stat.st_mtime_ns))
+        created += 1
+
+    return created
+
+
+def get_remote_python(ssh):
+    """
+    Returns the home directory and the tag of the bytecode files of the python on the remote host
+    (like cpython-311)
+    """
+    _, stdout, _ = ssh.exec_command("echo \"$HOME\"; python3 -c 'import sys; print(sys.implementation.cache_tag)'")
+    home, cache_tag = stdout.read().decode().splitlines()
+    return home, cache_tag
+
+
+def compile_bytecode(source, ddir):
+    """
+    Compile the python files of the directory with the local python.
+
+    The .pyc files validated by the hash of the source (checked-hash) stay valid after
+    the upload, where the modification time of the source changes. The paths of the
+    tracebacks are in the ddir directory (the remote path of the source).
+    """
+    with span("compile", source=source):
+        if not compileall.compile_dir(
+            source, ddir=ddir, quiet=1, invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH
+        ):
+            logger.warning("Failed to compile some files of %s", source)
+
+
+# compiling the sources at the first import vs. loading the checked-hash bytecode
+MEASURE_BYTECODE_SCRIPT = (
+    "import glob, importlib.util, marshal, sys, time\n"
+    "sources = sorted(glob.glob(sys.argv[1] + '/**/*.py', recursive=True))\n"
+    "start = time.perf_counter()\n"
+    "for source in sources:\n"
+    "    with open(source, 'rb') as file:\n"
+    "        compile(file.read(), source, 'exec')\n"
+    "compile_time = time.perf_counter() - start\n"
+    "start = time.perf_counter()\n"
+    "loaded = 0\n"
+    "for source in sources:\n"
+    "    try:\n"
+    "        with open(importlib.util.cache_from_source(source), 'rb') as file:\n"
+    "            data = file.read()\n"
+    "    except OSError:\n"
+    "        continue\n"
+    "    with open(source, 'rb') as file:\n"
+    "        valid = importlib.util.source_hash(file.read()) == data[8:16]\n"
+    "    marshal.loads(data[16:])\n"
+    "    loaded += valid\n"
+    "print(len(sources), loaded, compile_time, time.perf_counter() - start)\n"
+)
+
+
+def measure_bytecode(ssh, directory):
+    """
+    Measure the time of compiling the python files on the remote host and loading their bytecode instead.
+    """
+    _, stdout, _ = ssh.exec_command(f"python3 -c {shlex.quote(MEASURE_BYTECODE_SCRIPT)} {shlex.quote(directory)}")
+    try:
+        sources, loaded, compile_time, load_time = stdout.read().decode().split()
+    except ValueError:
+        logger.warning("Failed to measure the bytecode in %s", directory)
+        return
+
+    logger.info(
+        "  Cold start of %s: compiling %s files takes %.2fs, loading %s valid bytecode files %.2fs",
+        directory, sources, float(compile_time), loaded, float(load_time)
+    )
+
+
+def download_directory(ssh, remote_path, local_path):
+    """
+    Download the remote directory to the local path, the local path appears when the download is complete.
+    """
+    temp_path = f"{local_path}.{threading.get_ident()}.download"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    try:
+        with span("download", source=remote_path, target=local_path):
+            with SCPClient(ssh.get_transport()) as scp:
+                scp.get(remote_path, temp_path, recursive=True)
+
+        # other hosts of the fleet may download the same directory
+        if not os.path.exists(local_path):
+            os.rename(join(temp_path, basename(remote_path)), local_path)
+            logger.info("Downloaded %s files to %s", len(listdir(local_path)), local_path)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
 
 
 def generate_SSH_key(key_name, passphrase):
@@ -108,11 +700,75 @@ def generate_SSH_key(key_name, passphrase):
     public_key.close()
 
 
-def execute_remote(ssh, command, password=None, message=None):
-    if message:
-        logger.info(message)
-    stdin, stdout, stderr = ssh.exec_command(command, get_pty=True)
-    logger.debug("Using password %s", password)
-    stdin.write(f"{password}\n")
-    stdin.flush()
-    print_ssh_output(stdout, stderr, command)
+def execute_remote(ssh, command, password=None, message=None, check=False):
+    """
+    Execute the command on the remote host and return its exit status
+
+    The password is sent to the standard input (for sudo). Failing commands raise
+    RemoteCommandError if check is set.
+    """
+    with span("execute_remote", command=message or command) as trace:
+        if message:
+            logger.info(message)
+        stdin, stdout, stderr = ssh.exec_command(command, get_pty=True)
+        if password is not None:
+            logger.debug("Using password %s", password)
+            # the command may finish before reading it
+            with contextlib.suppress(OSError):
+                stdin.write(f"{password}\n")
+                stdin.flush()
+
+        exit_status = print_ssh_output(stdout, stderr, command)
+        trace["exit_status"] = exit_status
+        if exit_status != 0:
+            logger.warning("Command failed with exit status %s: '%s'", exit_status, message or command)
+            if check:
+                raise RemoteCommandError(f"Failed to execute '{message or command}' (exit status {exit_status})")
+
+        return exit_status
+
+
+def run_steps(steps, workers):
+    """
+    Run the steps in parallel as soon as their dependencies are finished
+
+    Stops starting new steps after the first failure and raises its error.
+    """
+    names = {step.name for step in steps}
+    pending = list(steps)
+    finished = set()
+    running = {}
+    error = None
+    prefix = threading.current_thread().name
+
+    def run(step):
+        # the name of the thread identifies the step in the log
+        threading.current_thread().name = step.name if prefix == "MainThread" else f"{prefix}/{step.name}"
+        logger.info("Starting step '%s'", step.name)
+        with span(f"step {step.name}"):
+            step.function()
+        logger.info("Finished step '%s'", step.name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if error is None:
+                for step in [s for s in pending if all(d in finished or d not in names for d in s.dependencies)]:
+                    pending.remove(step)
+                    running[executor.submit(run, step)] = step
+            elif not running:
+                break
+
+            if not running:
+                raise ValueError(f"Circular dependencies between the steps: {[step.name for step in pending]}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    logger.error("Failed step '%s': %s", step.name, future.exception())
+                    error = error or future.exception()
+                else:
+                    finished.add(step.name)
+
+    if error is not None:
+        raise error
@@ -2,21 +2,29 @@
 
 import os
 import contextlib
+import functools
+import glob
+import grp
+import hashlib
+import json
 import logging
+import pwd
 import shutil
+import stat
+import sys
 import tarfile
+import urllib.error
 import urllib.request
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
-from difflib import ndiff, unified_diff
-from filecmp import dircmp
+from difflib import unified_diff
 from logging import basicConfig
-from packaging.version import Version, parse
-from pathlib import Path
-from time import sleep
+from packaging.version import InvalidVersion, Version, parse
+from time import sleep, time
 
-from git import Repo
+from git import Git
 
 
 description = """
@@ -30,88 +38,176 @@ COMPONENTS = {
     "webapplication": "webapplication"
 }
 SEPARATOR = "\n################################################################################"
-INDENT_SIZE = 2
 
 
-SERVER_GITURL = "https://github.com/ArPIHomeSecurity/arpi_server"
-WEBAPP_GITURL = "https://github.com/ArPIHomeSecurity/arpi_webapplication"
+SERVER_GITURL = os.getenv("ARPI_SERVER_GITURL", "https://github.com/ArPIHomeSecurity/arpi_server")
+WEBAPP_GITURL = os.getenv("ARPI_WEBAPP_GITURL", "https://github.com/ArPIHomeSecurity/arpi_webapplication")
 TEMP_DIR = "/tmp"
 ARGUS_HOME = os.getenv("ARGUS_ROOT", "/home/argus")
+CACHE_DIR = os.getenv("ARPI_CACHE_DIR", os.path.join(ARGUS_HOME, ".cache", "arpi"))
+TAGS_CACHE_FILE = "tags.json"
+TAGS_CACHE_TTL = 3600
+ARTIFACTS_DIR = "artifacts"
+ARTIFACTS_INDEX_FILE = "index.json"
+ARTIFACTS_CACHE_SIZE = int(os.getenv("ARPI_CACHE_SIZE", 256 * 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 FIRST_RELEASE_VERSION = Version("v0.9.0-RC1")
 RESTORE_FILES = [
     ".env",
     "migrations"
 ]
+RELEASES_DIR = os.path.join(ARGUS_HOME, "releases")
+SHARED_DIR = os.path.join(ARGUS_HOME, "shared")
+PREVIOUS_RELEASE = "previous"
+RELEASES_KEEP = 3
+SNAPSHOT_TIME_FORMAT = "%Y%m%d_%H%M%S"
+# published next to the release artifacts (see release_utils)
+MANIFEST_SUFFIX = ".manifest.json"
+DELTA_FILE = ".arpi_delta.json"
+DIFF_IGNORED_FILES = ["Pipfile.lock", "index.html"]
+DIFF_WORKERS = min(4, os.cpu_count() or 1)
+# the files are diffed in memory, the diff is limited in the output
+MAX_DIFF_FILE_SIZE = 512 * 1024
+MAX_DIFF_LINES = 200
+
+
+class ChecksumError(Exception):
+    """
+    The downloaded file doesn't match the published checksum.
+    """
+
+
+class UnsafeArchiveError(tarfile.TarError):
+    """
+    The archive contains a member outside of the target directory.
+    """
 
 
 def list_files(start_path="."):
-    # logging.debug("Files in %s", start_path)
-    result = ""
-    walk_result = sorted(list(os.walk(start_path)), key=lambda x: x[0])
-    for root, dirs, files in walk_result:
-        level = root.replace(start_path, '').count(os.sep)
-        indent = ' ' * INDENT_SIZE * (level)
-        # logging.debug("%s%s/", indent, os.path.basename(root))
-        result += f"{indent}{os.path.basename(root)}/\n"
-        sub_indent = ' ' * INDENT_SIZE * (level + 1)
-        for f in sorted(files):
-            file = os.path.join(root, f)
-            info = Path(file)
-            file_info = f"{sub_indent}{f:32} = {os.path.getsize(file):10} {info.group():>10}:{info.owner():<10}"
-            # logging.debug(file_info)
-            result += file_info + "\n"
-
-    return result
-
-
-def list_versions():
-    logging.info("Component 'server'")
-    list_versions_of(SERVER_GITURL, os.path.join(TEMP_DIR, "arpi_server"))
-    logging.info("Component 'webapplication'")
-    list_versions_of(WEBAPP_GITURL, os.path.join(TEMP_DIR, "arpi_webapp"))
-
-
-def list_versions_of(repo_url, local_path):
-    logging.info("Versions in %s", repo_url)
-    if os.path.exists(local_path):
-        shutil.rmtree(local_path)
-    repo = Repo.clone_from(repo_url, local_path)
-    get_version(repo)
-    shutil.rmtree(local_path)
-    logging.info("")
-
-
-def get_version(repository):
-    tags = repository.git.ls_remote("--tags", "origin")
+    """
+    Returns the manifest of the directory: relative path => (size, modification time, owner, group).
+    """
+    manifest = {}
+    directories = [start_path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # bytecode compiled on the device is not part of the release
+                    if entry.name != "__pycache__":
+                        directories.append(entry.path)
+                    continue
+
+                info = entry.stat(follow_symlinks=False)
+                manifest[os.path.relpath(entry.path, start_path)] = (
+                    info.st_size, info.st_mtime_ns, get_user_name(info.st_uid), get_group_name(info.st_gid)
+                )
+
+    return manifest
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_name(uid):
+    with contextlib.suppress(KeyError):
+        return pwd.getpwuid(uid).pw_name
+
+    return str(uid)
+
+
+@functools.lru_cache(maxsize=None)
+def get_group_name(gid):
+    with contextlib.suppress(KeyError):
+        return grp.getgrgid(gid).gr_name
+
+    return str(gid)
+
+
+def list_versions(cache_dir=CACHE_DIR, ttl=TAGS_CACHE_TTL):
+    repositories = {"server": SERVER_GITURL, "webapplication": WEBAPP_GITURL}
+    tags = get_tags(list(repositories.values()), cache_dir, ttl)
+    for component, repo_url in repositories.items():
+        logging.info("Component '%s'", component)
+        logging.info("Versions in %s", repo_url)
+        for version in get_versions(tags[repo_url]):
+            logging.info("  - %s", version)
+        logging.info("")
+
+
+def get_tags(repo_urls, cache_dir=CACHE_DIR, ttl=TAGS_CACHE_TTL):
+    """
+    Returns the tags of the repositories (without cloning them) from the cache or querying
+    the expired ones at the same time.
+    """
+    cache_file = os.path.join(cache_dir, TAGS_CACHE_FILE)
+    cache = {}
+    with contextlib.suppress(OSError, ValueError):
+        with open(cache_file, "r", encoding="utf-8") as tags_file:
+            cache = json.load(tags_file)
+
+    expired = [repo_url for repo_url in repo_urls if time() - cache.get(repo_url, {}).get("time", 0) > ttl]
+    if expired:
+        with ThreadPoolExecutor(max_workers=len(expired)) as executor:
+            for repo_url, tags in zip(expired, executor.map(get_remote_tags, expired)):
+                cache[repo_url] = {"time": time(), "tags": tags}
+
+        with contextlib.suppress(OSError):
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, "w", encoding="utf-8") as tags_file:
+                json.dump(cache, tags_file, indent=2)
+
+    for repo_url in repo_urls:
+        if repo_url not in expired:
+            logging.debug("Tags of %s from cache %s", repo_url, cache_file)
+
+    return {repo_url: cache[repo_url]["tags"] for repo_url in repo_urls}
+
+
+def get_remote_tags(repo_url):
+    """
+    Returns the tags of the remote repository (URL or path of a local repository).
+    """
+    tags = Git().ls_remote("--tags", repo_url)
     logging.debug("Tags: %s", tags)
-    for line in tags.splitlines():
-        logging.debug("Line: %s", line)
-        if not line.endswith("^{}"):
-            version = line.split("/")[-1]
-            if parse(version) >= FIRST_RELEASE_VERSION:
-                logging.info("  - %s", version)
+    return [line.split("refs/tags/")[-1] for line in tags.splitlines() if not line.endswith("^{}")]
 
 
-def update(component, version):
+def get_versions(tags):
+    """
+    Returns the released versions from the tags in ascending order.
+    """
+    versions = []
+    for tag in tags:
+        with contextlib.suppress(InvalidVersion):
+            if parse(tag) >= FIRST_RELEASE_VERSION:
+                versions.append(tag)
+
+    return sorted(versions, key=parse)
+
+
+def update(
+    component, version, cache_dir=CACHE_DIR, cache_size=ARTIFACTS_CACHE_SIZE, stream=False, releases=False,
+    keep=RELEASES_KEEP, keep_backups=None, max_age=None, delta=False
+):
     logging.info("Changing '%s' to version '%s'", component, version)
 
-    if component == COMPONENTS["server"]:
-        update_server(version)
+    if releases and component in COMPONENTS:
+        return update_release(component, version, cache_dir, cache_size, stream, keep, delta)
+    elif component == COMPONENTS["server"]:
+        return update_server(version, cache_dir, cache_size, stream, keep_backups, max_age)
     elif component == COMPONENTS["webapplication"]:
-        update_webapplication(version)
+        return update_webapplication(version, cache_dir, cache_size, stream, keep_backups, max_age)
     else:
         logging.error("Unknown component!")
 
 
-def update_server(version):
+def update_server(version, cache_dir=CACHE_DIR, cache_size=ARTIFACTS_CACHE_SIZE, stream=False, keep_backups=None, max_age=None):
     working_directory = os.path.join(ARGUS_HOME, "server")
     logging.info("Working directory: %s", working_directory)
 
-    download(SERVER_GITURL, version, "arpi-server.tar.gz")
-    extract_files("arpi-server")
+    release_path = fetch_release(SERVER_GITURL, version, "arpi-server", working_directory, stream, cache_dir, cache_size)
 
     before = list_files(working_directory)
-    backup_path = backup_folder(working_directory)
+    backup_path = backup_folder(working_directory, keep_backups, max_age)
 
     # remove old files
     # cleanup_folder(working_directory)
@@ -120,104 +216,512 @@ def update_server(version):
     except PermissionError as error:
         logging.info("Failed to delete '%s'! %s", working_directory, error)
 
-
     # copy the new version
-    shutil.copytree(os.path.join(TEMP_DIR, "arpi-server"), working_directory)
+    place_release(release_path, working_directory, stream)
 
     # restore configuration
     restore_files(backup_path, working_directory, RESTORE_FILES)
 
     # list files after replace
     after = list_files(working_directory)
-    show_changes(before, after)
-
-    # directory comparison of new and backup
-    comparison = dircmp(working_directory, backup_path)
-    logging.info(SEPARATOR)
-    logging.info("\n\nDiff report:")
-    comparison.report_full_closure()
+    changes = show_changes(before, after, backup_path, working_directory)
 
+    # content comparison of new and backup
     logging.info(SEPARATOR)
     logging.info("File differences:")
-    print_diff_files(comparison)
+    print_diff_files(working_directory, backup_path, changes["modified"])
+    return changes
 
 
-def update_webapplication(version):
+def update_webapplication(version, cache_dir=CACHE_DIR, cache_size=ARTIFACTS_CACHE_SIZE, stream=False, keep_backups=None, max_age=None):
     working_directory = os.path.join(ARGUS_HOME, "webapplication")
     logging.info("Working directory: %s", working_directory)
 
-    download(WEBAPP_GITURL, version, "arpi-webapplication.tar.gz")
-    extract_files("arpi-webapplication")
+    release_path = fetch_release(
+        WEBAPP_GITURL, version, "arpi-webapplication", working_directory, stream, cache_dir, cache_size
+    )
 
     before = list_files(working_directory)
 
-    backup_path = backup_folder(working_directory)
+    backup_path = backup_folder(working_directory, keep_backups, max_age)
 
     # remove old files
     # cleanup_folder(ARGUS_ROOT)
     shutil.rmtree(working_directory)
 
     # copy the new version
-    shutil.copytree(os.path.join(TEMP_DIR, "arpi-webapplication"), working_directory)
+    place_release(release_path, working_directory, stream)
 
     # restore configuration
     restore_files(backup_path, working_directory, RESTORE_FILES)
 
     # list files after replace
     after = list_files(working_directory)
-    show_changes(before, after)
-
-    # directory comparison of new and backup
-    # comparison = dircmp(working_directory, backup_path)
-    # logging.info(SEPARATOR)
-    # logging.info("\n\nDiff report:")
-    # comparison.report_full_closure()
+    changes = show_changes(before, after, backup_path, working_directory)
 
+    # content comparison of new and backup
     # logging.info(SEPARATOR)
     # logging.info("File differences:")
-    # print_diff_files(comparison)
+    # print_diff_files(working_directory, backup_path, changes["modified"])
+    return changes
 
 
-def extract_files(filename):
-    archive = tarfile.open(os.path.join(TEMP_DIR, f"{filename}.tar.gz"))
-    archive.extractall(os.path.join(TEMP_DIR, filename))
+def update_release(
+    component, version, cache_dir=CACHE_DIR, cache_size=ARTIFACTS_CACHE_SIZE, stream=False, keep=RELEASES_KEEP, delta=False
+):
+    """
+    Switch the component to the release directory of the version.
 
+    The releases are kept side by side in the releases directory and the working directory
+    is a symlink to the active one, the configuration is linked from the shared directory.
+    """
+    working_directory = os.path.join(ARGUS_HOME, component)
+    release_path = os.path.join(RELEASES_DIR, component, version)
+    logging.info("Working directory: %s", working_directory)
+    adopt_working_directory(component)
 
-def show_changes(before, after):
-    # compare lists - show diff
-    logging.info(SEPARATOR)
-    logging.debug("Before: \n%s", before)
-    logging.debug("After: \n%s", after)
-    if before != after:
-        diff = ndiff(before.splitlines(), after.splitlines())
-        logging.info("Changes found: \n%s", "\n".join(list(diff)))
+    if os.path.isdir(release_path):
+        logging.info("Release already available: %s", release_path)
     else:
+        repo_url = SERVER_GITURL if component == COMPONENTS["server"] else WEBAPP_GITURL
+        current_version = get_release_version(component)
+        if delta and current_version and fetch_delta_release(
+            repo_url, current_version, version, f"arpi-{component}", os.path.realpath(working_directory),
+            f"{release_path}_staging", cache_dir, cache_size
+        ):
+            os.rename(f"{release_path}_staging", release_path)
+        else:
+            extracted_path = fetch_release(repo_url, version, f"arpi-{component}", release_path, stream, cache_dir, cache_size)
+            place_release(extracted_path, release_path, stream)
+        link_shared_files(component, release_path)
+
+    before = list_files(working_directory) if os.path.exists(working_directory) else {}
+    # the previous release stays in place after the switch
+    previous_path = os.path.realpath(working_directory)
+    switch_release(working_directory, release_path)
+    after = list_files(working_directory)
+    changes = show_changes(before, after, previous_path, working_directory)
+
+    prune_releases(component, keep)
+    return changes
+
+
+def get_release_version(component):
+    """
+    Returns the version of the active release or None if it's not known.
+    """
+    working_directory = os.path.join(ARGUS_HOME, component)
+    release_path = os.path.realpath(working_directory)
+    if not os.path.islink(working_directory) or os.path.dirname(release_path) != os.path.join(RELEASES_DIR, component):
+        return None
+
+    version = os.path.basename(release_path)
+    return None if version.startswith("initial_") else version
+
+
+def fetch_delta_release(repo_url, current_version, version, filename, current_path, target_path, cache_dir, cache_size):
+    """
+    Creates the release of the version in the target directory from the current release and the delta between them.
+
+    The delta is extracted on top of the copy of the current release and the result
+    is verified against the manifest of the version. Returns False if the delta isn't available or failed.
+    """
+    try:
+        manifest_url = f"{repo_url}/releases/download/{version}/{filename}.tar.gz{MANIFEST_SUFFIX}"
+        with urllib.request.urlopen(manifest_url) as response:
+            manifest = json.load(response)
+        delta_path = download(
+            repo_url, version, f"{filename}.from-{current_version}.delta.tar.gz", cache_dir, cache_size
+        )
+
+        if os.path.exists(target_path):
+            shutil.rmtree(target_path)
+        # copy instead of hard linking: install.py writes the files of the active release in place,
+        # the previous release (the rollback target) must not change with them
+        shutil.copytree(current_path, target_path, symlinks=True)
+
+        changed = 0
+        with tarfile.open(delta_path) as archive:
+            delta = json.load(archive.extractfile(DELTA_FILE))
+            for member in archive:
+                path = os.path.join(target_path, member.name)
+                if member.name == DELTA_FILE:
+                    continue
+                changed += 1
+                # replace the file instead of writing through a symlink of the copy
+                if not member.isdir() and os.path.lexists(path):
+                    os.remove(path)
+                extract_archive(archive, target_path, [member])
+
+        for name in delta["removed"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(target_path, name))
+
+        verify_release(target_path, manifest["files"])
+        logging.info(
+            "Applied delta from %s to %s: %s files changed, %s files removed",
+            current_version, version, changed, len(delta["removed"])
+        )
+        return True
+    except (OSError, KeyError, ValueError, tarfile.TarError, ChecksumError) as error:
+        logging.warning("Delta update failed, downloading the full release: %s", error)
+        if os.path.exists(target_path):
+            shutil.rmtree(target_path)
+        return False
+
+
+def verify_release(path, files):
+    """
+    Raise ChecksumError if the files of the release directory don't match the manifest.
+
+    The shared files linked into the release are ignored.
+    """
+    found = {
+        relative_path for relative_path in list_files(path)
+        if not os.path.realpath(os.path.join(path, relative_path)).startswith(SHARED_DIR + os.sep)
+    }
+    if found != files.keys():
+        raise ChecksumError(
+            f"Files missing: {sorted(files.keys() - found)}, unexpected files: {sorted(found - files.keys())}"
+        )
+
+    for relative_path, info in files.items():
+        full_path = os.path.join(path, relative_path)
+        if "link" in info:
+            valid = os.path.islink(full_path) and os.readlink(full_path) == info["link"]
+        else:
+            valid = file_hash(full_path) == info["sha256"]
+
+        if not valid:
+            raise ChecksumError(f"File {relative_path} doesn't match the manifest")
+
+
+def rollback(component, version=None):
+    """
+    Switch the component back to the previous (or the given) release.
+    """
+    working_directory = os.path.join(ARGUS_HOME, component)
+    releases_path = os.path.join(RELEASES_DIR, component)
+    if version is not None:
+        release_path = os.path.join(releases_path, version)
+    else:
+        release_path = os.path.realpath(os.path.join(releases_path, PREVIOUS_RELEASE))
+
+    if not os.path.islink(working_directory) or not os.path.isdir(release_path):
+        logging.error("No release to roll back to! Available releases: %s", ", ".join(get_releases(component)) or "-")
+        return False
+
+    logging.info("Rolling back '%s' to %s", component, release_path)
+    switch_release(working_directory, release_path)
+    return True
+
+
+def adopt_working_directory(component):
+    """
+    Move the working directory of the component into the releases directory.
+
+    The configuration (RESTORE_FILES) is moved to the shared directory.
+    """
+    working_directory = os.path.join(ARGUS_HOME, component)
+    if os.path.islink(working_directory) or not os.path.isdir(working_directory):
+        return
+
+    shared_path = os.path.join(SHARED_DIR, component)
+    os.makedirs(shared_path, exist_ok=True)
+    for name in RESTORE_FILES:
+        if os.path.exists(os.path.join(working_directory, name)) and not os.path.exists(os.path.join(shared_path, name)):
+            logging.info("Moving %s to %s", name, shared_path)
+            shutil.move(os.path.join(working_directory, name), os.path.join(shared_path, name))
+
+    release_path = os.path.join(RELEASES_DIR, component, f"initial_{dt.now().strftime('%Y%m%d_%H%M%S')}")
+    logging.info("Moving %s to %s", working_directory, release_path)
+    os.makedirs(os.path.dirname(release_path), exist_ok=True)
+    os.rename(working_directory, release_path)
+    link_shared_files(component, release_path)
+    switch_release(working_directory, release_path)
+
+
+def link_shared_files(component, release_path):
+    shared_path = os.path.join(SHARED_DIR, component)
+    for name in RESTORE_FILES:
+        if not os.path.exists(os.path.join(shared_path, name)):
+            continue
+
+        if os.path.lexists(os.path.join(release_path, name)):
+            logging.info("Keeping %s of the release", name)
+            continue
+
+        logging.info("Linking %s", os.path.join(shared_path, name))
+        os.symlink(os.path.join(shared_path, name), os.path.join(release_path, name))
+
+
+def switch_release(working_directory, release_path):
+    """
+    Point the working directory to the release by replacing the symlink in one step.
+    """
+    current_path = os.path.realpath(working_directory) if os.path.islink(working_directory) else None
+    replace_symlink(release_path, working_directory)
+    # the last used releases are kept by the pruning
+    os.utime(release_path)
+
+    if current_path is not None and current_path != release_path:
+        replace_symlink(current_path, os.path.join(os.path.dirname(release_path), PREVIOUS_RELEASE))
+
+    logging.info("Active release: %s", release_path)
+
+
+def replace_symlink(target, path):
+    temp_path = f"{path}.tmp"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(target, temp_path)
+    os.replace(temp_path, path)
+
+
+def get_releases(component):
+    """
+    Returns the release directories of the component, the most recently used first.
+    """
+    releases_path = os.path.join(RELEASES_DIR, component)
+    if not os.path.isdir(releases_path):
+        return []
+
+    with os.scandir(releases_path) as entries:
+        releases = [
+            entry for entry in entries
+            if entry.is_dir(follow_symlinks=False) and not entry.name.endswith("_staging")
+        ]
+
+    return [entry.name for entry in sorted(releases, key=lambda entry: entry.stat().st_mtime, reverse=True)]
+
+
+def prune_releases(component, keep=RELEASES_KEEP):
+    """
+    Removes the least recently used releases except the active and the previous one.
+    """
+    releases_path = os.path.join(RELEASES_DIR, component)
+    protected = {
+        os.path.realpath(os.path.join(ARGUS_HOME, component)),
+        os.path.realpath(os.path.join(releases_path, PREVIOUS_RELEASE)),
+    }
+    for name in get_releases(component)[keep:]:
+        release_path = os.path.join(releases_path, name)
+        # ARGUS_HOME or the releases directory can be a symlink
+        if os.path.realpath(release_path) not in protected:
+            logging.info("Removing release %s", release_path)
+            shutil.rmtree(release_path)
+
+
+def fetch_release(repo_url, version, filename, working_directory, stream, cache_dir, cache_size):
+    """
+    Returns the directory of the extracted release.
+
+    In streaming mode the release is extracted next to the working directory while it's downloaded.
+    """
+    if stream:
+        staging_path = f"{working_directory}_staging"
+        stream_release(repo_url, version, f"{filename}.tar.gz", staging_path, cache_dir, cache_size)
+        return staging_path
+
+    archive_path = download(repo_url, version, f"{filename}.tar.gz", cache_dir, cache_size)
+    extract_files(archive_path, filename)
+    return os.path.join(TEMP_DIR, filename)
+
+
+def place_release(release_path, working_directory, stream):
+    if stream:
+        # the staging directory is on the same file system
+        os.rename(release_path, working_directory)
+    else:
+        shutil.copytree(release_path, working_directory, symlinks=True)
+
+
+def extract_files(archive_path, filename):
+    # the files of an earlier extraction would be mixed into the release
+    if os.path.exists(os.path.join(TEMP_DIR, filename)):
+        shutil.rmtree(os.path.join(TEMP_DIR, filename))
+
+    with tarfile.open(archive_path) as archive:
+        extract_archive(archive, os.path.join(TEMP_DIR, filename))
+
+
+def extract_archive(archive, target_path, members=None):
+    """
+    Extracts the members of the downloaded archive only into the target directory.
+
+    The absolute paths, the paths and the links outside of the target and the special files are rejected.
+    """
+    if hasattr(tarfile, "data_filter"):
+        archive.extractall(target_path, members=members, filter="data")
+    else:
+        archive.extractall(target_path, members=check_members(archive if members is None else members, target_path))
+
+
+def check_members(members, target_path):
+    """
+    Yields the members of the archive, raises UnsafeArchiveError for a member escaping the target directory.
+    """
+    target_path = os.path.realpath(target_path)
+
+    def is_inside(path):
+        return os.path.commonpath([target_path, os.path.realpath(path)]) == target_path
+
+    for member in members:
+        path = os.path.join(target_path, member.name)
+        if os.path.isabs(member.name) or not is_inside(path):
+            raise UnsafeArchiveError(f"Member {member.name} is outside of {target_path}")
+        if member.issym() and (
+            os.path.isabs(member.linkname) or not is_inside(os.path.join(os.path.dirname(path), member.linkname))
+        ):
+            raise UnsafeArchiveError(f"Link {member.name} points outside of {target_path}")
+        if member.islnk() and (os.path.isabs(member.linkname) or not is_inside(os.path.join(target_path, member.linkname))):
+            raise UnsafeArchiveError(f"Hard link {member.name} points outside of {target_path}")
+        if member.isdev():
+            raise UnsafeArchiveError(f"Member {member.name} is a special file")
+        yield member
+
+
+class HashingReader:
+    """
+    File-like object hashing the bytes read from the stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+
+def stream_release(repo_url, version, filename, target_path, cache_dir=CACHE_DIR, cache_size=ARTIFACTS_CACHE_SIZE):
+    """
+    Extracts the release artifact into the target directory while downloading it.
+
+    The downloaded artifact isn't stored, only the extracted files are written to the disk.
+    An artifact already in the cache is extracted from there.
+    """
+    full_url = f"{repo_url}/releases/download/{version}/{filename}"
+    if os.path.exists(target_path):
+        shutil.rmtree(target_path)
+
+    if full_url in read_artifacts_index(os.path.join(cache_dir, ARTIFACTS_DIR)):
+        archive_path = download(repo_url, version, filename, cache_dir, cache_size)
+        with tarfile.open(archive_path) as archive:
+            extract_archive(archive, target_path)
+        return
+
+    checksum = get_checksum(full_url)
+    logging.debug("Streaming from %s", full_url)
+    start = time()
+    with urllib.request.urlopen(full_url) as response:
+        reader = HashingReader(response)
+        with tarfile.open(fileobj=reader, mode="r|gz") as archive:
+            extract_archive(archive, target_path)
+
+        # the rest of the stream after the end of the archive (padding) is hashed too
+        for _ in iter(lambda: reader.read(DOWNLOAD_CHUNK_SIZE), b""):
+            pass
+
+    sha256 = reader.digest.hexdigest()
+    if checksum is not None and checksum != sha256:
+        shutil.rmtree(target_path)
+        raise ChecksumError(f"Checksum of {full_url} is {sha256} instead of {checksum}")
+
+    logging.info(
+        "Extracted %s (%s bytes, sha256 %s) in %.2fs",
+        full_url, reader.size, sha256, time() - start
+    )
+
+
+def show_changes(before, after, before_path, after_path, workers=DIFF_WORKERS):
+    """
+    Compare the manifests of the directory and returns the added, removed and modified files.
+
+    The files are modified if their content is different (compared in the before and the after
+    directories), the files with only a different modification time or owner are listed separately.
+    """
+    paths = sorted(before.keys() & after.keys())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        different = list(executor.map(
+            lambda path: is_different(os.path.join(before_path, path), os.path.join(after_path, path)), paths
+        ))
+
+    changes = {
+        "added": sorted(after.keys() - before.keys()),
+        "removed": sorted(before.keys() - after.keys()),
+        "modified": [path for path, changed in zip(paths, different) if changed],
+        "metadata": [path for path, changed in zip(paths, different) if not changed and before[path] != after[path]],
+    }
+
+    logging.info(SEPARATOR)
+    if not any(changes.values()):
         logging.info("No changes found!")
+        return changes
+
+    logging.info(
+        "Changes found: %s added, %s removed, %s modified, %s with changed time or owner",
+        len(changes["added"]), len(changes["removed"]), len(changes["modified"]), len(changes["metadata"])
+    )
+    for sign, change, manifest in (
+        ("+", "added", after), ("-", "removed", before), ("*", "modified", after), ("~", "metadata", after)
+    ):
+        for path in changes[change]:
+            size, _, user, group = manifest[path]
+            logging.info("%s %-48s %10s %10s:%-10s", sign, path, size, group, user)
 
+    return changes
 
-def print_diff_files(comparison):
+
+def is_different(left_path, right_path):
     """
-    Difference of the files
+    Returns True if the content of the files (or the target of the links) is different.
     """
-    for name in comparison.diff_files:
-        if name in ["Pipfile.lock", "index.html"]:
+    if os.path.islink(left_path) or os.path.islink(right_path):
+        return not os.path.islink(left_path) or not os.path.islink(right_path) or \
+            os.readlink(left_path) != os.readlink(right_path)
+
+    return os.path.getsize(left_path) != os.path.getsize(right_path) or file_hash(left_path) != file_hash(right_path)
+
+
+def is_binary(path):
+    with open(path, "rb") as checked_file:
+        return b"\0" in checked_file.read(8192)
+
+
+def print_diff_files(left, right, different_files):
+    """
+    Difference of the files (the modified files found by show_changes)
+    """
+    logging.info("%s files are different in %s and %s", len(different_files), left, right)
+    for path in different_files:
+        if os.path.basename(path) in DIFF_IGNORED_FILES:
             continue
 
-        logging.info("\n\nFile difference %s found in %s and %s", name, comparison.left, comparison.right)
-        path_left = os.path.join(comparison.left, name)
-        path_right = os.path.join(comparison.right, name)
-        with open(path_left, "r+") as file_left, open(path_right, "r+") as file_right:
-            logging.info("".join(
-                unified_diff(
-                    file_left.readlines(),
-                    file_right.readlines(),
-                    fromfile=path_left,
-                    tofile=path_right
-                )
-            ))
+        logging.info("\n\nFile difference %s found in %s and %s", path, left, right)
+        path_left = os.path.join(left, path)
+        path_right = os.path.join(right, path)
+        if os.path.islink(path_left) or os.path.islink(path_right):
+            logging.info("Symbolic link changed")
+            continue
+        if max(os.path.getsize(path_left), os.path.getsize(path_right)) > MAX_DIFF_FILE_SIZE:
+            logging.info("File is too large (> %s bytes)", MAX_DIFF_FILE_SIZE)
+            continue
+        if is_binary(path_left) or is_binary(path_right):
+            logging.info("Binary file")
+            continue
 
-    for sub_comparison in comparison.subdirs.values():
-        print_diff_files(sub_comparison)
+        with open(path_left, "r", errors="replace") as file_left, open(path_right, "r", errors="replace") as file_right:
+            diff = unified_diff(file_left.readlines(), file_right.readlines(), fromfile=path_left, tofile=path_right)
+            for number, line in enumerate(diff):
+                if number == MAX_DIFF_LINES:
+                    logging.info("... (more than %s lines)", MAX_DIFF_LINES)
+                    break
+                logging.info(line.rstrip("\n"))
 
 
 def cleanup_folder(path):
@@ -230,14 +734,142 @@ def cleanup_folder(path):
             os.rmdir(item_path)
 
 
-def backup_folder(path):
-    backup_path = f"{path}_backup_{dt.now().strftime('%Y%m%d_%H%M%S')}"
-    logging.info("Creating backup to: %s", backup_path)
-    # shutil.move(path, backup_path)
-    shutil.copytree(path, backup_path)
+def backup_folder(path, keep=None, max_age=None):
+    """
+    Creates an incremental snapshot of the folder (the old snapshots are kept unless keep or max_age is given).
+
+    The files unchanged since the previous snapshot (same size and modification time)
+    are hard linked to it, only the new and the changed files are copied.
+    """
+    backup_path = f"{path}_backup_{dt.now().strftime(SNAPSHOT_TIME_FORMAT)}"
+    snapshots = get_snapshots(path)
+    previous_path = snapshots[0] if snapshots else None
+    logging.info("Creating backup to: %s (previous: %s)", backup_path, previous_path)
+
+    copied = linked = 0
+    directories = []
+    for root, dirs, files in os.walk(path):
+        relative_root = os.path.relpath(root, path)
+        target_root = os.path.normpath(os.path.join(backup_path, relative_root))
+        os.makedirs(target_root, exist_ok=True)
+        directories.append((root, target_root))
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+            elif name in files:
+                previous_file = os.path.join(previous_path, relative_root, name) if previous_path else None
+                if previous_file and link_unchanged(source, previous_file, target):
+                    linked += 1
+                else:
+                    shutil.copy2(source, target)
+                    copied += 1
+
+    # the modification time of the directories changes when their content is created
+    for root, target_root in reversed(directories):
+        shutil.copystat(root, target_root)
+
+    logging.info("Backup: %s files copied, %s files linked", copied, linked)
+    prune_snapshots(path, keep, max_age)
     return backup_path
 
 
+def link_unchanged(source, previous_file, target):
+    """
+    Hard link the file of the previous snapshot if the source didn't change since.
+    """
+    try:
+        source_stat = os.stat(source)
+        previous_stat = os.stat(previous_file, follow_symlinks=False)
+        if stat.S_ISREG(previous_stat.st_mode) and source_stat.st_size == previous_stat.st_size and \
+                source_stat.st_mtime_ns == previous_stat.st_mtime_ns:
+            os.link(previous_file, target)
+            return True
+    except OSError as error:
+        logging.debug("Copying %s: %s", source, error)
+
+    return False
+
+
+def get_snapshots(path):
+    """
+    Returns the snapshots of the folder, the newest first.
+    """
+    return sorted(
+        (snapshot for snapshot in glob.glob(f"{glob.escape(path)}_backup_*") if os.path.isdir(snapshot)),
+        reverse=True
+    )
+
+
+def get_snapshot_time(snapshot_path):
+    try:
+        return dt.strptime(snapshot_path.rsplit("_backup_", 1)[1], SNAPSHOT_TIME_FORMAT).timestamp()
+    except ValueError:
+        return os.path.getmtime(snapshot_path)
+
+
+def prune_snapshots(path, keep=None, max_age=None):
+    """
+    Removes the snapshots above the given count or older than the given days, the newest is always kept.
+    """
+    for index, snapshot_path in enumerate(get_snapshots(path)):
+        expired = max_age is not None and time() - get_snapshot_time(snapshot_path) > max_age * 24 * 3600
+        if index > 0 and ((keep is not None and index >= keep) or expired):
+            logging.info("Removing backup %s", snapshot_path)
+            shutil.rmtree(snapshot_path)
+
+
+def list_snapshots(component):
+    path = os.path.join(ARGUS_HOME, component)
+    logging.info("Backups of %s", path)
+    for snapshot_path in get_snapshots(path):
+        files = size = unique_size = 0
+        for root, _, names in os.walk(snapshot_path):
+            for name in names:
+                file_stat = os.lstat(os.path.join(root, name))
+                files += 1
+                size += file_stat.st_size
+                # the files not linked to other snapshots
+                if file_stat.st_nlink == 1:
+                    unique_size += file_stat.st_size
+
+        logging.info(
+            "  - %s: %s files, %s bytes (%s bytes not shared with other backups)",
+            snapshot_path.rsplit("_backup_", 1)[1], files, size, unique_size
+        )
+
+
+def restore_snapshot(component, name):
+    """
+    Replace the working directory of the component with the copy of the snapshot.
+
+    The current state is saved to a new snapshot before.
+    """
+    path = os.path.join(ARGUS_HOME, component)
+    snapshot_path = f"{path}_backup_{name}"
+    if os.path.islink(path):
+        logging.error("The working directory %s is a release, use rollback!", path)
+        return False
+    if not os.path.isdir(snapshot_path):
+        logging.error("Backup %s not found!", snapshot_path)
+        return False
+
+    if os.path.isdir(path):
+        backup_folder(path)
+
+    logging.info("Restoring %s from %s", path, snapshot_path)
+    restoring_path = f"{path}_restoring"
+    if os.path.exists(restoring_path):
+        shutil.rmtree(restoring_path)
+    # copy the files, the hard links of the snapshot shouldn't be changed in the working directory
+    shutil.copytree(snapshot_path, restoring_path, symlinks=True)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(restoring_path, path)
+    return True
+
+
 def restore_files(backup_folder, restore_folder, backup_paths):
     for backup_path in backup_paths:
         full_backup_path = os.path.join(backup_folder, backup_path)
@@ -250,19 +882,155 @@ def restore_files(backup_folder, restore_folder, backup_paths):
             shutil.copytree(full_backup_path, restore_path)
 
 
-def download(repo_url, version, filename):
+def download(repo_url, version, filename, cache_dir=CACHE_DIR, cache_size=ARTIFACTS_CACHE_SIZE):
+    """
+    Returns the path of the release artifact in the cache, downloads it only if it's missing.
+
+    The artifacts are stored by their SHA256 hash and the index maps the URLs to the hashes.
+    """
     full_url = f"{repo_url}/releases/download/{version}/{filename}"
-    logging.debug("Download from %s", full_url)
-    urllib.request.urlretrieve(full_url, os.path.join(TEMP_DIR, filename))
+    artifacts_dir = os.path.join(cache_dir, ARTIFACTS_DIR)
+    os.makedirs(artifacts_dir, exist_ok=True)
+
+    index = read_artifacts_index(artifacts_dir)
+    entry = index.get(full_url)
+    if entry and file_hash(os.path.join(artifacts_dir, entry["sha256"])) == entry["sha256"]:
+        logging.info("Using cached %s", full_url)
+    else:
+        logging.debug("Download from %s", full_url)
+        sha256 = fetch_artifact(full_url, artifacts_dir, get_checksum(full_url))
+        entry = {"sha256": sha256, "size": os.path.getsize(os.path.join(artifacts_dir, sha256))}
+
+    entry["used"] = time()
+    index[full_url] = entry
+    evict_artifacts(artifacts_dir, index, cache_size, keep=entry["sha256"])
+    write_artifacts_index(artifacts_dir, index)
+    return os.path.join(artifacts_dir, entry["sha256"])
+
+
+def get_checksum(url):
+    """
+    Returns the published SHA256 checksum of the file (<url>.sha256) if available.
+    """
+    try:
+        with urllib.request.urlopen(f"{url}.sha256") as response:
+            return response.read().decode().split()[0].lower()
+    except (urllib.error.URLError, IndexError) as error:
+        logging.debug("No checksum for %s: %s", url, error)
+        return None
+
+
+def fetch_artifact(url, artifacts_dir, checksum=None):
+    """
+    Downloads the file into the cache and returns its SHA256 hash.
+
+    The download continues from the partial file of an interrupted download if the server supports it.
+    """
+    partial_path = os.path.join(artifacts_dir, hashlib.sha256(url.encode()).hexdigest() + ".part")
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+
+    digest = hashlib.sha256()
+    try:
+        with urllib.request.urlopen(request) as response:
+            if offset and getattr(response, "status", None) == 206:
+                logging.info("Resuming download from %s bytes", offset)
+                update_hash(digest, partial_path)
+                mode = "ab"
+            else:
+                mode = "wb"
+
+            with open(partial_path, mode) as partial_file:
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    partial_file.write(chunk)
+    except urllib.error.HTTPError as error:
+        # the partial file is already complete
+        if error.code != 416:
+            raise
+        update_hash(digest, partial_path)
+
+    sha256 = digest.hexdigest()
+    if checksum is not None and checksum != sha256:
+        os.remove(partial_path)
+        raise ChecksumError(f"Checksum of {url} is {sha256} instead of {checksum}")
+
+    os.replace(partial_path, os.path.join(artifacts_dir, sha256))
+    return sha256
+
+
+def evict_artifacts(artifacts_dir, index, cache_size, keep=None):
+    """
+    Removes the least recently used artifacts until the cache fits in the given size.
+    """
+    # the same artifact can be referenced from multiple URLs
+    artifacts = {}
+    for entry in index.values():
+        size, used = artifacts.get(entry["sha256"], (entry["size"], 0))
+        artifacts[entry["sha256"]] = (size, max(used, entry["used"]))
+
+    total_size = sum(size for size, _ in artifacts.values())
+    for sha256, (size, _) in sorted(artifacts.items(), key=lambda item: item[1][1]):
+        if total_size <= cache_size:
+            break
+        if sha256 == keep:
+            continue
+
+        logging.info("Removing cached artifact %s (%s bytes)", sha256, size)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(artifacts_dir, sha256))
+        for url in [url for url, entry in index.items() if entry["sha256"] == sha256]:
+            del index[url]
+        total_size -= size
+
+
+def read_artifacts_index(artifacts_dir):
+    with contextlib.suppress(OSError, ValueError):
+        with open(os.path.join(artifacts_dir, ARTIFACTS_INDEX_FILE), "r", encoding="utf-8") as index_file:
+            return json.load(index_file)
+
+    return {}
+
+
+def write_artifacts_index(artifacts_dir, index):
+    index_path = os.path.join(artifacts_dir, ARTIFACTS_INDEX_FILE)
+    with open(f"{index_path}.tmp", "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def file_hash(path):
+    """
+    Returns the SHA256 hash of the file or None if it doesn't exist.
+    """
+    if not os.path.isfile(path):
+        return None
+
+    return update_hash(hashlib.sha256(), path).hexdigest()
+
+
+def update_hash(digest, path):
+    with open(path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest
 
 
 def main():
     parser = ArgumentParser(description=description, formatter_class=RawTextHelpFormatter)
     parser.add_argument("-v", "--verbose", action='store_true')
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help=f"Directory of the cached data (default: {CACHE_DIR})")
     subparsers = parser.add_subparsers(dest='action', description="You can use these commands to manage the version of the system")
 
     help = 'List the available versions'
     parser_list = subparsers.add_parser('list', description=help, help=help)
+    parser_list.add_argument(
+        "-r", "--refresh", action='store_true', help="Query the repositories even if the cached tags are not expired"
+    )
+    parser_list.add_argument(
+        "--ttl", type=int, default=TAGS_CACHE_TTL, help=f"Expiration of the cached tags in seconds (default: {TAGS_CACHE_TTL})"
+    )
     # parser_a.add_argument("-o", action='store_true')
     # parser_a.add_argument("--opt2", action='store_true')
 
@@ -271,8 +1039,49 @@ def main():
     parser_change = subparsers.add_parser('change', description=help, help=help)
     parser_change.add_argument("-V", "--version", type=str, required=True)
     parser_change.add_argument("-c", "--component", choices=COMPONENTS.keys(), required=True)
+    parser_change.add_argument(
+        "-s", "--stream", action='store_true',
+        help="Extract the release while downloading it, next to the working directory, without storing the archive"
+    )
+    parser_change.add_argument(
+        "-r", "--releases", action='store_true',
+        help=f"Keep the versions side by side in {RELEASES_DIR} and switch the working directory with a symlink"
+    )
+    parser_change.add_argument(
+        "-d", "--delta", action='store_true',
+        help="Download only the changes from the active release (with --releases), the full release if not available"
+    )
+    parser_change.add_argument(
+        "-k", "--keep", type=int, default=RELEASES_KEEP,
+        help="Number of releases to keep (the active and the previous release are always kept, default: %(default)s)"
+    )
+    parser_change.add_argument(
+        "--keep-backups", type=int, help="Number of backups to keep (the newest one is always kept, default: all)"
+    )
+    parser_change.add_argument(
+        "--max-age", type=float, help="Remove the backups older than the given days (the newest one is always kept)"
+    )
+    parser_change.add_argument("-j", "--json", metavar="FILE", help="Save the changed files in JSON format")
+    parser_change.add_argument(
+        "--cache-size", type=int, default=ARTIFACTS_CACHE_SIZE // (1024 * 1024),
+        help="Maximum size of the cached release artifacts in MB (default: %(default)s)"
+    )
     # parser_b.add_argument("--opt4", action='store_true')
 
+    help = 'Switch back to the previous release (only with the releases directory)'
+    parser_rollback = subparsers.add_parser('rollback', description=help, help=help)
+    parser_rollback.add_argument("-V", "--version", type=str, help="Release to switch to instead of the previous one")
+    parser_rollback.add_argument("-c", "--component", choices=COMPONENTS.keys(), required=True)
+
+    help = 'List the backups of the working directory'
+    parser_backups = subparsers.add_parser('backups', description=help, help=help)
+    parser_backups.add_argument("-c", "--component", choices=COMPONENTS.keys(), required=True)
+
+    help = 'Restore the working directory from a backup'
+    parser_restore = subparsers.add_parser('restore', description=help, help=help)
+    parser_restore.add_argument("-b", "--backup", type=str, required=True, help="Timestamp of the backup (see backups)")
+    parser_restore.add_argument("-c", "--component", choices=COMPONENTS.keys(), required=True)
+
     args = parser.parse_args()
 
     if args.verbose:
@@ -281,12 +1090,24 @@ def main():
         basicConfig(level=logging.INFO, format="%(message)s")
 
     if args.action == "list":
-        list_versions()
+        list_versions(args.cache_dir, 0 if args.refresh else args.ttl)
     elif args.action == "change":
-        update(args.component, args.version)
+        changes = update(
+            args.component, args.version, args.cache_dir, args.cache_size * 1024 * 1024,
+            args.stream, args.releases, args.keep, args.keep_backups, args.max_age, args.delta
+        )
+        if args.json and changes is not None:
+            with open(args.json, "w", encoding="utf-8") as changes_file:
+                json.dump(changes, changes_file, indent=2)
+    elif args.action == "rollback":
+        return 0 if rollback(args.component, args.version) else 1
+    elif args.action == "backups":
+        list_snapshots(args.component)
+    elif args.action == "restore":
+        return 0 if restore_snapshot(args.component, args.backup) else 1
     else:
         parser.print_help()
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
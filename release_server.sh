@@ -1,6 +1,3 @@
 #!/bin/bash
 
-cd server
-tar -cvzf arpi-server.tar.gz --exclude="__pycache__" etc scripts src Pipfile Pipfile.lock
-cd ..
-mv server/arpi-server.tar.gz .
\ No newline at end of file
+invoke package --component server
@@ -0,0 +1,230 @@
+"""
+Building the release artifacts of the ArPI Home Security system components.
+
+The archives are reproducible: the same source gives the same bytes, the entries
+are sorted and their timestamps, owners and permissions are normalized.
+"""
+
+import hashlib
+import json
+import os
+import stat
+import struct
+import subprocess
+import tarfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+
+RELEASES = {
+    "server": {
+        "source": "server",
+        "paths": ["etc", "scripts", "src", "Pipfile", "Pipfile.lock"],
+        "artifact": "arpi-server.tar.gz",
+    },
+    "webapplication": {
+        "source": "webapplication/dist-production",
+        "paths": ["."],
+        "artifact": "arpi-webapplication.tar.gz",
+    },
+}
+# the compressed siblings of the assets are created by install.py in the build of the web application
+EXCLUDES = ["__pycache__", "*.pyc", "*.gz", "*.br"]
+COMPRESSION_LEVEL = 9
+# size of the independently compressed blocks of the gzip stream
+BLOCK_SIZE = 128 * 1024
+# the previous 32 kB is the dictionary of the next block (like pigz)
+DICTIONARY_SIZE = 32 * 1024
+MANIFEST_SUFFIX = ".manifest.json"
+# list of the removed files in the delta archives
+DELTA_FILE = ".arpi_delta.json"
+
+
+def get_source_date(path):
+    """
+    Returns the timestamp of the last commit of the repository (SOURCE_DATE_EPOCH if set).
+    """
+    if os.getenv("SOURCE_DATE_EPOCH"):
+        return int(os.getenv("SOURCE_DATE_EPOCH"))
+
+    try:
+        output = subprocess.check_output(
+            ["git", "log", "-1", "--format=%ct"], cwd=path, text=True, stderr=subprocess.DEVNULL
+        )
+        return int(output.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return 0
+
+
+def is_excluded(name, excludes):
+    return any(
+        name == exclude or (exclude.startswith("*") and name.endswith(exclude[1:]))
+        for exclude in excludes
+    )
+
+
+def collect_entries(source, paths, excludes=EXCLUDES):
+    """
+    Returns the sorted relative paths of the directories and files to archive.
+    """
+    entries = []
+    for path in paths:
+        full_path = os.path.normpath(os.path.join(source, path))
+        if path != ".":
+            entries.append(os.path.relpath(full_path, source))
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            for root, dirs, files in os.walk(full_path):
+                dirs[:] = [name for name in dirs if not is_excluded(name, excludes)]
+                for name in dirs + files:
+                    if not is_excluded(name, excludes):
+                        entries.append(os.path.relpath(os.path.join(root, name), source))
+
+    return sorted(entries)
+
+
+def normalize(info, mtime):
+    """
+    Removes the attributes of the build environment from the archive entry.
+    """
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    if info.isdir() or info.mode & stat.S_IXUSR:
+        info.mode = 0o755
+    else:
+        info.mode = 0o644
+    return info
+
+
+def build_tar(source, entries, mtime, metadata=None):
+    """
+    Returns the uncompressed archive and the manifest of the files.
+
+    The metadata (name => content) is added before the files.
+    """
+    manifest = {}
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT) as archive:
+        for name, content in (metadata or {}).items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(normalize(info, mtime), BytesIO(content))
+
+        for entry in entries:
+            path = os.path.join(source, entry)
+            info = normalize(archive.gettarinfo(path, arcname=entry), mtime)
+            if info.isfile():
+                with open(path, "rb") as entry_file:
+                    content = entry_file.read()
+                archive.addfile(info, BytesIO(content))
+                manifest[entry] = {"size": info.size, "mode": oct(info.mode), "sha256": hashlib.sha256(content).hexdigest()}
+            else:
+                archive.addfile(info)
+                if info.issym():
+                    manifest[entry] = {"link": info.linkname}
+
+    return buffer.getvalue(), manifest
+
+
+def compress_block(block, dictionary, last, level=COMPRESSION_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary or b"")
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_compress(data, workers=None, level=COMPRESSION_LEVEL):
+    """
+    Compress the data in blocks on multiple threads into a single gzip stream.
+
+    The result only depends on the data (no file name or timestamp in the header).
+    """
+    offsets = range(0, len(data), BLOCK_SIZE) or [0]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        blocks = executor.map(
+            lambda offset: compress_block(
+                data[offset:offset + BLOCK_SIZE],
+                data[max(0, offset - DICTIONARY_SIZE):offset],
+                offset + BLOCK_SIZE >= len(data),
+                level
+            ),
+            offsets
+        )
+        # header: magic, deflate, no flags, no timestamp, no extra flags, unknown OS
+        header = b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff"
+        trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+        return header + b"".join(blocks) + trailer
+
+
+def build_release(component, version=None, output=".", workers=None):
+    """
+    Builds the release artifact of the component with the manifest and the checksum next to it.
+
+    Returns the path of the artifact.
+    """
+    release = RELEASES[component]
+    source = release["source"]
+    artifact_path = os.path.join(output, release["artifact"])
+    print(f"Building {artifact_path} from {source}...")
+
+    entries = collect_entries(source, release["paths"])
+    data, files = build_tar(source, entries, get_source_date(source))
+    checksum = write_artifact(artifact_path, data, workers)
+
+    manifest = {"component": component, "version": version, "sha256": checksum, "files": files}
+    with open(f"{artifact_path}{MANIFEST_SUFFIX}", "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    print(f"Archived {len(files)} files ({len(data)} bytes), sha256 {checksum}")
+    return artifact_path
+
+
+def get_delta_artifact(artifact, base_version):
+    """
+    Returns the name of the delta artifact updating the base version.
+    """
+    return artifact.replace(".tar.gz", f".from-{base_version}.delta.tar.gz")
+
+
+def build_delta(component, base_manifest_path, output=".", workers=None):
+    """
+    Builds the delta artifact from the release of the base manifest to the release built last.
+
+    The delta contains the added and changed files and the list of the removed files.
+    Returns the path of the artifact.
+    """
+    release = RELEASES[component]
+    source = release["source"]
+    with open(base_manifest_path, "r", encoding="utf-8") as manifest_file:
+        base = json.load(manifest_file)
+    with open(os.path.join(output, f"{release['artifact']}{MANIFEST_SUFFIX}"), "r", encoding="utf-8") as manifest_file:
+        target = json.load(manifest_file)
+
+    changed = sorted(path for path, info in target["files"].items() if base["files"].get(path) != info)
+    removed = sorted(base["files"].keys() - target["files"].keys())
+    delta = {"from": base["version"], "to": target["version"], "removed": removed}
+    artifact_path = os.path.join(output, get_delta_artifact(release["artifact"], base["version"]))
+    print(f"Building {artifact_path} with {len(changed)} changed and {len(removed)} removed files...")
+
+    data, _ = build_tar(
+        source, changed, get_source_date(source), {DELTA_FILE: json.dumps(delta, sort_keys=True).encode()}
+    )
+    checksum = write_artifact(artifact_path, data, workers)
+    print(f"Archived {len(changed)} files ({len(data)} bytes), sha256 {checksum}")
+    return artifact_path
+
+
+def write_artifact(artifact_path, data, workers=None):
+    """
+    Compress the archive into the artifact and writes its checksum next to it.
+
+    Returns the SHA256 hash of the artifact.
+    """
+    compressed = gzip_compress(data, workers)
+    with open(artifact_path, "wb") as artifact_file:
+        artifact_file.write(compressed)
+
+    checksum = hashlib.sha256(compressed).hexdigest()
+    with open(f"{artifact_path}.sha256", "w", encoding="utf-8") as checksum_file:
+        checksum_file.write(f"{checksum}  {os.path.basename(artifact_path)}\n")
+
+    return checksum
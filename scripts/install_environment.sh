@@ -1,172 +1,266 @@
 #!/bin/bash
 
 # Install Argus onto a new Rapsbian system
+#
+# The installation is split into steps, the completed steps are marked in $STEPS_DIR
+# and skipped when the script runs again (resuming at the failed step).
+#
+# Usage: install_environment.sh [--only step1,step2] [--skip step3] [--list] [--reset]
+#   --only   run only the listed steps (even if they are completed)
+#   --skip   skip the listed steps
+#   --list   print the steps and their state
+#   --reset  remove the completion markers
 
 set -x
-PS4='+\t '
+# timestamp of the commands in the trace (parsed by install.py)
+PS4='+${EPOCHREALTIME} '
 
 # print environment variables sorted
 env -0 | sort -z | tr '\0' '\n'
 
 export DEBIAN_FRONTEND=noninteractive
 
+STEPS_DIR="$HOME/.arpi_install"
+STEPS="upgrade zsh certificate mosquitto database certbot rtc gsm nginx python wiringpi pip services access run_folder restart cleanup"
+
+
+# append the line to the file if it doesn't contain it yet
+append_line() {
+  sudo grep -qxF -- "$2" "$1" || printf '%s\n' "$2" | sudo tee -a "$1" > /dev/null
+}
+
+# print the title of the section (the markers are parsed by install.py to measure the sections)
+section() {
+  { set +x; } 2> /dev/null
+  printf '\n\n::section:: %s\n' "$1"
+  set -x
+}
+
+subsection() {
+  { set +x; } 2> /dev/null
+  printf '::subsection:: %s\n' "$1"
+  set -x
+}
+
+# the dhparam file is uploaded by install.py when it is generated
+# (install.py waits for the upload at the end only if the marker is printed)
+wait_for_dhparam() {
+  { set +x; } 2> /dev/null
+  echo "::dhparam::"
+  local waited=0
+  until [ -f "$DHPARAM_FILE" ]; do
+    if [ -f "$DHPARAM_FILE.failed" ] || [ $waited -ge 3600 ]; then
+      echo "The dhparam file $DHPARAM_FILE isn't available"
+      set -x
+      return 1
+    fi
+    [ $waited -eq 0 ] && echo "Waiting for the dhparam file $DHPARAM_FILE..."
+    sleep 5
+    waited=$((waited + 5))
+  done
+  set -x
+}
+
 # Sytem update
-printf "\n\n# Updating the system\n"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET update
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y upgrade
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y autoremove
-
-echo "## Install oh my zsh for argus"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install zsh curl git vim minicom net-tools telnet
-set +x
-sh -c "$(curl -fsSL https://raw.githubusercontent.com/ohmyzsh/ohmyzsh/master/tools/install.sh) --unattended 2>&1 | cat"
-set -x
-sudo chsh -s /bin/zsh argus
+step_upgrade() {
+  section "Updating the system"
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET update
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y upgrade
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y autoremove
+}
+
+step_zsh() {
+  subsection "Install oh my zsh for argus"
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install zsh curl git vim minicom net-tools telnet
+  set +x
+  sh -c "$(curl -fsSL https://raw.githubusercontent.com/ohmyzsh/ohmyzsh/master/tools/install.sh) --unattended 2>&1 | cat"
+  set -x
+  sudo chsh -s /bin/zsh argus
+}
 
 # CERTIFICATE
-printf "\n\n## Create self signed certificate\n"
-cd /tmp
-openssl req -new -newkey rsa:4096 -nodes -x509 \
-     -subj "/C=HU/ST=Fejér/L=Baracska/O=ArPI/CN=arpi.local" \
-     -days 730 \
-     -keyout arpi.local.key \
-     -out arpi.local.cert
-cd ~
+step_certificate() {
+  subsection "Create self signed certificate"
+  cd /tmp
+  openssl req -new -newkey rsa:4096 -nodes -x509 \
+       -subj "/C=HU/ST=Fejér/L=Baracska/O=ArPI/CN=arpi.local" \
+       -days 730 \
+       -keyout arpi.local.key \
+       -out arpi.local.cert
+}
 
 # MQTT
-printf "\n\n# Install MQTT broker\n"
-echo "## Install mosquitto"
-cd /tmp
-wget http://repo.mosquitto.org/debian/mosquitto-repo.gpg.key
-sudo apt-key add mosquitto-repo.gpg.key
-cd ~
-echo "deb https://repo.mosquitto.org/debian bookworm main" | sudo tee /etc/apt/sources.list.d/mosquitto.list
-sudo apt-get $QUIET update
-sudo apt-get $QUIET -y install mosquitto
-echo "## Configure mosquitto"
-sudo cp $DHPARAM_FILE /etc/mosquitto/certs/
-sudo cp -t /etc/mosquitto/certs/ /tmp/arpi.local.key /tmp/arpi.local.cert
-sudo chown -R mosquitto: /etc/mosquitto/certs
-sudo cp /tmp/etc/mosquitto/auth.conf /etc/mosquitto/conf.d/
-sudo cp /tmp/etc/mosquitto/logging.conf /etc/mosquitto/conf.d/
-sudo mkdir -p /etc/mosquitto/configs-available/
-sudo cp /tmp/etc/mosquitto/ssl*.conf /etc/mosquitto/configs-available/
-sudo ln -s /etc/mosquitto/configs-available/ssl-self-signed.conf /etc/mosquitto/conf.d/ssl.conf
+step_mosquitto() {
+  section "Install MQTT broker"
+  subsection "Install mosquitto"
+  cd /tmp
+  wget -O mosquitto-repo.gpg.key http://repo.mosquitto.org/debian/mosquitto-repo.gpg.key
+  sudo apt-key add mosquitto-repo.gpg.key
+  cd ~
+  echo "deb https://repo.mosquitto.org/debian bookworm main" | sudo tee /etc/apt/sources.list.d/mosquitto.list
+  sudo apt-get $QUIET update
+  sudo apt-get $QUIET -y install mosquitto
+  subsection "Configure mosquitto"
+  wait_for_dhparam
+  sudo cp $DHPARAM_FILE /etc/mosquitto/certs/
+  sudo cp -t /etc/mosquitto/certs/ /tmp/arpi.local.key /tmp/arpi.local.cert
+  sudo chown -R mosquitto: /etc/mosquitto/certs
+  sudo cp /tmp/etc/mosquitto/auth.conf /etc/mosquitto/conf.d/
+  sudo cp /tmp/etc/mosquitto/logging.conf /etc/mosquitto/conf.d/
+  sudo mkdir -p /etc/mosquitto/configs-available/
+  sudo cp /tmp/etc/mosquitto/ssl*.conf /etc/mosquitto/configs-available/
+  sudo ln -sf /etc/mosquitto/configs-available/ssl-self-signed.conf /etc/mosquitto/conf.d/ssl.conf
+}
 
 # DATABASE
-printf "\n\n# Database install\n"
-echo "## Install postgres"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install postgresql-${POSTGRESQL_VERSION} libpq-dev
-echo "## Create database"
-sudo su -c "createdb -E UTF8 -e $ARGUS_DB_NAME" postgres
+step_database() {
+  section "Database install"
+  subsection "Install postgres"
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install postgresql-${POSTGRESQL_VERSION} libpq-dev
+  subsection "Create database"
+  if ! sudo su -c "psql -lqt" postgres | cut -d \| -f 1 | grep -qw "$ARGUS_DB_NAME"; then
+    sudo su -c "createdb -E UTF8 -e $ARGUS_DB_NAME" postgres
+  fi
+}
 
 # CERTBOT
-printf "\n\n# Install certbot\n"
-if uname -m | grep -q 'x86_64'; then
-  echo "## Install snapd"
-  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install snapd
-  echo "## Update snapd"
-  sudo snap install core < /dev/null
-  sudo snap refresh core < /dev/null
-  echo "## Update certbot snapd package"
-  sudo snap install certbot --classic < /dev/null
-  echo "## Prepare the command"
-  sudo ln -s /snap/bin/certbot /usr/bin/certbot
-elif uname -m | grep -q 'armv6l'; then
-  echo "## Install certbot"
-  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install certbot
-elif uname -m | grep -q 'armv7l'; then
-  echo "## Install certbot"
-  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install certbot
-fi
+step_certbot() {
+  section "Install certbot"
+  if uname -m | grep -q 'x86_64'; then
+    subsection "Install snapd"
+    sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install snapd
+    subsection "Update snapd"
+    sudo snap install core < /dev/null
+    sudo snap refresh core < /dev/null
+    subsection "Update certbot snapd package"
+    sudo snap install certbot --classic < /dev/null
+    subsection "Prepare the command"
+    sudo ln -sf /snap/bin/certbot /usr/bin/certbot
+  elif uname -m | grep -q 'armv6l'; then
+    subsection "Install certbot"
+    sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install certbot
+  elif uname -m | grep -q 'armv7l'; then
+    subsection "Install certbot"
+    sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install certbot
+  fi
+}
 
 
 # RTC
 # based on https://www.abelectronics.co.uk/kb/article/30/rtc-pi-on-raspbian-buster-and-stretch
-printf "\n\n# Install RTC - DS1307\n"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install i2c-tools
-sudo bash -c "echo ds1307 0x68 > /sys/class/i2c-adapter/i2c-1/new_device"
-echo "dtoverlay=i2c-rtc,ds1307" | sudo tee -a /boot/firmware/config.txt
-echo "rtc-ds1307" | sudo tee -a /etc/modules
-sudo cp /tmp/etc/cron/hwclock /etc/cron.d/
-sudo chmod 644 /etc/cron.d/hwclock
+step_rtc() {
+  section "Install RTC - DS1307"
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install i2c-tools
+  if [ -e /sys/class/i2c-adapter/i2c-1/new_device ] && [ ! -e /sys/class/i2c-adapter/i2c-1/1-0068 ]; then
+    sudo bash -c "echo ds1307 0x68 > /sys/class/i2c-adapter/i2c-1/new_device"
+  fi
+  append_line /boot/firmware/config.txt "dtoverlay=i2c-rtc,ds1307"
+  append_line /etc/modules "rtc-ds1307"
+  sudo cp /tmp/etc/cron/hwclock /etc/cron.d/
+  sudo chmod 644 /etc/cron.d/hwclock
+}
 
 # GSM
-printf "\n\n# Install GSM\n"
-# disable console on serial ports
-sudo systemctl stop serial-getty@ttyAMA0.service
-sudo systemctl disable serial-getty@ttyAMA0.service
-sudo systemctl stop serial-getty@ttyS0.service
-sudo systemctl disable serial-getty@ttyS0.service
-sudo sed -i 's/console=serial0,115200 //g' /boot/cmdline.txt
-echo "" | sudo tee -a /boot/firmware/config.txt
-echo "# Enable UART" | sudo tee -a /boot/firmware/config.txt
-echo "enable_uart=1" | sudo tee -a /boot/firmware/config.txt
-echo "dtoverlay=uart0" | sudo tee -a /boot/firmware/config.txt
-echo "dtoverlay=pi3-disable-bt" | sudo tee -a /boot/firmware/config.txt
-echo "dtoverlay=pi3-miniuart-bt" | sudo tee -a /boot/firmware/config.txt
-
-# Enable serial port
-sudo systemctl stop hciuart
-sudo systemctl disable hciuart
+step_gsm() {
+  section "Install GSM"
+  # disable console on serial ports (not all the devices have both)
+  sudo systemctl stop serial-getty@ttyAMA0.service || true
+  sudo systemctl disable serial-getty@ttyAMA0.service || true
+  sudo systemctl stop serial-getty@ttyS0.service || true
+  sudo systemctl disable serial-getty@ttyS0.service || true
+  sudo sed -i 's/console=serial0,115200 //g' /boot/cmdline.txt || true
+  append_line /boot/firmware/config.txt "# Enable UART"
+  append_line /boot/firmware/config.txt "enable_uart=1"
+  append_line /boot/firmware/config.txt "dtoverlay=uart0"
+  append_line /boot/firmware/config.txt "dtoverlay=pi3-disable-bt"
+  append_line /boot/firmware/config.txt "dtoverlay=pi3-miniuart-bt"
+
+  # Enable serial port
+  sudo systemctl stop hciuart || true
+  sudo systemctl disable hciuart || true
+}
 
 # NGINX installation
-printf "\n\n# Install NGINX\n"
-echo "## Download"
-mkdir /tmp/nginx_build
-cd /tmp/nginx_build
-curl -s -O -J http://nginx.org/download/nginx-$NGINX_VERSION.tar.gz
-tar xvf nginx-$NGINX_VERSION.tar.gz
-cd nginx-$NGINX_VERSION
-echo "## Install prerequisite"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install \
-	build-essential \
-	libpcre3-dev \
-	libssl-dev \
-	zlib1g-dev
-echo "## Build"
-./configure --with-http_stub_status_module --with-http_ssl_module
-make
-echo "## Install"
-sudo make install
-rm -rf /tmp/nginx_build
-# NGINX configurations
-# add user www-data to argus group for accessing the /home/argus/webapplication folder
-sudo adduser www-data argus
-sudo rm -r /usr/local/nginx/conf/*
-sudo cp -r /tmp/etc/nginx/* /usr/local/nginx/conf/
-sudo mkdir -p /usr/local/nginx/conf/modules-enabled/
-sudo ln -s /usr/local/nginx/conf/modules-available/* /usr/local/nginx/conf/modules-enabled/
-sudo ln -s /usr/local/nginx/conf/snippets/self-signed.conf /usr/local/nginx/conf/snippets/certificates.conf
-sudo mkdir -p /usr/local/nginx/conf/sites-enabled/
-sudo ln -s /usr/local/nginx/conf/sites-available/argus.conf /usr/local/nginx/conf/sites-enabled/argus.conf
-
-sudo mkdir -p /usr/local/nginx/conf/ssl
-sudo cp $DHPARAM_FILE /usr/local/nginx/conf/ssl/
-sudo cp -t /usr/local/nginx/conf/ssl/ /tmp/arpi.local.key /tmp/arpi.local.cert
-sudo chown -R www-data:www-data /usr/local/nginx/conf/ssl
-cd ~
-
-printf "\n\n# Install and configure common tools\n"
-echo "## Install python3 and packages"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install \
-  dnsutils \
-	python3 \
-  python3-cryptography \
-	python3-dev \
-	python3-gpiozero \
-	python3-gi \
-  python3-setuptools \
-  cmake \
-  gcc \
-  libgirepository1.0-dev \
-  libcairo2-dev \
-  pkg-config \
-  gir1.2-gtk-3.0 \
-  fail2ban
+# the install tree is archived to $NGINX_ARTIFACT, a prebuilt archive (uploaded by install.py) isn't built again
+NGINX_CONFIGURE_FLAGS="${NGINX_CONFIGURE_FLAGS:---with-http_stub_status_module --with-http_ssl_module --with-http_gzip_static_module}"
+NGINX_ARTIFACT="${NGINX_ARTIFACT:-/tmp/nginx-$NGINX_VERSION.tar.gz}"
+# the runtime libraries of the prebuilt NGINX on the OS release
+nginx_libraries() {
+  case "$(. /etc/os-release && echo "$VERSION_CODENAME")" in
+    buster|bullseye) echo "libpcre3 libssl1.1 zlib1g" ;;
+    bookworm) echo "libpcre3 libssl3 zlib1g" ;;
+    *) echo "libpcre3 libssl3t64 zlib1g" ;;
+  esac
+}
+step_nginx() {
+  section "Install NGINX"
+  if [ -f "$NGINX_ARTIFACT" ]; then
+    subsection "Install prerequisite"
+    sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install $(nginx_libraries)
+  else
+    subsection "Download"
+    rm -rf /tmp/nginx_build
+    mkdir /tmp/nginx_build
+    cd /tmp/nginx_build
+    curl -s -O -J http://nginx.org/download/nginx-$NGINX_VERSION.tar.gz
+    tar xvf nginx-$NGINX_VERSION.tar.gz
+    cd nginx-$NGINX_VERSION
+    subsection "Install prerequisite"
+    sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install \
+    	build-essential \
+    	libpcre3-dev \
+    	libssl-dev \
+    	zlib1g-dev
+    subsection "Build"
+    ./configure $NGINX_CONFIGURE_FLAGS
+    make -j$(nproc)
+    make install DESTDIR=/tmp/nginx_build/root
+    tar -czf "$NGINX_ARTIFACT" --owner=0 --group=0 -C /tmp/nginx_build/root usr/local/nginx
+    cd ~
+    rm -rf /tmp/nginx_build
+  fi
+  subsection "Install"
+  sudo tar -xzf "$NGINX_ARTIFACT" --no-overwrite-dir -C /
+  # NGINX configurations
+  # add user www-data to argus group for accessing the /home/argus/webapplication folder
+  sudo adduser www-data argus
+  sudo rm -rf /usr/local/nginx/conf/*
+  sudo cp -r /tmp/etc/nginx/* /usr/local/nginx/conf/
+  sudo mkdir -p /usr/local/nginx/conf/modules-enabled/
+  sudo ln -sf /usr/local/nginx/conf/modules-available/* /usr/local/nginx/conf/modules-enabled/
+  sudo ln -sf /usr/local/nginx/conf/snippets/self-signed.conf /usr/local/nginx/conf/snippets/certificates.conf
+  sudo mkdir -p /usr/local/nginx/conf/sites-enabled/
+  sudo ln -sf /usr/local/nginx/conf/sites-available/argus.conf /usr/local/nginx/conf/sites-enabled/argus.conf
+
+  sudo mkdir -p /usr/local/nginx/conf/ssl
+  wait_for_dhparam
+  sudo cp $DHPARAM_FILE /usr/local/nginx/conf/ssl/
+  sudo cp -t /usr/local/nginx/conf/ssl/ /tmp/arpi.local.key /tmp/arpi.local.cert
+  sudo chown -R www-data:www-data /usr/local/nginx/conf/ssl
+}
+
+step_python() {
+  section "Install and configure common tools"
+  subsection "Install python3 and packages"
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install \
+    dnsutils \
+  	python3 \
+    python3-cryptography \
+  	python3-dev \
+  	python3-gpiozero \
+  	python3-gi \
+    python3-setuptools \
+    cmake \
+    gcc \
+    libgirepository1.0-dev \
+    libcairo2-dev \
+    pkg-config \
+    gir1.2-gtk-3.0 \
+    fail2ban
+}
 
 # # Firewalld
-# printf "\n\n# Install Firewalld\n"
+# section "Install Firewalld"
 # sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install firewalld
 # sudo systemctl enable firewalld
 # # webapplication
@@ -181,75 +275,169 @@ sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install \
 # sudo sed -i 's/FirewallBackend=nftables/FirewallBackend=iptables/' /etc/firewalld/firewalld.conf
 
 
-echo "## Install wiringpi for pywiegand"
-git clone $QUIET https://github.com/WiringPi/WiringPi.git /tmp/wiringpi
-cd /tmp/wiringpi
-./build
-sudo ldconfig
-cd ~
-
-echo "## Install pip packages"
-sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install python3-pip pipenv
-# remove pip configuration to avoid hash mismatch
-sudo rm /etc/pip.conf
-
-echo "## Configure systemd services"
-sudo cp -r /tmp/etc/systemd/* /etc/systemd/system/
-sudo systemctl daemon-reload
-sudo systemctl enable argus_server argus_monitor nginx
-
-printf "\n\n# Generate secrets\n"
-if [ -z "$ARGUS_DB_PASSWORD" ]; then
-  ARGUS_DB_PASSWORD="$(tr -dc 'A-Za-z0-9!#*+' </dev/urandom | head -c 24  ; echo)"
-fi
-if [ -z "$SALT" ]; then
-  SALT="$(tr -dc 'A-Za-z0-9!#$*+-' </dev/urandom | head -c 24  ; echo)"
-fi 
-if [ -z "$SECRET" ]; then
-  SECRET="$(tr -dc 'A-Za-z0-9!#$&()*+-.:;<=>?@{}' </dev/urandom | head -c 24  ; echo)"
-fi
-if [ -z "$ARGUS_MQTT_PASSWORD" ]; then
-  ARGUS_MQTT_PASSWORD="$(tr -dc 'A-Za-z0-9!#*+' </dev/urandom | head -c 24  ; echo)"
-fi
-
-echo "## Configure MQTT access"
-sudo mosquitto_passwd -b -c /etc/mosquitto/.passwd argus $ARGUS_MQTT_PASSWORD
-sudo chmod +r /etc/mosquitto/.passwd
-
-echo "## Configure Database access"
-sudo su - postgres -c "psql -c \"CREATE USER $ARGUS_DB_USERNAME WITH PASSWORD '$ARGUS_DB_PASSWORD';\""
-sudo su - postgres -c "psql -d $ARGUS_DB_NAME -c \"GRANT ALL PRIVILEGES ON DATABASE $ARGUS_DB_NAME TO $ARGUS_DB_USERNAME;\""
-sudo su - postgres -c "psql -d $ARGUS_DB_NAME -c \"GRANT ALL ON SCHEMA public TO $ARGUS_DB_USERNAME;\""
-
-# prepare the folder for the backend service
-mkdir /home/argus/server
-tee /home/argus/server/secrets.env > /dev/null <<EOL
+# the debian package is built to $WIRINGPI_ARTIFACT, a prebuilt package (uploaded by install.py) isn't built again
+WIRINGPI_ARTIFACT="${WIRINGPI_ARTIFACT:-/tmp/wiringpi.deb}"
+step_wiringpi() {
+  subsection "Install wiringpi for pywiegand"
+  if [ ! -f "$WIRINGPI_ARTIFACT" ]; then
+    rm -rf /tmp/wiringpi
+    git clone $QUIET https://github.com/WiringPi/WiringPi.git /tmp/wiringpi
+    cd /tmp/wiringpi
+    if [ -n "$WIRINGPI_VERSION" ]; then
+      git checkout $QUIET "$WIRINGPI_VERSION"
+    fi
+    MAKEFLAGS="-j$(nproc)" ./build debian
+    mv debian-template/wiringpi_*.deb "$WIRINGPI_ARTIFACT"
+    cd ~
+    rm -rf /tmp/wiringpi
+  fi
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install "$WIRINGPI_ARTIFACT"
+  sudo ldconfig
+}
+
+step_pip() {
+  subsection "Install pip packages"
+  sudo DEBIAN_FRONTEND=noninteractive apt-get $QUIET -y install python3-pip pipenv
+  # remove pip configuration to avoid hash mismatch
+  sudo rm -f /etc/pip.conf
+}
+
+step_services() {
+  subsection "Configure systemd services"
+  sudo cp -r /tmp/etc/systemd/* /etc/systemd/system/
+  sudo systemctl daemon-reload
+  sudo systemctl enable argus_server argus_monitor nginx
+}
+
+# read the secret of the previous installation
+get_secret() {
+  if [ -f /home/argus/server/secrets.env ]; then
+    sed -n "s/^$1=\"\(.*\)\"$/\1/p" /home/argus/server/secrets.env
+  fi
+}
+
+step_access() {
+  section "Generate secrets"
+  # reuse the secrets of the previous run (the database user already has the password)
+  ARGUS_DB_PASSWORD="${ARGUS_DB_PASSWORD:-$(get_secret DB_PASSWORD)}"
+  SALT="${SALT:-$(get_secret SALT)}"
+  SECRET="${SECRET:-$(get_secret SECRET)}"
+  ARGUS_MQTT_PASSWORD="${ARGUS_MQTT_PASSWORD:-$(get_secret ARGUS_MQTT_PASSWORD)}"
+  if [ -z "$ARGUS_DB_PASSWORD" ]; then
+    ARGUS_DB_PASSWORD="$(tr -dc 'A-Za-z0-9!#*+' </dev/urandom | head -c 24  ; echo)"
+  fi
+  if [ -z "$SALT" ]; then
+    SALT="$(tr -dc 'A-Za-z0-9!#$*+-' </dev/urandom | head -c 24  ; echo)"
+  fi
+  if [ -z "$SECRET" ]; then
+    SECRET="$(tr -dc 'A-Za-z0-9!#$&()*+-.:;<=>?@{}' </dev/urandom | head -c 24  ; echo)"
+  fi
+  if [ -z "$ARGUS_MQTT_PASSWORD" ]; then
+    ARGUS_MQTT_PASSWORD="$(tr -dc 'A-Za-z0-9!#*+' </dev/urandom | head -c 24  ; echo)"
+  fi
+
+  subsection "Configure MQTT access"
+  sudo mosquitto_passwd -b -c /etc/mosquitto/.passwd argus $ARGUS_MQTT_PASSWORD
+  sudo chmod +r /etc/mosquitto/.passwd
+
+  subsection "Configure Database access"
+  if sudo su - postgres -c "psql -tAc \"SELECT 1 FROM pg_roles WHERE rolname='$ARGUS_DB_USERNAME';\"" | grep -q 1; then
+    sudo su - postgres -c "psql -c \"ALTER USER $ARGUS_DB_USERNAME WITH PASSWORD '$ARGUS_DB_PASSWORD';\""
+  else
+    sudo su - postgres -c "psql -c \"CREATE USER $ARGUS_DB_USERNAME WITH PASSWORD '$ARGUS_DB_PASSWORD';\""
+  fi
+  sudo su - postgres -c "psql -d $ARGUS_DB_NAME -c \"GRANT ALL PRIVILEGES ON DATABASE $ARGUS_DB_NAME TO $ARGUS_DB_USERNAME;\""
+  sudo su - postgres -c "psql -d $ARGUS_DB_NAME -c \"GRANT ALL ON SCHEMA public TO $ARGUS_DB_USERNAME;\""
+
+  # prepare the folder for the backend service
+  mkdir -p /home/argus/server
+  tee /home/argus/server/secrets.env > /dev/null <<EOL
 SALT="$SALT"
 DB_PASSWORD="$ARGUS_DB_PASSWORD"
 SECRET="$SECRET"
 ARGUS_MQTT_PASSWORD="$ARGUS_MQTT_PASSWORD"
 EOL
 
-# prepare the folder for the frontend service
-mkdir /home/argus/webapplication
-
-# add access for the group to the home folder
-sudo chown -R argus:argus /home/argus
-sudo chmod g+rx /home/argus /home/argus/webapplication
-
-echo "## Configure /run folder"
-sudo mkdir -p /run/argus
-sudo chown argus:argus /run/argus
-sudo chmod 755 /run/argus
-# configuring the /run/argus temporary folder to create after every reboot
-echo "# Type Path                     Mode    UID     GID     Age     Argument" | sudo tee /usr/lib/tmpfiles.d/argus.conf
-echo "d /run/argus 0755 argus argus" | sudo tee /usr/lib/tmpfiles.d/argus.conf
-
-printf "\n\n# Restart services\n"
-# pick up all the changes without reboot
-sudo systemctl restart mosquitto
-sudo systemctl restart nginx
-
-printf "\n\n# Cleanup\n"
-sudo apt-get $QUIET clean
-sudo apt-get $QUIET autoremove
+  # prepare the folder for the frontend service
+  mkdir -p /home/argus/webapplication
+
+  # add access for the group to the home folder
+  sudo chown -R argus:argus /home/argus
+  sudo chmod g+rx /home/argus /home/argus/webapplication
+}
+
+step_run_folder() {
+  subsection "Configure /run folder"
+  sudo mkdir -p /run/argus
+  sudo chown argus:argus /run/argus
+  sudo chmod 755 /run/argus
+  # configuring the /run/argus temporary folder to create after every reboot
+  printf '%s\n' \
+    "# Type Path                     Mode    UID     GID     Age     Argument" \
+    "d /run/argus 0755 argus argus" | sudo tee /usr/lib/tmpfiles.d/argus.conf > /dev/null
+}
+
+step_restart() {
+  section "Restart services"
+  # pick up all the changes without reboot
+  sudo systemctl restart mosquitto
+  sudo systemctl restart nginx
+}
+
+step_cleanup() {
+  section "Cleanup"
+  sudo apt-get $QUIET clean
+  sudo apt-get $QUIET autoremove
+}
+
+
+# run the step (stopping at the first failing command) unless it is completed or excluded
+run_step() {
+  local name="$1"
+  if [ -n "$ONLY_STEPS" ]; then
+    [[ ",$ONLY_STEPS," == *",$name,"* ]] || return 0
+  elif [ -f "$STEPS_DIR/$name" ]; then
+    echo "Step '$name' is already completed ($(cat "$STEPS_DIR/$name"))"
+    return 0
+  fi
+  if [[ ",$SKIP_STEPS," == *",$name,"* ]]; then
+    echo "Step '$name' is skipped"
+    return 0
+  fi
+
+  ( set -e; "step_$name" )
+  local status=$?
+  if [ $status -ne 0 ]; then
+    echo "Step '$name' failed with exit status $status, run the installation again to resume"
+    exit $status
+  fi
+  mkdir -p "$STEPS_DIR"
+  date -Iseconds > "$STEPS_DIR/$name"
+}
+
+ONLY_STEPS=""
+SKIP_STEPS=""
+while [ $# -gt 0 ]; do
+  case "$1" in
+    --only) ONLY_STEPS="$2"; shift 2 ;;
+    --skip) SKIP_STEPS="$2"; shift 2 ;;
+    --list)
+      for step in $STEPS; do
+        echo "$step $(cat "$STEPS_DIR/$step" 2>/dev/null || echo "-")"
+      done
+      exit 0 ;;
+    --reset) rm -rf "$STEPS_DIR"; shift ;;
+    *) echo "Unknown argument: $1"; exit 1 ;;
+  esac
+done
+
+for step in ${ONLY_STEPS//,/ } ${SKIP_STEPS//,/ }; do
+  if [[ " $STEPS " != *" $step "* ]]; then
+    echo "Unknown step: $step (steps: $STEPS)"
+    exit 1
+  fi
+done
+
+for step in $STEPS; do
+  run_step "$step"
+done
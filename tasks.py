@@ -11,6 +11,7 @@ from enum import Enum
 from sh import ng
 from invoke import task
 
+from release_utils import build_delta, build_release
 from task_utils import check_uncommitted_changes, tag_repository, update_version_files
 
 
@@ -44,6 +45,34 @@ def build_webapplication(c):
     )
 
 
+@task(
+    help={
+        "component": f"(optional) Component of the ArPI Home Security system to package {[c.value for c in Component]}.",
+        "version": "(optional) Version of the release stored in the manifest.",
+    }
+)
+def package(c, component: Component = None, version=None):
+    """
+    Builds the reproducible release artifacts with their manifests.
+    """
+    components = [component] if component else [member.value for member in Component]
+    for name in components:
+        build_release(name, version)
+
+
+@task(
+    help={
+        "component": f"Component of the ArPI Home Security system {[c.value for c in Component]}.",
+        "base_manifest": "Manifest of the release to update from (<artifact>.manifest.json).",
+    }
+)
+def package_delta(c, component: Component, base_manifest):
+    """
+    Builds the delta artifact from an earlier release to the last packaged one.
+    """
+    build_delta(component, base_manifest)
+
+
 @task(
     help={
         "version": "Version of the ArPI Home Security system to release.",
@@ -61,6 +90,7 @@ def release(c, version, component: Component = None, dry_run=False):
         if check_uncommitted_changes("server"):
             print("Please commit your changes first!")
             exit(1)
+        package(c, component, version)
         if not dry_run:
             tag_repository(version=version, path="server")
     elif component == Component.WEBAPPLICATION.value:
@@ -68,6 +98,7 @@ def release(c, version, component: Component = None, dry_run=False):
             print("Please commit your changes first!")
             exit(1)
         build_webapplication(c)
+        package(c, component, version)
         if not dry_run:
             tag_repository(version=version, path="webapplication")
     else:
@@ -79,6 +110,7 @@ def release(c, version, component: Component = None, dry_run=False):
             exit(1)
 
         build_webapplication(c)
+        package(c, version=version)
         if not dry_run:
             tag_repository(version=version, path="server")
             tag_repository(version=version, path="webapplication")
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# the modules are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_transfer import connect, start_server  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def remote(tmp_path_factory):
+    """
+    Connection to the local SSH server of the benchmark and its root directory
+    """
+    root = tmp_path_factory.mktemp("remote")
+    ssh = connect(start_server(str(root)))
+    yield ssh, root
+    ssh.close()
@@ -0,0 +1,138 @@
+import hashlib
+import http.server
+import logging
+import os
+import threading
+
+import pytest
+
+import manage_versions
+from manage_versions import ARTIFACTS_DIR, ChecksumError, download
+
+VERSION = "v1.0.0"
+FILENAME = "arpi-server.tar.gz"
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of the directory with the range requests (like GitHub)
+    """
+
+    def do_GET(self):
+        path = os.path.join(self.server.directory, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, "rb") as served_file:
+            data = served_file.read()
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        offset = int(self.headers["Range"][len("bytes="):].rstrip("-")) if self.headers.get("Range") else 0
+        if offset >= len(data) > 0:
+            self.send_error(416)
+            return
+
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Length", str(len(data) - offset))
+        self.end_headers()
+        self.wfile.write(data[offset:])
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture
+def github(tmp_path):
+    """
+    HTTP server of the release files: returns the URL of the repository and the release directory
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.directory = str(tmp_path / "github")
+    server.requests = []
+    release_path = tmp_path / "github" / "releases" / "download" / VERSION
+    release_path.mkdir(parents=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}", release_path
+    server.shutdown()
+    server.server_close()
+
+
+def publish(release_path, filename, data, checksum=True):
+    (release_path / filename).write_bytes(data)
+    if checksum:
+        (release_path / f"{filename}.sha256").write_text(f"{hashlib.sha256(data).hexdigest()}  {filename}\n")
+
+
+def test_cached_artifact_isnt_downloaded_again(tmp_path, github, caplog):
+    caplog.set_level(logging.INFO)
+    _, url, release_path = github
+    publish(release_path, FILENAME, b"release" * 1000)
+    path = download(url, VERSION, FILENAME, str(tmp_path / "cache"))
+    (release_path / FILENAME).unlink()
+
+    assert download(url, VERSION, FILENAME, str(tmp_path / "cache")) == path
+    assert "Using cached" in caplog.text
+    with open(path, "rb") as artifact:
+        assert artifact.read() == b"release" * 1000
+
+
+def test_changed_cached_artifact_is_downloaded_again(tmp_path, github):
+    _, url, release_path = github
+    publish(release_path, FILENAME, b"release" * 1000)
+    path = download(url, VERSION, FILENAME, str(tmp_path / "cache"))
+    with open(path, "wb") as artifact:
+        artifact.write(b"broken")
+
+    download(url, VERSION, FILENAME, str(tmp_path / "cache"))
+
+    with open(path, "rb") as artifact:
+        assert artifact.read() == b"release" * 1000
+
+
+def test_checksum_mismatch(tmp_path, github):
+    _, url, release_path = github
+    publish(release_path, FILENAME, b"release" * 1000)
+    (release_path / f"{FILENAME}.sha256").write_text(f"{'0' * 64}  {FILENAME}\n")
+
+    with pytest.raises(ChecksumError):
+        download(url, VERSION, FILENAME, str(tmp_path / "cache"))
+
+    assert os.listdir(tmp_path / "cache" / ARTIFACTS_DIR) == []
+
+
+def test_interrupted_download_is_resumed(tmp_path, github, caplog):
+    caplog.set_level(logging.INFO)
+    server, url, release_path = github
+    data = os.urandom(300 * 1024)
+    publish(release_path, FILENAME, data)
+    artifacts_dir = tmp_path / "cache" / ARTIFACTS_DIR
+    artifacts_dir.mkdir(parents=True)
+    full_url = f"{url}/releases/download/{VERSION}/{FILENAME}"
+    partial_path = artifacts_dir / (hashlib.sha256(full_url.encode()).hexdigest() + ".part")
+    partial_path.write_bytes(data[:100 * 1024])
+
+    path = download(url, VERSION, FILENAME, str(tmp_path / "cache"))
+
+    assert "Resuming download from 102400 bytes" in caplog.text
+    assert (f"/releases/download/{VERSION}/{FILENAME}", "bytes=102400-") in server.requests
+    with open(path, "rb") as artifact:
+        assert artifact.read() == data
+    assert not partial_path.exists()
+
+
+def test_least_recently_used_artifacts_are_removed(tmp_path, github, monkeypatch):
+    _, url, release_path = github
+    for name in ("first.tar.gz", "second.tar.gz", "third.tar.gz"):
+        publish(release_path, name, name.encode() * 1000)
+    times = iter(range(1, 10))
+    monkeypatch.setattr(manage_versions, "time", lambda: next(times))
+    cache_dir = str(tmp_path / "cache")
+    first = download(url, VERSION, "first.tar.gz", cache_dir, cache_size=30000)
+    second = download(url, VERSION, "second.tar.gz", cache_dir, cache_size=30000)
+    # the first is used again
+    download(url, VERSION, "first.tar.gz", cache_dir, cache_size=30000)
+
+    third = download(url, VERSION, "third.tar.gz", cache_dir, cache_size=30000)
+
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
@@ -0,0 +1,88 @@
+import gzip
+import os
+import tarfile
+
+import pytest
+
+from install_utils import precompress_assets
+from release_utils import BLOCK_SIZE, build_release
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    return tmp_path / "server"
+
+
+def create_server(path, names):
+    for name in names:
+        filename = path / name
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # larger than a compressed block to compress in parallel
+        filename.write_bytes(f"# {name}\n".encode() * (BLOCK_SIZE // 8))
+    (path / "src" / "__pycache__").mkdir(parents=True, exist_ok=True)
+    (path / "src" / "__pycache__" / "app.cpython-311.pyc").write_bytes(b"bytecode")
+
+
+NAMES = ["Pipfile", "Pipfile.lock", "etc/nginx.conf", "scripts/start.sh", "src/app.py", "src/models/user.py"]
+
+
+def build(tmp_path, name, workers):
+    output = tmp_path / name
+    output.mkdir()
+    with open(build_release("server", "v1.0.0", str(output), workers), "rb") as artifact:
+        return artifact.read()
+
+
+def test_same_source_gives_the_same_artifact(tmp_path, server):
+    create_server(server, NAMES)
+    first = build(tmp_path, "first", workers=1)
+
+    # the same files created again in a different order, later and with other permissions
+    os.rename(server, tmp_path / "old_server")
+    create_server(server, reversed(NAMES))
+    os.chmod(server / "src" / "app.py", 0o600)
+    os.utime(server / "etc" / "nginx.conf", (0, 0))
+    second = build(tmp_path, "second", workers=4)
+
+    assert first == second
+
+
+def test_artifact_content(tmp_path, server):
+    create_server(server, NAMES)
+    data = build(tmp_path, "output", workers=4)
+    artifact = tmp_path / "output" / "arpi-server.tar.gz"
+
+    with tarfile.open(artifact) as archive:
+        members = archive.getmembers()
+    files = [member.name for member in members if member.isfile()]
+    assert files == sorted(files)
+    assert set(files) == set(NAMES)
+    assert {(member.mtime, member.uid, member.gid, member.uname, member.gname) for member in members} == {
+        (1700000000, 0, 0, "", "")
+    }
+    # a valid gzip stream of the parallel compressed blocks
+    assert len(gzip.decompress(data)) > len(NAMES) * BLOCK_SIZE
+    assert (tmp_path / "output" / "arpi-server.tar.gz.sha256").exists()
+    assert (tmp_path / "output" / "arpi-server.tar.gz.manifest.json").exists()
+
+
+def test_precompressed_assets_arent_released(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    dist = tmp_path / "webapplication" / "dist-production"
+    (dist / "en").mkdir(parents=True)
+    (dist / "en" / "main.js").write_text("console.log('main');\n" * 1000, encoding="utf-8")
+    (dist / "en" / "index.html").write_text("<html></html>\n", encoding="utf-8")
+    (tmp_path / "first").mkdir()
+    first = build_release("webapplication", "v1.0.0", str(tmp_path / "first"))
+
+    # install.py webapplication
+    precompress_assets(str(dist), ["gzip"])
+    (tmp_path / "second").mkdir()
+    second = build_release("webapplication", "v1.0.0", str(tmp_path / "second"))
+
+    assert (dist / "en" / "main.js.gz").exists()
+    with open(first, "rb") as first_artifact, open(second, "rb") as second_artifact:
+        assert first_artifact.read() == second_artifact.read()
@@ -0,0 +1,19 @@
+import importlib.util
+import marshal
+import os
+
+from install import upload_python_sources
+
+
+def test_bytecode_has_the_remote_paths(tmp_path, monkeypatch, remote):
+    ssh, root = remote
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "server" / "src" / "monitor").mkdir(parents=True)
+    (tmp_path / "server" / "src" / "monitor" / "alert.py").write_text("ALERT = 1\n", encoding="utf-8")
+
+    upload_python_sources(ssh, os.path.join("server", "src", "monitor"), bytecode=True)
+
+    source = os.path.join(root, "server", "src", "monitor", "alert.py")
+    with open(importlib.util.cache_from_source(source), "rb") as bytecode:
+        code = marshal.loads(bytecode.read()[16:])
+    assert code.co_filename == source
@@ -0,0 +1,115 @@
+import json
+import os
+
+import pytest
+
+import install_utils
+from install_utils import MANIFEST_FILENAME, build_manifest, collect_tree, deep_copy
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """
+    Records the files transferred by deep_copy
+    """
+    uploaded = []
+    scp_put = install_utils.TRANSFER_METHODS["scp"]
+
+    def recording_put(ssh, directory, entries, progress):
+        uploaded.extend(target for _, target in entries)
+        scp_put(ssh, directory, entries, progress)
+
+    monkeypatch.setitem(install_utils.TRANSFER_METHODS, "scp", recording_put)
+    return uploaded
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content, encoding="utf-8")
+
+
+def read_manifest(target):
+    with open(target / MANIFEST_FILENAME, encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)["files"]
+
+
+def get_files(path):
+    return {
+        os.path.relpath(os.path.join(root, filename), path)
+        for root, _, files in os.walk(path) for filename in files if filename != MANIFEST_FILENAME
+    }
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / "source"
+    write(source / "app.py", "print('app')\n")
+    write(source / "models" / "user.py", "class User: pass\n")
+    write(source / "models" / "alert.py", "class Alert: pass\n")
+    return source
+
+
+def test_manifest_describes_the_full_upload(remote, source, uploads):
+    ssh, root = remote
+    target = root / "full"
+
+    deep_copy(ssh, str(source), str(target), "**/*", False)
+
+    assert sorted(uploads) == ["app.py", "models/alert.py", "models/user.py"]
+    assert read_manifest(target) == build_manifest(str(source), collect_tree(str(source), "**/*"))
+
+
+def test_delta_uploads_only_the_changes(remote, source, uploads):
+    ssh, root = remote
+    target = root / "delta"
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+    uploads.clear()
+
+    write(source / "models" / "user.py", "class User: name = None\n")
+    write(source / "models" / "zone.py", "class Zone: pass\n")
+    (source / "models" / "alert.py").unlink()
+    # the same content with a new modification time isn't a change
+    os.utime(source / "app.py", (0, 0))
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+
+    assert sorted(uploads) == ["models/user.py", "models/zone.py"]
+    assert get_files(target) == {"app.py", "models/user.py", "models/zone.py"}
+    assert (target / "models" / "user.py").read_text(encoding="utf-8") == "class User: name = None\n"
+    assert read_manifest(target) == build_manifest(str(source), collect_tree(str(source), "**/*"))
+
+
+def test_full_upload_updates_the_manifest(remote, source, uploads):
+    ssh, root = remote
+    target = root / "mixed"
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+
+    write(source / "app.py", "print('changed')\n")
+    deep_copy(ssh, str(source), str(target), "**/*", False)
+    write(source / "app.py", "print('app')\n")
+    uploads.clear()
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+
+    assert uploads == ["app.py"]
+    assert (target / "app.py").read_text(encoding="utf-8") == "print('app')\n"
+
+
+def test_invalid_manifest_uploads_all_the_files(remote, source, uploads):
+    ssh, root = remote
+    target = root / "invalid"
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+    (target / MANIFEST_FILENAME).write_text("{", encoding="utf-8")
+    uploads.clear()
+
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+
+    assert sorted(uploads) == ["app.py", "models/alert.py", "models/user.py"]
+
+
+def test_empty_full_upload_removes_the_manifest(remote, source, tmp_path):
+    ssh, root = remote
+    target = root / "emptied"
+    deep_copy(ssh, str(source), str(target), "**/*", False, delta=True)
+
+    deep_copy(ssh, str(tmp_path / "empty"), str(target), "**/*", False)
+
+    assert not (target / MANIFEST_FILENAME).exists()
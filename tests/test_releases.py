@@ -0,0 +1,287 @@
+import io
+import logging
+import os
+import tarfile
+
+import pytest
+
+import manage_versions
+import release_utils
+
+SERVER_FILES = {
+    "Pipfile": "[packages]\n",
+    "Pipfile.lock": "{}\n",
+    "etc/argus.conf": "debug = false\n",
+    "scripts/start.sh": "#!/bin/bash\n",
+    "src/app.py": "print('v1.0.0')\n",
+    "src/models.py": "class User: pass\n",
+}
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    """
+    Publishes the releases of the server to a file:// URL like the GitHub releases
+    """
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    path = tmp_path / "repository"
+    build_path = tmp_path / "build"
+
+    def publish(version, files, base_version=None):
+        release_path = path / "releases" / "download" / version
+        release_path.mkdir(parents=True)
+        write_tree(build_path / "server", files)
+        monkeypatch.chdir(build_path)
+        release_utils.build_release("server", version, str(release_path))
+        if base_version:
+            base_manifest = path / "releases" / "download" / base_version / "arpi-server.tar.gz.manifest.json"
+            release_utils.build_delta("server", str(base_manifest), str(release_path))
+        return release_path
+
+    publish.url = path.as_uri()
+    return publish
+
+
+@pytest.fixture
+def device(tmp_path, monkeypatch, repository):
+    """
+    The home directory of the device (ARGUS_HOME)
+    """
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setattr(manage_versions, "ARGUS_HOME", str(home))
+    monkeypatch.setattr(manage_versions, "RELEASES_DIR", str(home / "releases"))
+    monkeypatch.setattr(manage_versions, "SHARED_DIR", str(home / "shared"))
+    monkeypatch.setattr(manage_versions, "TEMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(manage_versions, "SERVER_GITURL", repository.url)
+    (tmp_path / "tmp").mkdir()
+    return home
+
+
+def write_tree(path, files):
+    if path.exists():
+        for root, _, names in os.walk(path):
+            for name in names:
+                os.remove(os.path.join(root, name))
+    for name, content in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(content, encoding="utf-8")
+
+
+def read_tree(path):
+    return {
+        os.path.relpath(os.path.join(root, name), path): open(os.path.join(root, name), encoding="utf-8").read()
+        for root, _, names in os.walk(path) for name in names
+    }
+
+
+def update(tmp_path, version, delta=True, keep=manage_versions.RELEASES_KEEP):
+    return manage_versions.update_release("server", version, cache_dir=str(tmp_path / "cache"), keep=keep, delta=delta)
+
+
+NEW_FILES = {
+    **{name: content for name, content in SERVER_FILES.items() if name != "src/models.py"},
+    "src/app.py": "print('v1.1.0')\n",
+    "src/alerts.py": "class Alert: pass\n",
+}
+
+
+def test_delta_release(tmp_path, repository, device, caplog):
+    caplog.set_level(logging.INFO)
+    repository("v1.0.0", SERVER_FILES)
+    repository("v1.1.0", NEW_FILES, base_version="v1.0.0")
+    update(tmp_path, "v1.0.0")
+
+    update(tmp_path, "v1.1.0")
+
+    assert "Applied delta from v1.0.0 to v1.1.0: 2 files changed, 1 files removed" in caplog.text
+    assert read_tree(device / "server") == NEW_FILES
+    assert os.path.realpath(device / "releases" / "server" / "previous") == str(device / "releases" / "server" / "v1.0.0")
+
+
+def test_delta_release_doesnt_share_the_files(tmp_path, repository, device):
+    repository("v1.0.0", SERVER_FILES)
+    repository("v1.1.0", NEW_FILES, base_version="v1.0.0")
+    update(tmp_path, "v1.0.0")
+    update(tmp_path, "v1.1.0")
+
+    # install.py writes the files of the active release in place
+    with open(device / "server" / "Pipfile", "w", encoding="utf-8") as pipfile:
+        pipfile.write("[dev-packages]\n")
+
+    assert (device / "releases" / "server" / "v1.0.0" / "Pipfile").read_text(encoding="utf-8") == "[packages]\n"
+
+
+def test_missing_delta_falls_back_to_the_full_release(tmp_path, repository, device, caplog):
+    repository("v1.0.0", SERVER_FILES)
+    repository("v1.1.0", NEW_FILES)
+    update(tmp_path, "v1.0.0")
+
+    update(tmp_path, "v1.1.0")
+
+    assert "Delta update failed, downloading the full release" in caplog.text
+    assert read_tree(device / "server") == NEW_FILES
+    assert not os.path.exists(device / "releases" / "server" / "v1.1.0_staging")
+
+
+def test_delta_on_a_changed_release_falls_back_to_the_full_release(tmp_path, repository, device, caplog):
+    repository("v1.0.0", SERVER_FILES)
+    repository("v1.1.0", NEW_FILES, base_version="v1.0.0")
+    update(tmp_path, "v1.0.0")
+    (device / "server" / "scripts" / "start.sh").write_text("#!/bin/sh\n", encoding="utf-8")
+
+    update(tmp_path, "v1.1.0")
+
+    assert "File scripts/start.sh doesn't match the manifest" in caplog.text
+    assert read_tree(device / "server") == NEW_FILES
+
+
+def build_archive(name, **attributes):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as archive:
+        member = tarfile.TarInfo(name)
+        for key, value in attributes.items():
+            setattr(member, key, value)
+        archive.addfile(member, io.BytesIO(b"") if member.isfile() else None)
+    data.seek(0)
+    return data
+
+
+UNSAFE_MEMBERS = [
+    ("../outside.py", {}),
+    ("src/../../outside.py", {}),
+    ("link", {"type": tarfile.SYMTYPE, "linkname": "../outside"}),
+    ("link", {"type": tarfile.SYMTYPE, "linkname": "/etc/passwd"}),
+    ("hardlink", {"type": tarfile.LNKTYPE, "linkname": "../outside"}),
+    ("device", {"type": tarfile.CHRTYPE}),
+]
+
+
+@pytest.mark.parametrize("data_filter", [True, False], ids=["data filter", "checked members"])
+@pytest.mark.parametrize("name, attributes", UNSAFE_MEMBERS)
+def test_unsafe_members_are_rejected(tmp_path, monkeypatch, data_filter, name, attributes):
+    if not data_filter:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+    target_path = tmp_path / "release"
+    target_path.mkdir()
+
+    with tarfile.open(fileobj=build_archive(name, **attributes), mode="r|gz") as archive:
+        with pytest.raises(tarfile.TarError):
+            manage_versions.extract_archive(archive, str(target_path))
+
+    assert os.listdir(tmp_path) == ["release"]
+
+
+def test_absolute_members_are_rejected(tmp_path, monkeypatch):
+    monkeypatch.delattr(tarfile, "data_filter", raising=False)
+
+    with tarfile.open(fileobj=build_archive(str(tmp_path / "outside.py")), mode="r|gz") as archive:
+        with pytest.raises(manage_versions.UnsafeArchiveError):
+            manage_versions.extract_archive(archive, str(tmp_path / "release"))
+
+    assert not (tmp_path / "outside.py").exists()
+
+
+def test_streamed_release_isnt_stored(tmp_path, repository):
+    repository("v1.0.0", SERVER_FILES)
+    target_path = tmp_path / "server_staging"
+
+    manage_versions.stream_release(repository.url, "v1.0.0", "arpi-server.tar.gz", str(target_path), str(tmp_path / "cache"))
+
+    assert read_tree(target_path) == SERVER_FILES
+    assert not (tmp_path / "cache" / manage_versions.ARTIFACTS_DIR).exists()
+
+
+def test_streamed_release_with_checksum_mismatch(tmp_path, repository):
+    release_path = repository("v1.0.0", SERVER_FILES)
+    (release_path / "arpi-server.tar.gz.sha256").write_text(f"{'0' * 64}  arpi-server.tar.gz\n", encoding="utf-8")
+    target_path = tmp_path / "server_staging"
+
+    with pytest.raises(manage_versions.ChecksumError):
+        manage_versions.stream_release(
+            repository.url, "v1.0.0", "arpi-server.tar.gz", str(target_path), str(tmp_path / "cache")
+        )
+
+    assert not target_path.exists()
+
+
+def test_cached_release_is_extracted_from_the_cache(tmp_path, repository):
+    release_path = repository("v1.0.0", SERVER_FILES)
+    manage_versions.download(repository.url, "v1.0.0", "arpi-server.tar.gz", str(tmp_path / "cache"))
+    (release_path / "arpi-server.tar.gz").unlink()
+    target_path = tmp_path / "server_staging"
+
+    manage_versions.stream_release(repository.url, "v1.0.0", "arpi-server.tar.gz", str(target_path), str(tmp_path / "cache"))
+
+    assert read_tree(target_path) == SERVER_FILES
+
+
+def test_working_directory_is_adopted_as_a_release(tmp_path, repository, device):
+    repository("v1.0.0", SERVER_FILES)
+    write_tree(device / "server", {"src/app.py": "print('installed')\n", ".env": "SECRET=1\n"})
+
+    update(tmp_path, "v1.0.0")
+
+    releases = os.listdir(device / "releases" / "server")
+    initial = next(name for name in releases if name.startswith("initial_"))
+    assert read_tree(device / "releases" / "server" / initial / "src") == {"app.py": "print('installed')\n"}
+    assert os.path.realpath(device / "releases" / "server" / "previous") == str(device / "releases" / "server" / initial)
+    # the configuration is shared by the releases
+    assert (device / "shared" / "server" / ".env").read_text(encoding="utf-8") == "SECRET=1\n"
+    assert os.path.realpath(device / "server" / ".env") == str(device / "shared" / "server" / ".env")
+
+
+def test_rollback(tmp_path, repository, device):
+    repository("v1.0.0", SERVER_FILES)
+    repository("v1.1.0", NEW_FILES)
+    update(tmp_path, "v1.0.0")
+    update(tmp_path, "v1.1.0")
+
+    assert manage_versions.rollback("server")
+    assert read_tree(device / "server") == SERVER_FILES
+    assert manage_versions.rollback("server")
+    assert read_tree(device / "server") == NEW_FILES
+    assert manage_versions.rollback("server", "v1.0.0")
+    assert read_tree(device / "server") == SERVER_FILES
+    assert not manage_versions.rollback("server", "v2.0.0")
+
+
+@pytest.mark.parametrize("linked_home", [False, True], ids=["home", "linked home"])
+def test_prune_keeps_the_active_and_the_previous_release(tmp_path, repository, device, monkeypatch, linked_home):
+    versions = ["v1.0.0", "v1.1.0", "v1.2.0", "v1.3.0"]
+    for version in versions:
+        repository(version, {**SERVER_FILES, "src/app.py": f"print('{version}')\n"})
+        update(tmp_path, version, delta=False, keep=len(versions))
+    manage_versions.rollback("server", "v1.0.0")
+    releases_path = device / "releases" / "server"
+    # the active (v1.0.0) and the previous (v1.3.0) releases are the least recently used
+    for age, version in enumerate(["v1.2.0", "v1.1.0", "v1.3.0", "v1.0.0"]):
+        os.utime(releases_path / version, (1700000000 - age, 1700000000 - age))
+    if linked_home:
+        os.symlink(device, tmp_path / "linked_home")
+        monkeypatch.setattr(manage_versions, "ARGUS_HOME", str(tmp_path / "linked_home"))
+        monkeypatch.setattr(manage_versions, "RELEASES_DIR", str(tmp_path / "linked_home" / "releases"))
+
+    manage_versions.prune_releases("server", keep=1)
+
+    assert sorted(manage_versions.get_releases("server")) == ["v1.0.0", "v1.2.0", "v1.3.0"]
+    assert read_tree(device / "server")["src/app.py"] == "print('v1.0.0')\n"
+
+
+def test_update_server_compares_the_files_once(tmp_path, repository, device, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    repository("v1.0.0", SERVER_FILES)
+    repository("v1.1.0", NEW_FILES)
+    write_tree(device / "server", SERVER_FILES)
+    manage_versions.update_server("v1.0.0", cache_dir=str(tmp_path / "cache"))
+    compared = []
+    is_different = manage_versions.is_different
+    monkeypatch.setattr(
+        manage_versions, "is_different", lambda left, right: compared.append(left) or is_different(left, right)
+    )
+
+    changes = manage_versions.update_server("v1.1.0", cache_dir=str(tmp_path / "cache"))
+
+    assert changes["modified"] == ["src/app.py"]
+    assert len(compared) == len(SERVER_FILES.keys() & NEW_FILES.keys())
+    assert "File difference src/app.py" in caplog.text
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from install_utils import Step, run_steps
+
+
+def record(events, name, delay=0.0, error=None):
+    def function():
+        events.append(("start", name))
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        events.append(("end", name))
+
+    return function
+
+
+def test_dependencies_finish_before_the_step():
+    events = []
+    steps = [
+        Step("server", record(events, "server", 0.05), ["environment"]),
+        Step("environment", record(events, "environment", 0.05), []),
+        Step("database", record(events, "database"), ["environment", "server"]),
+    ]
+
+    run_steps(steps, workers=4)
+
+    assert events.index(("end", "environment")) < events.index(("start", "server"))
+    assert events.index(("end", "server")) < events.index(("start", "database"))
+
+
+def test_independent_steps_run_in_parallel():
+    barrier = threading.Barrier(2, timeout=5)
+    steps = [Step("server", barrier.wait, []), Step("webapplication", barrier.wait, [])]
+
+    run_steps(steps, workers=2)
+
+
+def test_dependencies_not_selected_are_ignored():
+    events = []
+
+    run_steps([Step("server", record(events, "server"), ["environment"])], workers=1)
+
+    assert events == [("start", "server"), ("end", "server")]
+
+
+def test_failure_stops_the_dependent_steps():
+    events = []
+    error = RuntimeError("failed")
+    steps = [
+        Step("environment", record(events, "environment", error=error), []),
+        Step("server", record(events, "server"), ["environment"]),
+        Step("monitor", record(events, "monitor", 0.05), []),
+    ]
+
+    with pytest.raises(RuntimeError) as raised:
+        run_steps(steps, workers=2)
+
+    assert raised.value is error
+    assert ("start", "server") not in events
+    # the running steps are finished
+    assert ("end", "monitor") in events
+
+
+def test_circular_dependencies():
+    steps = [Step("server", lambda: None, ["database"]), Step("database", lambda: None, ["server"])]
+
+    with pytest.raises(ValueError):
+        run_steps(steps, workers=2)
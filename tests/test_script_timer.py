@@ -0,0 +1,67 @@
+from trace_utils import ScriptTimer
+
+
+def feed(timer, lines, elapsed=0.0):
+    for line in lines:
+        timer.on_line("stdout", elapsed, line)
+    return timer
+
+
+def test_sections_and_subsections():
+    timer = feed(ScriptTimer(), [
+        "+100.000000 section 'Install NGINX'",
+        "",
+        "::section:: Install NGINX",
+        "+100.000100 subsection Download",
+        "::subsection:: Download",
+        "+100.000200 curl -s -O -J http://nginx.org/download/nginx-1.25.3.tar.gz",
+        "+102.000000 subsection Build",
+        "::subsection:: Build",
+        "+102.000100 make -j4",
+        "+110.000000 section 'Restart services'",
+        "::section:: Restart services",
+        "+110.000100 sudo systemctl restart nginx",
+    ])
+    timer.finish()
+    report = timer.get_report()
+
+    assert report["total"] == 10.0
+    assert [(section["name"], section["duration"]) for section in report["sections"]] == [
+        ("Install NGINX", 10.0), ("Restart services", 0.0)
+    ]
+    assert [(subsection["name"], subsection["duration"]) for subsection in report["sections"][0]["subsections"]] == [
+        ("Download", 2.0), ("Build", 8.0)
+    ]
+    make = next(command for command in report["commands"] if command["command"] == "make -j4")
+    assert (make["section"], make["subsection"], make["duration"]) == ("Install NGINX", "Build", 8.0)
+
+
+def test_output_of_the_commands_isnt_a_section():
+    timer = feed(ScriptTimer(), [
+        "+1.0 echo '## not a section'",
+        "## not a section",
+        "+2.0 printf '# neither\\n'",
+        "# neither",
+        "+3.0 grep '^# ' /etc/ssh/sshd_config",
+        "# PasswordAuthentication yes",
+    ])
+
+    assert timer.get_report()["sections"] == []
+
+
+def test_nesting_level_and_the_end_of_the_last_command():
+    timer = ScriptTimer()
+    feed(timer, ["+10.0 cd /tmp", "++11.0 nproc"], elapsed=1.0)
+    feed(timer, ["4"], elapsed=3.5)
+    timer.finish()
+    commands = timer.get_report()["commands"]
+
+    assert [(command["level"], command["command"]) for command in commands] == [(1, "cd /tmp"), (2, "nproc")]
+    # the last command lasts until the last output line
+    assert commands[-1]["duration"] == 2.5
+
+
+def test_time_of_the_day_after_midnight():
+    timer = feed(ScriptTimer(), ["+23:59:50 apt-get update", "+00:00:20 apt-get upgrade"])
+
+    assert timer.get_report()["commands"][0]["duration"] == 30
@@ -0,0 +1,46 @@
+import threading
+
+from install_utils import MANIFEST_FILENAME, SFTP_SESSIONS, Step, deep_copy, run_steps
+
+
+def test_parallel_uploads_share_the_sftp_sessions(remote, tmp_path, monkeypatch):
+    ssh, root = remote
+    sessions = {"open": 0, "peak": 0}
+    lock = threading.Lock()
+    open_sftp = ssh.open_sftp
+
+    def counting_open_sftp():
+        sftp = open_sftp()
+        close = sftp.close
+        with lock:
+            sessions["open"] += 1
+            sessions["peak"] = max(sessions["peak"], sessions["open"])
+
+        def counting_close():
+            with lock:
+                sessions["open"] -= 1
+            close()
+
+        sftp.close = counting_close
+        return sftp
+
+    monkeypatch.setattr(ssh, "open_sftp", counting_open_sftp)
+
+    # the uploads of install.py --parallel
+    components = ["common", "server", "monitor", "migrations", "webapplication"]
+    names = [f"file{index}.py" for index in range(2 * SFTP_SESSIONS)]
+    for component in components:
+        (tmp_path / component).mkdir()
+        for name in names:
+            (tmp_path / component / name).write_text(f"# {component} {name}\n" * 1000, encoding="utf-8")
+
+    def upload(component):
+        return lambda: deep_copy(ssh, str(tmp_path / component), str(root / component), "**/*", False, method="sftp")
+
+    run_steps([Step(component, upload(component), []) for component in components], workers=len(components))
+
+    assert 0 < sessions["peak"] <= SFTP_SESSIONS
+    assert sessions["open"] == 0
+    for component in components:
+        assert sorted(path.name for path in (root / component).iterdir() if path.name != MANIFEST_FILENAME) == names
+        assert (root / component / "file0.py").read_text(encoding="utf-8") == f"# {component} file0.py\n" * 1000
@@ -0,0 +1,90 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import manage_versions
+from manage_versions import backup_folder, get_snapshots, restore_snapshot
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    Working directory of the server, the snapshots are taken one minute after the other
+    """
+    times = (datetime(2024, 5, 1, 12, 0) + timedelta(minutes=minutes) for minutes in range(1000))
+
+    class SnapshotTime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return next(times)
+
+    monkeypatch.setattr(manage_versions, "dt", SnapshotTime)
+    monkeypatch.setattr(manage_versions, "ARGUS_HOME", str(tmp_path))
+    path = tmp_path / "server"
+    (path / "src").mkdir(parents=True)
+    (path / "src" / "app.py").write_text("print('app')\n", encoding="utf-8")
+    (path / "src" / "models.py").write_text("class User: pass\n", encoding="utf-8")
+    os.symlink("/home/argus/shared/server/.env", path / ".env")
+    return path
+
+
+def test_unchanged_files_are_linked(server):
+    first = backup_folder(str(server))
+    (server / "src" / "models.py").write_text("class User: name = None\n", encoding="utf-8")
+
+    second = backup_folder(str(server))
+
+    assert os.path.samefile(os.path.join(first, "src", "app.py"), os.path.join(second, "src", "app.py"))
+    assert not os.path.samefile(os.path.join(first, "src", "models.py"), os.path.join(second, "src", "models.py"))
+    assert os.readlink(os.path.join(second, ".env")) == "/home/argus/shared/server/.env"
+    # the snapshots don't share the files with the working directory
+    with open(server / "src" / "app.py", "w", encoding="utf-8") as app:
+        app.write("print('changed')\n")
+    with open(os.path.join(first, "src", "app.py"), encoding="utf-8") as app:
+        assert app.read() == "print('app')\n"
+
+
+def test_snapshots_are_kept_by_default(server):
+    for _ in range(5):
+        backup_folder(str(server))
+
+    assert len(get_snapshots(str(server))) == 5
+
+    newest = backup_folder(str(server), keep=2)
+    assert get_snapshots(str(server)) == [newest, f"{server}_backup_20240501_120400"]
+
+
+def test_old_snapshots_are_removed(server, monkeypatch):
+    for _ in range(3):
+        backup_folder(str(server))
+    # the snapshots of 12:00 and 12:01 are older than two days
+    monkeypatch.setattr(manage_versions, "time", lambda: datetime(2024, 5, 3, 12, 1, 30).timestamp())
+
+    newest = backup_folder(str(server), max_age=2)
+
+    assert get_snapshots(str(server)) == [newest, f"{server}_backup_20240501_120200"]
+
+
+def test_restore_snapshot(server):
+    snapshot = backup_folder(str(server))
+    (server / "src" / "app.py").write_text("print('broken')\n", encoding="utf-8")
+    (server / "src" / "new.py").write_text("", encoding="utf-8")
+
+    assert restore_snapshot("server", snapshot.rsplit("_backup_", 1)[1])
+
+    assert sorted(os.listdir(server / "src")) == ["app.py", "models.py"]
+    assert (server / "src" / "app.py").read_text(encoding="utf-8") == "print('app')\n"
+    # the replaced state is saved too
+    saved = get_snapshots(str(server))[0]
+    with open(os.path.join(saved, "src", "app.py"), encoding="utf-8") as app:
+        assert app.read() == "print('broken')\n"
+    assert not os.path.samefile(server / "src" / "app.py", os.path.join(snapshot, "src", "app.py"))
+
+
+def test_release_isnt_restored_from_a_snapshot(server, tmp_path):
+    snapshot = backup_folder(str(server))
+    os.rename(server, tmp_path / "release")
+    os.symlink(tmp_path / "release", server)
+
+    assert not restore_snapshot("server", snapshot.rsplit("_backup_", 1)[1])
@@ -0,0 +1,240 @@
+"""
+Tracing the duration of the deployment steps.
+
+The spans are collected in memory and exported in the Chrome trace event format
+(JSON), which can be loaded into chrome://tracing or https://ui.perfetto.dev.
+The remote scripts are measured from their xtrace output (ScriptTimer).
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import re
+import threading
+from time import perf_counter
+
+
+logger = logging.getLogger(__name__)
+
+# start of the trace, the timestamps of the events are relative to it
+_start = perf_counter()
+_events = []
+# name of the thread (host, step) => id of the thread in the trace
+_threads = {}
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Measure the duration of the block.
+
+    Yields the arguments of the span, the block can add values to it (bytes, files...).
+    """
+    start = perf_counter()
+    try:
+        yield args
+    except BaseException as error:
+        args["error"] = repr(error)
+        raise
+    finally:
+        end = perf_counter()
+        thread_name = threading.current_thread().name
+        with _lock:
+            thread_id = _threads.setdefault(thread_name, len(_threads) + 1)
+            _events.append({
+                "name": name,
+                "ph": "X",
+                "ts": round((start - _start) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": thread_id,
+                "args": args,
+            })
+
+
+def traced(name=None):
+    """
+    Decorator measuring the duration of the function in a span.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_events():
+    """
+    Returns the finished spans.
+    """
+    with _lock:
+        return list(_events)
+
+
+def clear():
+    """
+    Drops the collected spans.
+    """
+    with _lock:
+        _events.clear()
+        _threads.clear()
+
+
+def export_trace(filename):
+    """
+    Saves the spans in the Chrome trace event format.
+    """
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+
+    # name the threads (hosts and steps) in the trace viewer
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread_id, "args": {"name": name}}
+        for name, thread_id in threads.items()
+    ]
+    with open(filename, "w", encoding="utf-8") as trace_file:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, trace_file, indent=1, default=str)
+
+    logger.info("Trace with %s spans saved to %s", len(events), filename)
+
+
+class ScriptTimer:
+    """
+    Measures the sections and the commands of a shell script from its xtrace output.
+
+    The trace lines start with the PS4 prompt: the nesting level ("+" characters) and the
+    timestamp (${EPOCHREALTIME} or \\t). The "::section:: title" and "::subsection:: title"
+    lines printed by the section and subsection functions of the script start the sections
+    and the subsections. Pass on_line as the callback of pump_output and call finish at the
+    end of the output.
+    """
+
+    TRACE_LINE = re.compile(r"^(\++)(\d+(?:[.,]\d+)?|\d{2}:\d{2}:\d{2}) (.*)$")
+    SECTION_MARKER = "::section:: "
+    SUBSECTION_MARKER = "::subsection:: "
+
+    def __init__(self):
+        # (level, start, command, section, subsection) with the time relative to the first trace line
+        self._commands = []
+        # (start, section, subsection)
+        self._sections = []
+        self._first_time = None
+        self._last_time = None
+        self._end = None
+        # local time of the last trace line and the last output line to estimate the end
+        self._trace_elapsed = None
+        self._elapsed = None
+
+    def on_line(self, stream, elapsed, line):  # pylint: disable=unused-argument
+        self._elapsed = elapsed
+        match = self.TRACE_LINE.match(line)
+        if match:
+            section, subsection = self._get_section()
+            self._commands.append(
+                (len(match.group(1)), self._parse_time(match.group(2)), match.group(3), section, subsection)
+            )
+            self._trace_elapsed = elapsed
+        elif self._commands:
+            level, start, command, section, _ = self._commands[-1]
+            if line.startswith(self.SUBSECTION_MARKER):
+                self._sections.append((start, section, line[len(self.SUBSECTION_MARKER):].strip()))
+            elif line.startswith(self.SECTION_MARKER):
+                self._sections.append((start, line[len(self.SECTION_MARKER):].strip(), ""))
+            else:
+                return
+            # the call of the section function belongs to the new section
+            self._commands[-1] = (level, start, command, *self._get_section())
+
+    def _get_section(self):
+        return self._sections[-1][1:] if self._sections else ("", "")
+
+    def _parse_time(self, value):
+        if ":" in value:
+            hours, minutes, seconds = value.split(":")
+            timestamp = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+            # the time of the day restarts at midnight
+            while self._last_time is not None and timestamp < self._last_time - 12 * 3600:
+                timestamp += 24 * 3600
+        else:
+            timestamp = float(value.replace(",", "."))
+
+        if self._first_time is None:
+            self._first_time = timestamp
+        self._last_time = timestamp
+        return timestamp - self._first_time
+
+    def finish(self):
+        """
+        Ends the last command at the time of the last output line.
+        """
+        if self._commands:
+            self._end = self._commands[-1][1] + (self._elapsed - self._trace_elapsed)
+
+    def get_report(self):
+        """
+        Returns the durations (seconds) of the sections, the subsections and the commands.
+
+        A command lasts until the next trace line, a section until the next section.
+        """
+        end = self._end if self._end is not None else (self._commands[-1][1] if self._commands else 0)
+        commands = []
+        for index, (level, start, command, section, subsection) in enumerate(self._commands):
+            next_start = self._commands[index + 1][1] if index + 1 < len(self._commands) else end
+            commands.append({
+                "section": section,
+                "subsection": subsection,
+                "level": level,
+                "command": command,
+                "start": round(start, 3),
+                "duration": round(next_start - start, 3),
+            })
+
+        sections = []
+        for index, (start, section, subsection) in enumerate(self._sections):
+            following = self._sections[index + 1:]
+            if subsection:
+                next_start = following[0][0] if following else end
+                if sections:
+                    sections[-1]["subsections"].append(
+                        {"name": subsection, "start": round(start, 3), "duration": round(next_start - start, 3)}
+                    )
+            else:
+                next_start = next((item[0] for item in following if not item[2]), end)
+                sections.append(
+                    {"name": section, "start": round(start, 3), "duration": round(next_start - start, 3), "subsections": []}
+                )
+
+        return {"total": round(end, 3), "sections": sections, "commands": commands}
+
+    def log_summary(self, limit=10):
+        """
+        Logs the duration of the sections and the slowest commands.
+        """
+        report = self.get_report()
+        logger.info("Duration of the script: %.1fs", report["total"])
+        for section in report["sections"]:
+            logger.info("  %8.1fs %s", section["duration"], section["name"])
+            for subsection in section["subsections"]:
+                logger.info("  %8.1fs   %s", subsection["duration"], subsection["name"])
+
+        logger.info("Slowest commands:")
+        for command in sorted(report["commands"], key=lambda command: command["duration"], reverse=True)[:limit]:
+            logger.info("  %8.1fs %s", command["duration"], command["command"][:100])
+
+    def save(self, filename):
+        """
+        Saves the report as JSON.
+        """
+        with open(filename, "w", encoding="utf-8") as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+
+        logger.info("Script timing saved to %s", filename)